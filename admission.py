@@ -0,0 +1,175 @@
+"""
+Admission control for the Healthcare BERT QA System
+
+Each traffic class ("ask", "batch", "upload") has its own budget: a per-client token
+bucket enforcing a requests-per-minute rate, and a concurrency limiter that
+lets a bounded number of requests wait a bounded time for a slot. Requests
+over budget are rejected at once with 429 or 503 and a Retry-After header,
+so a spike of uploads or batches cannot starve interactive questions and
+overload turns into fast rejections instead of timeouts. A batch request
+costs one token of its own budget whatever its size, which MAX_BATCH_SIZE
+caps. Limits apply per process.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Dict, Optional, Tuple
+
+import metrics
+from config import Config
+
+
+class RateLimiter:
+    """Per-client token buckets refilled at ``rate_per_minute``
+
+    A request costing more than the burst is admitted once its client's
+    bucket is full and leaves the bucket in debt, so every token is paid for.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, max_clients: int = 10000):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.max_clients = max_clients
+        # client -> (tokens, last refill time), least recently seen first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client: str, cost: float = 1.0) -> Optional[float]:
+        """Take ``cost`` tokens; return None if allowed, else seconds until they are available"""
+        needed = min(cost, self.capacity)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            if tokens >= needed:
+                tokens -= cost
+                retry_after = None
+            else:
+                retry_after = (needed - tokens) / self.rate if self.rate > 0 else 60.0
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight requests, queueing at most ``max_waiting`` for up to ``timeout`` seconds"""
+
+    def __init__(self, max_active: int, max_waiting: int, timeout: float):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> bool:
+        """Take a slot; return False if the queue is full or the deadline passes first"""
+        with self._condition:
+            if self.active < self.max_active and self.waiting == 0:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+
+            deadline = time.monotonic() + self.timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.max_active:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class Budget:
+    """Rate and concurrency limits of one traffic class"""
+
+    def __init__(self, name: str, rate_per_minute: float, burst: int, max_active: int, max_waiting: int,
+                 timeout: float):
+        self.name = name
+        self.rate_limiter = RateLimiter(rate_per_minute, burst)
+        self.concurrency = ConcurrencyLimiter(max_active, max_waiting, timeout)
+        self.rate_limited = metrics.REJECTED_REQUESTS.labels(name, "rate_limited")
+        self.overloaded = metrics.REJECTED_REQUESTS.labels(name, "overloaded")
+
+    def stats(self) -> Dict:
+        return {
+            "rate_per_minute": self.rate_limiter.rate * 60.0,
+            "burst": self.rate_limiter.capacity,
+            "active": self.concurrency.active,
+            "waiting": self.concurrency.waiting,
+            "max_active": self.concurrency.max_active,
+            "max_waiting": self.concurrency.max_waiting,
+        }
+
+
+budgets: Dict[str, Budget] = {
+    "ask": Budget("ask", Config.RATE_LIMIT_PER_MINUTE, Config.RATE_LIMIT_BURST,
+                  Config.MAX_CONCURRENT_ASKS, Config.MAX_QUEUED_ASKS, Config.ASK_QUEUE_TIMEOUT),
+    "batch": Budget("batch", Config.BATCH_RATE_LIMIT_PER_MINUTE, Config.BATCH_RATE_LIMIT_BURST,
+                    Config.MAX_CONCURRENT_BATCHES, Config.MAX_QUEUED_BATCHES, Config.BATCH_QUEUE_TIMEOUT),
+    "upload": Budget("upload", Config.UPLOAD_RATE_LIMIT_PER_MINUTE, Config.UPLOAD_RATE_LIMIT_BURST,
+                     Config.MAX_CONCURRENT_UPLOADS, Config.MAX_QUEUED_UPLOADS, Config.UPLOAD_QUEUE_TIMEOUT),
+}
+
+
+def _rejection(message: str, status: int, retry_after: float):
+    from flask import jsonify
+
+    response = jsonify({"error": message})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def limited(budget_name: str) -> Callable:
+    """Decorate a Flask view with the named budget's rate and concurrency limits
+
+    Clients are told apart by address, taken from X-Forwarded-For
+    when PROXY_TRUSTED_HOPS is set. Returns the view itself when
+    RATE_LIMIT_ENABLED is off.
+    """
+    budget = budgets[budget_name]
+
+    def decorator(view: Callable) -> Callable:
+        if not Config.RATE_LIMIT_ENABLED:
+            return view
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            from flask import request
+
+            retry_after = budget.rate_limiter.acquire(request.remote_addr or "unknown")
+            if retry_after is not None:
+                budget.rate_limited.inc()
+                return _rejection("Rate limit exceeded, please retry later", 429, retry_after)
+
+            if not budget.concurrency.acquire():
+                budget.overloaded.inc()
+                return _rejection("Server is busy, please retry later", 503, budget.concurrency.timeout)
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                budget.concurrency.release()
+                raise
+            # A streamed body is produced after the view returns, so its slot is held until it closes
+            if getattr(response, "is_streamed", False):
+                response.call_on_close(budget.concurrency.release)
+            else:
+                budget.concurrency.release()
+            return response
+        return wrapper
+    return decorator
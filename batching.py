@@ -0,0 +1,130 @@
+"""
+Dynamic micro-batching for the Healthcare BERT QA System
+
+Model inference is far cheaper per item in batches than one request at a
+time. ``MicroBatcher`` collects items submitted by concurrent request threads
+and runs them through one function call per batch. A batch is closed when it
+reaches ``max_batch_size`` or when its first item has waited ``max_wait``
+seconds. Every item is a ``concurrent.futures.Future``; a caller that gives up
+cancels its futures, and cancelled items are dropped before the batch runs.
+At most ``max_pending`` items wait at once; submissions past that are
+rejected with ``BatcherFull`` instead of queueing behind a stalled model.
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BatcherFull(RuntimeError):
+    """Raised when a batcher's queue already holds ``max_pending`` items"""
+
+
+class MicroBatcher:
+    """Runs items submitted from many threads through ``process`` in batches
+
+    ``process`` takes a list of items and returns one result per item. It
+    runs on a single daemon thread started on the first submission.
+    """
+
+    def __init__(self, process: Callable[[List[Any]], Sequence[Any]], max_batch_size: int, max_wait: float,
+                 max_pending: int = 0, name: str = "micro-batcher"):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        # (item, future, submission time); max_pending 0 leaves it unbounded
+        self._queue: "queue.Queue[Tuple[Any, Future, float]]" = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, item: Any) -> Future:
+        """Queue ``item`` for the next batch and return the future of its result
+
+        Raises ``BatcherFull`` if ``max_pending`` items are already waiting.
+        """
+        self._start()
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            raise BatcherFull(f"{self.name}: {self._queue.maxsize} items already waiting") from None
+        return future
+
+    def run_many(self, items: Sequence[Any], timeout: float) -> List[Any]:
+        """Submit ``items`` and wait for all their results
+
+        Raises ``TimeoutError`` after ``timeout`` seconds, cancelling the
+        items that have not started yet, and ``BatcherFull`` if the queue has
+        no room for all of them, cancelling the ones already queued.
+        """
+        futures = []
+        try:
+            for item in items:
+                futures.append(self.submit(item))
+        except BatcherFull:
+            for future in futures:
+                future.cancel()
+            raise
+        deadline = time.monotonic() + timeout
+        try:
+            return [future.result(max(0.0, deadline - time.monotonic())) for future in futures]
+        except FutureTimeoutError:
+            for future in futures:
+                future.cancel()
+            raise TimeoutError(f"{self.name}: no result within {timeout:g}s")
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> List[Tuple[Any, Future, float]]:
+        """Block for the first item, then gather more until the batch is full or its wait is over"""
+        batch = [self._queue.get()]
+        # The wait counts from the first item's submission, not from when this thread woke up
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            # Items whose callers already gave up are dropped here
+            live = [(item, future) for item, future, submitted in batch if future.set_running_or_notify_cancel()]
+            for _, _, submitted in batch:
+                metrics.INFERENCE_QUEUE_WAIT.observe(started - submitted)
+            if not live:
+                continue
+
+            metrics.INFERENCE_BATCH_SIZE.observe(len(live))
+            try:
+                results = self.process([item for item, _ in live])
+            except Exception as e:
+                logger.error(f"{self.name}: batch of {len(live)} failed: {e}")
+                for _, future in live:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(live, results):
+                future.set_result(result)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Latency and throughput benchmark for the Healthcare QA System API
+
+Replays a weighted mix of knowledge-base, uploaded-document and fallback
+questions against the API, for a synthetic corpus at each requested size, and
+reports p50/p95/p99 latency, throughput and peak memory. Runs in-process
+against the Flask test client by default, or as an HTTP load generator
+against a live server with --url.
+
+    python benchmark.py --corpus-sizes 10,1000,100000
+    python benchmark.py --save-baseline
+    python benchmark.py --url http://localhost:5000 --concurrency 16
+
+A run is compared against the stored baseline when one exists, and exits
+with status 1 if any latency percentile regressed beyond the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config import Config
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+KNOWLEDGE_BASE_QUESTIONS = [
+    "What are the side effects of aspirin?",
+    "What are the symptoms of diabetes?",
+    "How is diabetes treated?",
+    "What are the risk factors for hypertension?",
+    "How is high blood pressure treated?",
+    "What are the symptoms of pneumonia?",
+    "How is pneumonia diagnosed?",
+    "What are the types of insulin?",
+    "How is insulin administered?",
+    "What is a heart attack?",
+]
+
+FALLBACK_QUESTIONS = [
+    "What is the recommended dose of quorzavine?",
+    "How does plemtrax interact with zolvenide?",
+    "Who should avoid trenbaxol therapy?",
+    "What causes vorpalitis in adults?",
+]
+
+_CONDITIONS = ["arrhythmia", "nephropathy", "neuropathy", "hepatitis", "asthma", "anemia",
+               "migraine", "psoriasis", "sepsis", "gout", "thyroiditis", "bronchitis"]
+_TREATMENTS = ["beta blockers", "corticosteroids", "antibiotics", "anticoagulants", "bronchodilators",
+               "antivirals", "statins", "diuretics", "immunotherapy", "physiotherapy"]
+_FINDINGS = ["fatigue", "fever", "swelling", "shortness of breath", "chest pain", "dizziness",
+             "joint pain", "weight loss", "headache", "rash"]
+
+DEFAULT_MIX = "knowledge_base=0.5,uploaded=0.35,fallback=0.15"
+
+
+def synthetic_document(rng: random.Random, doc_id: int) -> str:
+    """Return a clinical note mentioning a unique study marker, so questions can target it"""
+    condition = rng.choice(_CONDITIONS)
+    treatment = rng.choice(_TREATMENTS)
+    findings = rng.sample(_FINDINGS, 3)
+    return (
+        f"Study protocol bx{doc_id} examined patients with {condition}. "
+        f"Common findings included {findings[0]}, {findings[1]} and {findings[2]}. "
+        f"Under protocol bx{doc_id}, first-line management used {treatment} with monitoring every {rng.randint(2, 12)} weeks. "
+        f"Adverse events were reported in {rng.randint(1, 30)} percent of participants. "
+        f"Follow-up showed improvement in {rng.randint(40, 95)} percent of cases treated with {treatment}."
+    )
+
+
+def uploaded_question(rng: random.Random, corpus_size: int) -> str:
+    doc_id = rng.randrange(corpus_size)
+    return rng.choice([
+        f"What management did protocol bx{doc_id} use?",
+        f"What findings were seen in study protocol bx{doc_id}?",
+        f"How often were bx{doc_id} patients monitored?",
+    ])
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        category, weight = item.split("=")
+        if category not in ("knowledge_base", "uploaded", "fallback"):
+            raise ValueError(f"Unknown question category: {category}")
+        weights[category] = float(weight)
+    return weights
+
+
+def build_workload(rng: random.Random, mix: Dict[str, float], corpus_size: int,
+                   num_requests: int) -> List[Tuple[str, str]]:
+    """Return (category, question) pairs drawn according to the mix weights"""
+    categories = list(mix)
+    drawn = rng.choices(categories, weights=[mix[category] for category in categories], k=num_requests)
+    workload = []
+    for category in drawn:
+        if category == "knowledge_base":
+            workload.append((category, rng.choice(KNOWLEDGE_BASE_QUESTIONS)))
+        elif category == "uploaded":
+            workload.append((category, uploaded_question(rng, corpus_size)))
+        else:
+            workload.append((category, rng.choice(FALLBACK_QUESTIONS)))
+    return workload
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class InProcessTarget:
+    """Drives a fresh QA engine through the Flask test client"""
+
+    def __init__(self, use_cache: bool, dense: bool):
+        # The benchmark client would exhaust a single client's rate limit
+        Config.RATE_LIMIT_ENABLED = False
+        import enhanced_full_api
+        from caching import AnswerCache, LRUCache
+
+        self.api = enhanced_full_api
+        self.use_cache = use_cache
+        self.dense = dense
+        self._AnswerCache = AnswerCache
+        self._LRUCache = LRUCache
+        self._local = threading.local()
+
+    def load_corpus(self, documents: List[str]):
+        # Benchmarks must not touch the persistent document store or shared segments
+        Config.DOCUMENT_STORE_ENABLED = False
+        Config.SEGMENTS_ENABLED = False
+        Config.DENSE_RETRIEVAL_ENABLED = self.dense
+        embedder = None
+        if self.dense:
+            from dense_retrieval import HashingEmbedder
+
+            Config.FAISS_INDEX_PATH = None
+            embedder = HashingEmbedder()
+        cache = self._AnswerCache(self._LRUCache(Config.ANSWER_CACHE_SIZE if self.use_cache else 0))
+        engine = self.api.EnhancedMedicalQA(embedder=embedder, answer_cache=cache)
+        engine.ingest_documents([[document] for document in documents])
+        self.api.qa_engine = engine
+
+    def ask(self, question: str) -> int:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.api.app.test_client()
+        return client.post("/api/v1/ask", json={"question": question}).status_code
+
+
+class HttpTarget:
+    """Drives a live API server over HTTP"""
+
+    def __init__(self, url: str):
+        import requests
+
+        self.requests = requests
+        self.url = url.rstrip("/")
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self.requests.Session()
+        return session
+
+    def load_corpus(self, documents: List[str], batch_size: int = 1000):
+        for start in range(0, len(documents), batch_size):
+            response = self._session().post(f"{self.url}/api/v1/docs/upload?wait=true",
+                                            json={"documents": documents[start:start + batch_size]}, timeout=600)
+            response.raise_for_status()
+
+    def ask(self, question: str) -> int:
+        return self._session().post(f"{self.url}/api/v1/ask", json={"question": question}, timeout=60).status_code
+
+
+def run_workload(target, workload: List[Tuple[str, str]], concurrency: int) -> Tuple[Dict[str, List[float]], float, int]:
+    """Send the workload and return per-category latencies, wall time and error count"""
+    latencies: Dict[str, List[float]] = {}
+    errors = 0
+    lock = threading.Lock()
+
+    def send(item: Tuple[str, str]):
+        nonlocal errors
+        category, question = item
+        start_time = time.perf_counter()
+        status = target.ask(question)
+        elapsed = time.perf_counter() - start_time
+        with lock:
+            latencies.setdefault(category, []).append(elapsed)
+            if status != 200:
+                errors += 1
+
+    start_time = time.perf_counter()
+    if concurrency <= 1:
+        for item in workload:
+            send(item)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, workload))
+    return latencies, time.perf_counter() - start_time, errors
+
+
+def benchmark_corpus(target, corpus_size: int, args, mix: Dict[str, float]) -> Dict:
+    rng = random.Random(args.seed + corpus_size)
+    documents = [synthetic_document(rng, doc_id) for doc_id in range(corpus_size)]
+
+    start_time = time.perf_counter()
+    target.load_corpus(documents)
+    ingest_time = time.perf_counter() - start_time
+    del documents
+
+    # Warm up code paths and lazy imports before measuring
+    warmup = build_workload(rng, mix, corpus_size, args.warmup)
+    run_workload(target, warmup, 1)
+
+    workload = build_workload(rng, mix, corpus_size, args.requests)
+    latencies, wall_time, errors = run_workload(target, workload, args.concurrency)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        "corpus_size": corpus_size,
+        "ingest_seconds": round(ingest_time, 3),
+        "requests": len(workload),
+        "errors": errors,
+        "throughput_rps": round(len(workload) / wall_time, 1) if wall_time else 0.0,
+        "latency": summarize(all_latencies),
+        "categories": {category: summarize(values) for category, values in sorted(latencies.items())},
+    }
+    if isinstance(target, InProcessTarget):
+        result["max_rss_mb"] = max_rss_mb()
+    return result
+
+
+def compare_to_baseline(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    """Return a description of every latency percentile that regressed beyond the tolerance"""
+    regressions = []
+    baseline_runs = {run["corpus_size"]: run for run in baseline.get("results", [])}
+    for run in results:
+        previous = baseline_runs.get(run["corpus_size"])
+        if previous is None:
+            continue
+        groups = [("all", run["latency"], previous["latency"])]
+        groups += [(category, stats, previous["categories"][category])
+                   for category, stats in run["categories"].items() if category in previous.get("categories", {})]
+        for name, current, before in groups:
+            for metric in ("p50_ms", "p95_ms", "p99_ms"):
+                if before[metric] > 0 and current[metric] > before[metric] * (1.0 + tolerance):
+                    regressions.append(f"corpus={run['corpus_size']} {name} {metric}: "
+                                       f"{before[metric]:.3f} -> {current[metric]:.3f}")
+    return regressions
+
+
+def print_report(results: List[Dict]):
+    print(f"{'corpus':>8} {'category':>15} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rps':>8} {'rss MB':>8}")
+    for run in results:
+        rows = [("all", run["latency"])] + list(run["categories"].items())
+        for name, stats in rows:
+            extra = ""
+            if name == "all":
+                extra = f" {run['throughput_rps']:>8.1f} {run.get('max_rss_mb', 0):>8.1f}"
+            print(f"{run['corpus_size']:>8} {name:>15} {stats['count']:>6} {stats['p50_ms']:>9.3f} "
+                  f"{stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f}{extra}")
+        print(f"{'':>8} ingest {run['ingest_seconds']:.2f}s, {run['errors']} errors")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Healthcare QA System API")
+    parser.add_argument("--url", help="benchmark a live server instead of the in-process test client")
+    parser.add_argument("--corpus-sizes", default="10,1000,10000",
+                        help="comma-separated synthetic corpus sizes (documents)")
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests per corpus size")
+    parser.add_argument("--warmup", type=int, default=100, help="unmeasured requests per corpus size")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent client threads")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="category weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--cache", action="store_true", help="keep the answer cache enabled (in-process only)")
+    parser.add_argument("--dense", action="store_true",
+                        help="enable dense retrieval with the offline hashing embedder (in-process only)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fractional latency increase over the baseline")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    corpus_sizes = [int(size) for size in args.corpus_sizes.split(",")]
+    if args.url:
+        target = HttpTarget(args.url)
+        # A live server keeps its corpus, so uploads accumulate across sizes
+        corpus_sizes.sort()
+    else:
+        # Per-document ingestion logs would dominate the run
+        logging.disable(logging.INFO)
+        target = InProcessTarget(use_cache=args.cache, dense=args.dense)
+
+    results = [benchmark_corpus(target, size, args, mix) for size in corpus_sizes]
+    report = {
+        "mode": "http" if args.url else "in-process",
+        "mix": mix,
+        "concurrency": args.concurrency,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results,
+    }
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Latency regressions against baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No latency regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,383 @@
+"""
+Answer caching for the Healthcare BERT QA System
+
+Answers are cached under the normalized question in an in-process LRU tier
+with a TTL, optionally backed by a shared Redis-protocol tier. Answers that
+depend on uploaded documents are tagged with the corpus generation they were
+computed against, and are treated as misses once an upload bumps it.
+
+A semantic tier keys upload-dependent answers on a question's canonical
+terms instead, so paraphrases such as "adverse effects of aspirin" and
+"what are aspirin side effects?" reuse one retrieval. Entities, section cues,
+negations and quantities must match exactly; only the remaining words may
+differ.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Optional, Set, Tuple
+
+from config import Config
+from dedup import MinHash
+from entities import EntityMatcher
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Question words that do not change what is asked, beyond the retrieval stopwords
+_FILLER_TERMS = frozenset("""
+common commonly main typical usual usually possible known tell explain describe list know please
+""".split())
+
+# Negations, which the retrieval stopwords drop but which change the answer
+_NEGATION_RE = re.compile(r"\b(?:not|no|nor|never|without|none|neither|cannot)\b|n['\u2019]t\b")
+_NEGATION_CANONICAL = {"cannot": "not", "n't": "not", "n\u2019t": "not"}
+
+# Numbers with their optional unit, e.g. "50 kg", "2.5mg", "10 %"; "50 kg" and "100 kg" ask different things
+_QUANTITY_RE = re.compile(
+    r"(?<![\w.])(\d+(?:[.,]\d+)?)\s*(%|(?:mg|mcg|\u00b5g|ug|g|kg|lbs?|ml|l|iu|units?|mmhg|mmol|mg/dl|"
+    r"mg/kg|years?|months?|weeks?|days?|hours?|hrs?|minutes?|mins?)\b)?")
+_UNIT_CANONICAL = {"lbs": "lb", "units": "unit", "years": "year", "months": "month", "weeks": "week",
+                   "days": "day", "hours": "hour", "hrs": "hour", "hr": "hour", "minutes": "minute",
+                   "mins": "minute", "min": "minute", "\u00b5g": "mcg", "ug": "mcg"}
+
+
+def normalize_question(question: str, context: Optional[str] = None) -> str:
+    """Return the cache key text for a question and optional context"""
+    key = _WHITESPACE_RE.sub(" ", question.lower()).strip().rstrip("?!. ")
+    if context:
+        key += "\x00" + context
+    return key
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache whose entries expire after a TTL"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Shared cache tier over any client speaking the Redis protocol
+
+    Only ``get``, ``mget``, ``set(..., ex=...)``, ``incr`` and ``delete`` are
+    used, so a local stand-in with the same methods can replace the server.
+    """
+
+    def __init__(self, client, ttl: float = 3600, prefix: str = "hqa:"):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self.generation_key = prefix + "corpus_generation"
+
+    @classmethod
+    def from_url(cls, url: str = Config.REDIS_URL, ttl: float = Config.CACHE_TIMEOUT) -> "RedisCache":
+        import redis
+
+        client = redis.Redis.from_url(url)
+        client.ping()
+        return cls(client, ttl)
+
+    def get_with_generation(self, key: str) -> Tuple[Optional[Any], int]:
+        """Fetch an entry and the current corpus generation in one round trip"""
+        raw_entry, raw_generation = self.client.mget([self.prefix + key, self.generation_key])
+        entry = json.loads(raw_entry) if raw_entry is not None else None
+        return entry, int(raw_generation or 0)
+
+    def get_generation(self) -> int:
+        return int(self.client.get(self.generation_key) or 0)
+
+    def set(self, key: str, value: Any):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def bump_generation(self) -> int:
+        return int(self.client.incr(self.generation_key))
+
+
+class AnswerCache:
+    """Two-tier answer cache with upload-aware invalidation
+
+    Entries are stored as ``{"result": ..., "generation": ...}``; a generation
+    of ``None`` marks answers that never depend on uploaded documents.
+    Counters are per process.
+    """
+
+    def __init__(self, local: Optional[LRUCache] = None, remote: Optional[RedisCache] = None):
+        self.local = local if local is not None else LRUCache()
+        self.remote = remote
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.remote_hits = 0
+
+    @staticmethod
+    def _key(question: str, context: Optional[str]) -> str:
+        return hashlib.sha1(normalize_question(question, context).encode('utf-8')).hexdigest()
+
+    @property
+    def generation(self) -> int:
+        """Current corpus generation, shared through the remote tier if there is one"""
+        if self.remote is not None:
+            return self.remote.get_generation()
+        return self._generation
+
+    def get(self, question: str, context: Optional[str] = None) -> Optional[Dict]:
+        """Return a copy of the cached answer, or None on a miss"""
+        key = self._key(question, context)
+        entry = self.local.get(key)
+        if entry is not None and entry["generation"] is None:
+            return self._hit(entry)
+
+        if self.remote is None:
+            if entry is not None and entry["generation"] == self._generation:
+                return self._hit(entry)
+            return self._miss()
+
+        remote_entry, generation = self.remote.get_with_generation(key)
+        if entry is not None and entry["generation"] == generation:
+            return self._hit(entry)
+        if remote_entry is not None and remote_entry["generation"] in (None, generation):
+            self.local.set(key, remote_entry)
+            with self._lock:
+                self.remote_hits += 1
+            return self._hit(remote_entry)
+        return self._miss()
+
+    def set(self, question: str, context: Optional[str], result: Dict, generation: Optional[int] = None):
+        """Cache an answer
+
+        Answers that depend on uploaded documents must pass the corpus
+        generation read before they were computed, so an upload racing with
+        the computation still invalidates them.
+        """
+        entry = {"result": dict(result), "generation": generation}
+        key = self._key(question, context)
+        self.local.set(key, entry)
+        if self.remote is not None:
+            self.remote.set(key, entry)
+
+    def invalidate_corpus(self):
+        """Start a new corpus generation, invalidating every upload-dependent answer"""
+        with self._lock:
+            self._generation += 1
+        if self.remote is not None:
+            self.remote.bump_generation()
+
+    def _hit(self, entry: Dict) -> Dict:
+        with self._lock:
+            self.hits += 1
+        return dict(entry["result"])
+
+    def _miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "memory+redis" if self.remote is not None else "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "remote_hits": self.remote_hits,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self.local),
+        }
+
+
+class SemanticCache:
+    """Upload-dependent answers reused across paraphrased questions
+
+    A question is reduced to its distinct canonical terms: entity synonyms
+    and section cues folded to one name, stopwords and filler dropped. The
+    entities, section cues, negations and quantities (numbers with their
+    units) form an exact key; only the other terms are compared by
+    similarity, so "is aspirin not safe" never reuses the answer to "is
+    aspirin safe", nor "50 kg" the answer to "100 kg". Candidates with the
+    same exact key come from the MinHash band buckets of the other terms and
+    are verified by the exact Jaccard similarity of those terms, since
+    questions have too few terms for the signature estimate to be reliable.
+    Entries are evicted least recently used, expire after the TTL, and only
+    match lookups made against the corpus generation they were computed
+    for.
+    """
+
+    def __init__(self, matcher: EntityMatcher, max_entries: int = 1024, ttl: float = 3600,
+                 threshold: float = 0.8):
+        self.matcher = matcher
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._minhash = MinHash(threshold=threshold, shingle_size=1)
+        # Entry ID -> (expiry, (exact terms, other terms), bucket keys, generation, result)
+        self._entries: "OrderedDict[int, Tuple[float, Tuple[FrozenSet[str], FrozenSet[str]], Tuple, int, Dict]]" = \
+            OrderedDict()
+        self._buckets: Dict[Tuple, Set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def terms(self, question: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+        """Return a question's exact terms (entities, sections, negations, quantities) and its other terms"""
+        question_lower = question.lower()
+        exact, other = set(), set()
+        for number, unit in _QUANTITY_RE.findall(question_lower):
+            exact.add(number.replace(",", ".") + _UNIT_CANONICAL.get(unit, unit))
+        for term in self.matcher.canonical_terms(_QUANTITY_RE.sub(" ", question_lower)):
+            if term in self.matcher.canonical_names:
+                exact.add(term)
+            elif term not in _FILLER_TERMS:
+                other.add(term)
+        for negation in _NEGATION_RE.findall(question_lower):
+            exact.add(_NEGATION_CANONICAL.get(negation, negation))
+        return frozenset(exact), frozenset(other)
+
+    def _bucket_keys(self, terms: Tuple[FrozenSet[str], FrozenSet[str]]) -> Tuple:
+        exact, other = terms
+        if not other:
+            return ((exact, -1, 0),)
+        signature = self._minhash.signature(sorted(other))
+        return tuple((exact, band, band_hash) for band, band_hash in enumerate(self._minhash.band_hashes(signature)))
+
+    def _find(self, terms: Tuple[FrozenSet[str], FrozenSet[str]], bucket_keys: Tuple) -> Optional[int]:
+        """Return the ID of the most similar live entry, removing expired ones on the way; call with the lock held"""
+        now = time.monotonic()
+        other = terms[1]
+        best, best_similarity = None, self.threshold
+        for entry_id in {entry_id for key in bucket_keys for entry_id in self._buckets.get(key, ())}:
+            expiry, (entry_exact, entry_other) = self._entries[entry_id][:2]
+            if expiry < now:
+                self._remove(entry_id)
+                continue
+            if entry_exact != terms[0]:
+                continue
+            union = other | entry_other
+            similarity = len(other & entry_other) / len(union) if union else 1.0
+            if similarity >= best_similarity:
+                best, best_similarity = entry_id, similarity
+        return best
+
+    def _remove(self, entry_id: int):
+        bucket_keys = self._entries.pop(entry_id)[2]
+        for key in bucket_keys:
+            bucket = self._buckets[key]
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def get(self, question: str, generation: int) -> Optional[Dict]:
+        """Return a copy of the answer to a paraphrase of ``question``, or None on a miss"""
+        terms = self.terms(question)
+        if not any(terms):
+            return None
+        bucket_keys = self._bucket_keys(terms)
+        with self._lock:
+            entry_id = self._find(terms, bucket_keys)
+            if entry_id is not None and self._entries[entry_id][3] != generation:
+                self._remove(entry_id)
+                entry_id = None
+            if entry_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return dict(self._entries[entry_id][4])
+
+    def set(self, question: str, result: Dict, generation: int):
+        """Cache an answer computed against corpus ``generation``, replacing the entry of an equivalent question"""
+        terms = self.terms(question)
+        if not any(terms):
+            return
+        bucket_keys = self._bucket_keys(terms)
+        with self._lock:
+            previous = self._find(terms, bucket_keys)
+            if previous is not None and self._entries[previous][1] == terms:
+                self._remove(previous)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (time.monotonic() + self.ttl, terms, bucket_keys, generation, dict(result))
+            for key in bucket_keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "threshold": self.threshold,
+        }
+
+
+def create_answer_cache() -> AnswerCache:
+    """Create the answer cache described by the configuration"""
+    local = LRUCache(Config.ANSWER_CACHE_SIZE, Config.CACHE_TIMEOUT)
+    remote = None
+    if Config.CACHE_BACKEND == "redis":
+        try:
+            remote = RedisCache.from_url(Config.REDIS_URL, Config.CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Redis cache unavailable, using in-process cache only: {e}")
+    return AnswerCache(local, remote)
+
+
+def create_semantic_cache(matcher: Optional[EntityMatcher] = None) -> Optional[SemanticCache]:
+    """Create the paraphrase answer cache, or None if it is disabled"""
+    if not Config.SEMANTIC_CACHE_ENABLED:
+        return None
+    return SemanticCache(matcher if matcher is not None else EntityMatcher(), Config.SEMANTIC_CACHE_SIZE,
+                         Config.CACHE_TIMEOUT, Config.SEMANTIC_CACHE_THRESHOLD)
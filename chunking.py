@@ -0,0 +1,399 @@
+"""
+Document chunking for the Healthcare BERT QA System
+
+Documents are split once at ingestion time into sentences and overlapping
+chunks. Sentence boundaries are kept as offsets in compact arrays, so retrieval
+and passage assembly work on chunk IDs and text slices instead of re-splitting
+documents on every query.
+
+Chunk tables hold the UTF-8 text of all their documents in one arena, next to
+a folded copy in the tokenizer's alphabet and a normalized hash of every
+sentence, so query terms are matched and repeated sentences recognized
+without lowercasing or decoding any text.
+"""
+
+import re
+import zlib
+from array import array
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Pattern, Tuple
+
+import numpy as np
+
+from config import Config
+
+# Sentence ends at ., ! or ? followed by whitespace, or at a blank line
+_SENTENCE_BOUNDARY_RE = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+# Maps UTF-8 bytes to the alphabet of retrieval.tokenize: ASCII letters lowercased, digits kept and
+# every other byte, including each byte of a multi-byte character, a space
+_FOLD_TABLE = bytes(
+    byte + 32 if 0x41 <= byte <= 0x5A else byte if 0x61 <= byte <= 0x7A or 0x30 <= byte <= 0x39 else 0x20
+    for byte in range(256)
+)
+
+
+def fold_text(data: bytes) -> bytes:
+    """Fold UTF-8 text so tokens are runs of ``[a-z0-9]`` at the same byte offsets"""
+    return bytes(data).translate(_FOLD_TABLE)
+
+
+def sentence_key(folded: bytes, start: int, end: int) -> int:
+    """Hash of a folded sentence's tokens, equal for sentences differing only in case, punctuation or spacing"""
+    return zlib.crc32(b" ".join(folded[start:end].split()))
+
+
+def term_pattern(terms: Iterable[str]) -> Optional[Pattern[bytes]]:
+    """Compile tokenized query terms into a whole-token matcher over folded text"""
+    unique = sorted(set(terms))
+    if not unique:
+        return None
+    return re.compile(rb"\b(?:" + b"|".join(re.escape(term.encode('ascii')) for term in unique) + rb")\b")
+
+
+def sentence_offsets(text: str, max_length: int) -> array:
+    """Return the start offset of every sentence in text, plus len(text)
+
+    Sentences longer than ``max_length`` are cut at the last whitespace before
+    the limit (or hard-cut if there is none), so no chunk grows unbounded on
+    text without punctuation.
+    """
+    offsets = array('I')
+    start = 0
+    for match in _SENTENCE_BOUNDARY_RE.finditer(text):
+        _append_sentence(offsets, text, start, match.end(), max_length)
+        start = match.end()
+    if start < len(text):
+        _append_sentence(offsets, text, start, len(text), max_length)
+    offsets.append(len(text))
+    return offsets
+
+
+def _append_sentence(offsets: array, text: str, start: int, end: int, max_length: int):
+    """Append the start offsets of the sentence text[start:end]"""
+    while end - start > max_length:
+        cut = text.rfind(' ', start + 1, start + max_length)
+        if cut <= start:
+            cut = start + max_length
+        offsets.append(start)
+        start = cut
+    offsets.append(start)
+
+
+def chunk_sentences(offsets: array, chunk_size: int, overlap: int) -> List[Tuple[int, int]]:
+    """Group sentences into overlapping chunks of at most ``chunk_size`` characters
+
+    Returns (first sentence, end sentence) index pairs. Each chunk after the
+    first repeats the trailing sentences of its predecessor that fit within
+    ``overlap`` characters.
+    """
+    num_sentences = len(offsets) - 1
+    chunks = []
+    first = 0
+    while first < num_sentences:
+        end = first + 1
+        while end < num_sentences and offsets[end + 1] - offsets[first] <= chunk_size:
+            end += 1
+        chunks.append((first, end))
+        if end >= num_sentences:
+            break
+
+        next_first = end
+        while next_first - 1 > first and offsets[end] - offsets[next_first - 1] <= overlap:
+            next_first -= 1
+        first = next_first
+    return chunks
+
+
+def iter_document_parts(pieces: Iterable[str], part_size: int = Config.INGEST_PART_SIZE) -> Iterator[str]:
+    """Regroup streamed text pieces into parts of roughly ``part_size`` characters
+
+    Parts end at a sentence boundary followed by more text, so chunking a part
+    never needs anything beyond it, and only about two parts of text plus one
+    piece are buffered regardless of the size of the whole stream. Text
+    without any boundary is cut at a space once twice the part size is
+    buffered.
+    """
+    buffered: List[str] = []
+    buffered_length = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        buffered.append(piece)
+        buffered_length += len(piece)
+        if buffered_length < part_size:
+            continue
+
+        text = "".join(buffered)
+        # A boundary running into trailing whitespace may still grow
+        content_end = len(text)
+        while content_end and text[content_end - 1].isspace():
+            content_end -= 1
+
+        start = 0
+        while len(text) - start >= part_size:
+            cut = _part_boundary(text, start, content_end, part_size)
+            if cut is None:
+                break
+            yield text[start:cut]
+            start = cut
+        text = text[start:]
+        buffered = [text]
+        buffered_length = len(text)
+
+    if buffered_length:
+        yield "".join(buffered)
+
+
+def _part_boundary(text: str, start: int, content_end: int, part_size: int) -> Optional[int]:
+    """Return where the part starting at ``start`` should end, or None to wait for more text"""
+    limit = start + part_size
+    best = None
+    for match in _SENTENCE_BOUNDARY_RE.finditer(text, start + part_size // 2):
+        if match.end() >= content_end:
+            break
+        if best is not None and match.end() > limit:
+            break
+        best = match.end()
+    if best is not None:
+        return best
+    if len(text) - start >= 2 * part_size:
+        space = text.rfind(' ', start + 1, limit)
+        return space + 1 if space > start else limit
+    return None
+
+
+class PreparedDocument(NamedTuple):
+    """A document split into sentences and chunks, ready to append to a ChunkTable
+
+    ``document_id`` names the ingested document the text belongs to; a large
+    upload is prepared as several parts with the same ID.
+    """
+    text: str
+    offsets: array
+    chunks: List[Tuple[int, int]]
+    document_id: int = 0
+
+    def chunk_texts(self) -> List[str]:
+        offsets = self.offsets
+        return [self.text[offsets[first]:offsets[end]].strip() for first, end in self.chunks]
+
+    def encode(self) -> Tuple[bytes, array]:
+        """Return the UTF-8 text and the sentence offsets converted to byte offsets"""
+        if self.text.isascii():
+            return self.text.encode('ascii'), self.offsets
+        encoded = bytearray()
+        byte_offsets = array('I')
+        offsets = self.offsets
+        for i in range(len(offsets) - 1):
+            byte_offsets.append(len(encoded))
+            encoded += self.text[offsets[i]:offsets[i + 1]].encode('utf-8')
+        byte_offsets.append(len(encoded))
+        return bytes(encoded), byte_offsets
+
+
+def prepare_document(text: str, chunk_size: int = Config.CHUNK_SIZE,
+                     overlap: int = Config.CHUNK_OVERLAP) -> PreparedDocument:
+    """Split a document into sentences and chunks"""
+    offsets = sentence_offsets(text, chunk_size)
+    return PreparedDocument(text, offsets, chunk_sentences(offsets, chunk_size, overlap))
+
+
+class ChunkTable:
+    """Documents with their precomputed sentence offsets and chunk boundaries
+
+    The UTF-8 text of every document is appended to one arena, each document
+    followed by a newline so tokens never run across documents. Sentence
+    offsets of all documents are byte offsets into the arena, kept in one
+    array; documents and chunks refer into it by index, so a chunk or sentence
+    is always a slice of the original document text. The text of documents
+    can be dropped again without changing any chunk or sentence ID: their
+    offsets are collapsed at once, and the arena is rebuilt without their
+    bytes once those pass ``compact_fraction`` of it.
+    """
+
+    def __init__(self, chunk_size: int = Config.CHUNK_SIZE, chunk_overlap: int = Config.CHUNK_OVERLAP,
+                 compact_fraction: float = Config.CORPUS_COMPACT_FRACTION):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.compact_fraction = compact_fraction
+        # Arena bytes of dropped documents, released by the next compaction
+        self.dropped_bytes = 0
+        # The text arena, the arena folded by fold_text (for matching query terms) and the per-document
+        # sentence start offsets into both, each document's followed by its end offset; replaced as a
+        # whole when text is dropped
+        self._arena: Tuple[bytearray, bytearray, array] = (bytearray(), bytearray(), array('Q'))
+        # Document -> index of its first sentence in the sentence offsets, its first chunk and its
+        # owner's document ID
+        self.document_sentence_base = array('I')
+        self.document_first_chunk = array('I')
+        self.document_owner = array('q')
+        # Sentence -> sentence_key, aligned with the sentence offsets
+        self.sentence_keys = array('I')
+        # Chunk -> document, first sentence and end sentence (global indices)
+        self.chunk_document = array('I')
+        self.chunk_first_sentence = array('I')
+        self.chunk_end_sentence = array('I')
+
+    def __len__(self) -> int:
+        return len(self.chunk_document)
+
+    @property
+    def text(self) -> bytearray:
+        return self._arena[0]
+
+    @property
+    def sentence_offsets(self) -> array:
+        return self._arena[2]
+
+    def prepare_document(self, text: str) -> "PreparedDocument":
+        """Compute a document's sentence offsets and chunks without modifying the table"""
+        return prepare_document(text, self.chunk_size, self.chunk_overlap)
+
+    def add_prepared(self, prepared: "PreparedDocument") -> range:
+        """Append a prepared document and return its new chunk IDs"""
+        text, folded_arena, sentence_offsets = self._arena
+        document_id = len(self.document_sentence_base)
+        base = len(sentence_offsets)
+        encoded, offsets = prepared.encode()
+        folded = fold_text(encoded)
+        start = len(text)
+
+        text += encoded
+        text += b"\n"
+        folded_arena += folded
+        folded_arena += b" "
+        sentence_offsets.extend(start + offset for offset in offsets)
+        self.sentence_keys.extend(sentence_key(folded, offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1))
+        self.sentence_keys.append(0)
+        first_chunk = len(self.chunk_document)
+        self.document_sentence_base.append(base)
+        self.document_first_chunk.append(first_chunk)
+        self.document_owner.append(prepared.document_id)
+
+        for first, end in prepared.chunks:
+            self.chunk_first_sentence.append(base + first)
+            self.chunk_end_sentence.append(base + end)
+            # Appended last: it is the length readers see
+            self.chunk_document.append(document_id)
+        return range(first_chunk, len(self.chunk_document))
+
+    def add_document(self, text: str) -> range:
+        """Split a document into chunks and return the new chunk IDs"""
+        return self.add_prepared(self.prepare_document(text))
+
+    def owned_chunks(self, owners: Iterable[int]) -> Tuple[List[int], np.ndarray]:
+        """Return the documents owned by the given document IDs and their chunk IDs"""
+        owned = np.isin(np.frombuffer(self.document_owner, dtype=np.int64), np.fromiter(owners, dtype=np.int64))
+        documents = np.flatnonzero(owned)
+        # A document's chunks run up to the next document's first chunk
+        first_chunks = np.append(np.frombuffer(self.document_first_chunk, dtype=np.uint32), len(self.chunk_document))
+        chunk_ids = [np.arange(first_chunks[document], first_chunks[document + 1]) for document in documents]
+        return documents.tolist(), np.concatenate(chunk_ids) if chunk_ids else np.zeros(0, dtype=np.int64)
+
+    def drop_documents(self, documents: Iterable[int]) -> int:
+        """Release the text of documents, keeping their chunk and sentence IDs
+
+        Chunks of dropped documents read back as empty text at once: each
+        document's sentence offsets collapse onto its start, in a copy of the
+        offsets that replaces the arena's in one step. Their bytes stay in the
+        arena until they pass ``compact_fraction`` of it; then the arena is
+        rebuilt without them and swapped in the same way, so concurrent
+        readers see either the old or the new arena, never a document half
+        dropped. Returns the bytes released.
+        """
+        text, folded, offsets = self._arena
+        bases = self.document_sentence_base
+        new_offsets = None
+        for document in set(documents):
+            first = bases[document]
+            last = bases[document + 1] if document + 1 < len(bases) else len(offsets)
+            start, end = offsets[first], offsets[last - 1]
+            if start == end:
+                continue
+            if new_offsets is None:
+                new_offsets = array('Q', offsets)
+            new_offsets[first:last] = array('Q', [start]) * (last - first)
+            # The text and its trailing separator, in both arenas
+            self.dropped_bytes += 2 * (end + 1 - start)
+        if new_offsets is not None:
+            self._arena = (text, folded, new_offsets)
+        if self.dropped_bytes <= self.compact_fraction * 2 * len(text):
+            return 0
+        return self.compact()
+
+    def compact(self) -> int:
+        """Rebuild the arena without the text of dropped documents and return the bytes released"""
+        text, folded, offsets = self._arena
+        new_text = bytearray()
+        new_folded = bytearray()
+        new_offsets = np.frombuffer(offsets, dtype=np.uint64).astype(np.int64)
+        bases = self.document_sentence_base
+        for document in range(len(bases)):
+            first = bases[document]
+            last = bases[document + 1] if document + 1 < len(bases) else len(offsets)
+            start, end = offsets[first], offsets[last - 1]
+            new_start = len(new_text)
+            if start == end:
+                new_offsets[first:last] = new_start
+                continue
+            # The text and its trailing separator
+            new_text += text[start:end + 1]
+            new_folded += folded[start:end + 1]
+            new_offsets[first:last] += new_start - start
+
+        rebuilt = array('Q')
+        rebuilt.frombytes(new_offsets.astype(np.uint64).tobytes())
+        self._arena = (new_text, new_folded, rebuilt)
+        self.dropped_bytes = 0
+        return 2 * (len(text) - len(new_text))
+
+    def memory_bytes(self) -> int:
+        """Bytes held by the arenas and the offset and chunk arrays"""
+        text, folded, offsets = self._arena
+        arrays = (offsets, self.document_sentence_base, self.document_first_chunk, self.document_owner,
+                  self.sentence_keys,
+                  self.chunk_document, self.chunk_first_sentence, self.chunk_end_sentence)
+        return len(text) + len(folded) + sum(len(values) * values.itemsize for values in arrays)
+
+    def document_text(self, document: int) -> str:
+        """Return the full text of a table document, or an empty string once dropped"""
+        text, _, offsets = self._arena
+        first = self.document_sentence_base[document]
+        last = self.document_sentence_base[document + 1] - 1 if document + 1 < len(self.document_sentence_base) \
+            else len(offsets) - 1
+        return text[offsets[first]:offsets[last]].decode('utf-8')
+
+    def chunk_text(self, chunk_id: int) -> str:
+        """Return the text of a chunk as a slice of its document"""
+        text, _, offsets = self._arena
+        start, end = offsets[self.chunk_first_sentence[chunk_id]], offsets[self.chunk_end_sentence[chunk_id]]
+        return text[start:end].decode('utf-8').strip()
+
+    def chunk_sentence_range(self, chunk_id: int) -> range:
+        """Sentence IDs of a chunk"""
+        return range(self.chunk_first_sentence[chunk_id], self.chunk_end_sentence[chunk_id])
+
+    def sentence_text(self, sentence_id: int) -> str:
+        """Return the raw text of a sentence, with the whitespace following it"""
+        text, _, offsets = self._arena
+        return text[offsets[sentence_id]:offsets[sentence_id + 1]].decode('utf-8')
+
+    def chunk_sentences(self, chunk_id: int) -> Iterator[Tuple[int, str]]:
+        """Yield (sentence ID, sentence text) for every sentence of a chunk"""
+        text, _, offsets = self._arena
+        for sentence_id in range(self.chunk_first_sentence[chunk_id], self.chunk_end_sentence[chunk_id]):
+            sentence = text[offsets[sentence_id]:offsets[sentence_id + 1]].decode('utf-8').strip()
+            if sentence:
+                yield sentence_id, sentence
+
+    def matching_sentences(self, chunk_id: int, pattern: Pattern[bytes]) -> Iterator[Tuple[int, str]]:
+        """Yield (sentence key, sentence text) for the sentences of a chunk matching a term_pattern
+
+        Only matching sentences are decoded.
+        """
+        text, folded, offsets = self._arena
+        for sentence_id in range(self.chunk_first_sentence[chunk_id], self.chunk_end_sentence[chunk_id]):
+            start, end = offsets[sentence_id], offsets[sentence_id + 1]
+            if pattern.search(folded, start, end) is not None:
+                yield self.sentence_keys[sentence_id], text[start:end].decode('utf-8').strip()
@@ -37,22 +37,92 @@ class Config:
     BIOBERT_DIR = MODELS_DIR / "biobert"
     CHECKPOINTS_DIR = MODELS_DIR / "checkpoints"
     
+    # Extractive reader: a local question-answering checkpoint run on CPU over the top retrieved chunks
+    READER_ENABLED = os.getenv("READER_ENABLED", "False").lower() == "true"
+    READER_MODEL_DIR = Path(os.getenv("READER_MODEL_DIR", MODELS_DIR / "biobert-qa"))
+    READER_TOP_CHUNKS = int(os.getenv("READER_TOP_CHUNKS", 3))
+    READER_BATCH_SIZE = int(os.getenv("READER_BATCH_SIZE", 8))
+    READER_THREADS = int(os.getenv("READER_THREADS", 0))  # 0 keeps torch's default
+    READER_QUANTIZE = os.getenv("READER_QUANTIZE", "True").lower() == "true"
+    READER_BUCKET_SIZE = int(os.getenv("READER_BUCKET_SIZE", 32))  # tokens
+    READER_DOC_STRIDE = int(os.getenv("READER_DOC_STRIDE", 128))  # tokens shared by overlapping windows
+    READER_MAX_BATCH_SIZE = int(os.getenv("READER_MAX_BATCH_SIZE", 32))  # questions per micro-batch; 1 disables it
+    READER_MAX_WAIT_MS = float(os.getenv("READER_MAX_WAIT_MS", 5))
+    READER_TIMEOUT = float(os.getenv("READER_TIMEOUT", 10.0))  # seconds per request
+    READER_MAX_PENDING = int(os.getenv("READER_MAX_PENDING", 1024))  # queued questions before rejecting; 0 is unbounded
+    
     # Vector search settings
     FAISS_INDEX_PATH = EMBEDDINGS_DIR / "document_index.faiss"
     CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 512))
     CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 50))
     TOP_K_RETRIEVAL = int(os.getenv("TOP_K_RETRIEVAL", 5))
+    INGEST_PART_SIZE = int(os.getenv("INGEST_PART_SIZE", 256 * 1024))  # characters
+    UPLOAD_READ_SIZE = int(os.getenv("UPLOAD_READ_SIZE", 64 * 1024))  # bytes
+    INGEST_COMMIT_SIZE = int(os.getenv("INGEST_COMMIT_SIZE", 4 * 1024 * 1024))  # characters per batch
+    INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 1))
+    INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 16))
+    INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", 1000))
+    INGEST_WORKER_NICE = int(os.getenv("INGEST_WORKER_NICE", 10))
+    UPLOAD_SPOOL_DIR = Path(os.getenv("UPLOAD_SPOOL_DIR", DATA_DIR / "spool"))
+    # Processes parsing PDF, DOCX and HTML uploads, per server worker process (0 parses in the ingesting
+    # thread); by default the CPUs are split between the WEB_CONCURRENCY workers
+    EXTRACTION_PROCESSES = int(os.getenv("EXTRACTION_PROCESSES",
+                                         max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", 1)))))
+    EXTRACTION_PAGES_PER_TASK = int(os.getenv("EXTRACTION_PAGES_PER_TASK", 8))
+    # Entity -> section index of uploaded documents; a JSON file of {type: [terms]} extends the gazetteer
+    ENTITY_INDEX_ENABLED = os.getenv("ENTITY_INDEX_ENABLED", "True").lower() == "true"
+    ENTITY_GAZETTEER_PATH = os.getenv("ENTITY_GAZETTEER_PATH", "")
+    DENSE_RETRIEVAL_ENABLED = os.getenv("DENSE_RETRIEVAL_ENABLED", "True").lower() == "true"
+    EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence-transformers")  # or "hashing"
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+    HNSW_M = int(os.getenv("HNSW_M", 32))
+    DENSE_MIN_SCORE = float(os.getenv("DENSE_MIN_SCORE", 0.35))
+    DENSE_INDEX_SAVE_INTERVAL = float(os.getenv("DENSE_INDEX_SAVE_INTERVAL", 60))  # seconds
+    DENSE_INDEX_COMPACT_FRACTION = float(os.getenv("DENSE_INDEX_COMPACT_FRACTION", 0.25))  # of stale vectors
+    SEGMENTS_ENABLED = os.getenv("SEGMENTS_ENABLED", "False").lower() == "true"
+    SEGMENTS_DIR = Path(os.getenv("SEGMENTS_DIR", DATA_DIR / "segments"))
+    SEGMENT_MERGE_FACTOR = int(os.getenv("SEGMENT_MERGE_FACTOR", 8))  # segments per merge; below 2 never merges
+    
+    # Near-duplicate chunks (MinHash/LSH) are dropped at upload; mostly duplicate documents are skipped whole
+    NEAR_DEDUP_ENABLED = os.getenv("NEAR_DEDUP_ENABLED", "True").lower() == "true"
+    SHINGLE_SIZE = int(os.getenv("SHINGLE_SIZE", 3))  # words
+    MINHASH_PERMUTATIONS = int(os.getenv("MINHASH_PERMUTATIONS", 32))
+    MINHASH_BANDS = int(os.getenv("MINHASH_BANDS", 8))
+    NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0.8))  # estimated Jaccard similarity
+    NEAR_DUPLICATE_DOCUMENT_RATIO = float(os.getenv("NEAR_DUPLICATE_DOCUMENT_RATIO", 0.9))  # of a document's chunks
+    
+    # Retention of uploaded documents in memory (0 disables a limit); evicted documents leave every index
+    DEFAULT_COLLECTION = os.getenv("DEFAULT_COLLECTION", "default")
+    CORPUS_MEMORY_BUDGET_MB = float(os.getenv("CORPUS_MEMORY_BUDGET_MB", 0))
+    CORPUS_EVICTION_TARGET = float(os.getenv("CORPUS_EVICTION_TARGET", 0.9))  # evict down to this share of a limit
+    CORPUS_MAX_DOCUMENT_AGE_HOURS = float(os.getenv("CORPUS_MAX_DOCUMENT_AGE_HOURS", 0))
+    CORPUS_COLLECTION_QUOTA_MB = float(os.getenv("CORPUS_COLLECTION_QUOTA_MB", 0))  # per collection
+    CORPUS_COLLECTION_QUOTAS = os.getenv("CORPUS_COLLECTION_QUOTAS", "")  # overrides, e.g. "guidelines=200,notes=20"
+    CORPUS_RETENTION_INTERVAL = float(os.getenv("CORPUS_RETENTION_INTERVAL", 300))  # seconds between age checks
+    CORPUS_ARCHIVE_PATH = os.getenv("CORPUS_ARCHIVE_PATH", "")  # JSON lines file receiving evicted documents
+    CORPUS_COMPACT_FRACTION = float(os.getenv("CORPUS_COMPACT_FRACTION", 0.25))  # of evicted text in the arena
     
     # QA settings
     MIN_CONFIDENCE_SCORE = float(os.getenv("MIN_CONFIDENCE_SCORE", 0.1))
     MAX_ANSWER_LENGTH = int(os.getenv("MAX_ANSWER_LENGTH", 100))
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 500))
+    STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 8))  # questions answered together per streamed slice
     
     # Database settings
     DATABASE_URL = os.getenv("DATABASE_URL", f"sqlite:///{BASE_DIR}/healthcare_qa.db")
+    DOCUMENT_STORE_ENABLED = os.getenv("DOCUMENT_STORE_ENABLED", "True").lower() == "true"
+    
+    # Startup: build the engine on a background thread, answering liveness probes at once
+    BACKGROUND_STARTUP = os.getenv("BACKGROUND_STARTUP", "True").lower() == "true"
     
     # Redis settings (for caching)
     REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
     CACHE_TIMEOUT = int(os.getenv("CACHE_TIMEOUT", 3600))  # 1 hour
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")  # or "redis"
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1024))
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "True").lower() == "true"
+    SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1024))
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.8))  # Jaccard similarity of question terms
     
     # Security settings
     SECRET_KEY = os.getenv("SECRET_KEY", "healthcare-qa-secret-key-change-in-production")
@@ -60,9 +130,33 @@ class Config:
     # Logging settings
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
     LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() == "true"
+    
+    # Profiling settings (PROFILING_MODE: "sampling" for collapsed stacks, "cprofile" for pstats)
+    PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "False").lower() == "true"
+    PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0.01))
+    PROFILING_MODE = os.getenv("PROFILING_MODE", "sampling")
+    PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", 0.001))  # seconds between stack samples
+    PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN", "")
     
-    # Rate limiting
+    # Rate limiting and load shedding (per client and per process; ask, batch and upload budgets are separate)
+    RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() == "true"
     RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", 60))
+    RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 60))
+    PROXY_TRUSTED_HOPS = int(os.getenv("PROXY_TRUSTED_HOPS", 0))  # reverse proxies appending to X-Forwarded-For
+    MAX_CONCURRENT_ASKS = int(os.getenv("MAX_CONCURRENT_ASKS", 32))
+    MAX_QUEUED_ASKS = int(os.getenv("MAX_QUEUED_ASKS", 64))
+    ASK_QUEUE_TIMEOUT = float(os.getenv("ASK_QUEUE_TIMEOUT", 2.0))  # seconds
+    BATCH_RATE_LIMIT_PER_MINUTE = int(os.getenv("BATCH_RATE_LIMIT_PER_MINUTE", 10))  # batch requests, whatever their size
+    BATCH_RATE_LIMIT_BURST = int(os.getenv("BATCH_RATE_LIMIT_BURST", 5))
+    MAX_CONCURRENT_BATCHES = int(os.getenv("MAX_CONCURRENT_BATCHES", 4))
+    MAX_QUEUED_BATCHES = int(os.getenv("MAX_QUEUED_BATCHES", 8))
+    BATCH_QUEUE_TIMEOUT = float(os.getenv("BATCH_QUEUE_TIMEOUT", 2.0))  # seconds
+    UPLOAD_RATE_LIMIT_PER_MINUTE = int(os.getenv("UPLOAD_RATE_LIMIT_PER_MINUTE", 10))
+    UPLOAD_RATE_LIMIT_BURST = int(os.getenv("UPLOAD_RATE_LIMIT_BURST", 5))
+    MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", 2))
+    MAX_QUEUED_UPLOADS = int(os.getenv("MAX_QUEUED_UPLOADS", 4))
+    UPLOAD_QUEUE_TIMEOUT = float(os.getenv("UPLOAD_QUEUE_TIMEOUT", 5.0))  # seconds
     
     # Healthcare-specific settings
     MEDICAL_DISCLAIMER = (
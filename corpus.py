@@ -0,0 +1,242 @@
+"""
+Corpus retention for the Healthcare BERT QA System
+
+Uploaded documents stay in memory until a retention policy evicts them:
+- a maximum document age,
+- a per-collection memory quota, evicting the collection's least recently
+  retrieved documents first,
+- a memory budget for the whole corpus, evicting the least recently
+  retrieved documents first.
+
+Quotas and the budget evict down to ``CORPUS_EVICTION_TARGET`` of their
+limit, so eviction runs in occasional rounds rather than on every upload.
+Memory is an estimate per document of its text (kept twice, as text and
+folded), sentence and chunk arrays, postings and MinHash signatures. Dense
+vectors are left out: the HNSW graph cannot delete, so evicting a document
+does not release them. The engine drops evicted documents from every
+in-memory index; they stay in the document store, and can also be appended
+to a JSON lines archive. With shared segments, the evicting worker records
+them as tombstones for the other workers and for segment merges.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+from documents import DocumentRecord, DocumentTable
+
+logger = logging.getLogger(__name__)
+
+_MB = 1024 * 1024
+# Postings entry (passage ID and term frequency) per distinct term, assuming every token is distinct
+_POSTING_BYTES = 8
+_SENTENCE_BYTES = 12  # offset and key
+_CHUNK_BYTES = 16  # chunk arrays and passage length
+
+
+def parse_quotas(spec: str) -> Dict[str, float]:
+    """Parse ``"name=MB,name=MB"`` into collection -> bytes"""
+    quotas = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, megabytes = item.partition("=")
+        try:
+            quotas[name.strip()] = float(megabytes) * _MB
+        except ValueError:
+            raise ValueError(f"Invalid collection quota: {item!r}")
+    return quotas
+
+
+def _column(values, dtype, count: int) -> np.ndarray:
+    """Copy the first ``count`` values of a column into a NumPy array
+
+    Slicing copies before NumPy sees the buffer, so the column is never
+    exported and other threads can keep appending to it.
+    """
+    return np.frombuffer(values[:count], dtype=dtype)
+
+
+def process_rss_bytes() -> Optional[int]:
+    """Resident set size of this process, where the platform reports it"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class CorpusManager:
+    """Tracks the memory of each document and picks documents to evict"""
+
+    def __init__(self, budget_mb: float = Config.CORPUS_MEMORY_BUDGET_MB,
+                 max_age_hours: float = Config.CORPUS_MAX_DOCUMENT_AGE_HOURS,
+                 collection_quota_mb: float = Config.CORPUS_COLLECTION_QUOTA_MB,
+                 collection_quotas: str = Config.CORPUS_COLLECTION_QUOTAS,
+                 target: float = Config.CORPUS_EVICTION_TARGET,
+                 archive_path: str = Config.CORPUS_ARCHIVE_PATH):
+        self.budget = budget_mb * _MB
+        self.max_age = max_age_hours * 3600
+        self.default_quota = collection_quota_mb * _MB
+        self.quotas = parse_quotas(collection_quotas)
+        self.target = target
+        self.archive_path = Path(archive_path) if archive_path else None
+        # Memory of parts committed before their document's record (large uploads commit part by part)
+        self._pending: Dict[int, int] = {}
+        self.evictions: Counter = Counter()
+        self._timer: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.budget or self.max_age or self.default_quota or self.quotas)
+
+    def part_bytes(self, characters: int, sentences: int, chunks: int, tokens: int, signature_size: int = 0) -> int:
+        """Estimated memory held for one chunked part of a document"""
+        per_chunk = _CHUNK_BYTES + signature_size * 4
+        return 2 * characters + sentences * _SENTENCE_BYTES + chunks * per_chunk + tokens * _POSTING_BYTES
+
+    def account(self, documents: DocumentTable, document_id: int, size: int):
+        """Add memory to a document, or hold it until the document's record is committed"""
+        position = documents.position(document_id)
+        if position is None:
+            self._pending[document_id] = self._pending.get(document_id, 0) + size
+        elif not documents.evicted[position]:
+            documents.memory[position] += size
+
+    def document_added(self, documents: DocumentTable, position: int):
+        pending = self._pending.pop(documents.document_id(position), 0)
+        if pending and not documents.evicted[position]:
+            documents.memory[position] += pending
+
+    def record_hits(self, documents: DocumentTable, document_ids: Iterable[int]):
+        """Count a retrieval of each document, for least-recently-used eviction"""
+        now = time.time()
+        for document_id in document_ids:
+            position = documents.position(document_id)
+            if position is not None:
+                documents.last_hit[position] = now
+                documents.hits[position] += 1
+
+    def quota(self, collection: str) -> float:
+        return self.quotas.get(collection, self.default_quota)
+
+    def select_evictions(self, documents: DocumentTable, now: Optional[float] = None) -> List[Tuple[int, str]]:
+        """Return (position, reason) for each document the retention policies evict"""
+        if not self.enabled or not len(documents):
+            return []
+        now = time.time() if now is None else now
+        count = len(documents)
+        memory = _column(documents.memory, np.uint64, count).astype(np.float64)
+        last_hit = _column(documents.last_hit, np.float64, count)
+        # Only documents in memory and holding something can be evicted
+        candidates = (_column(documents.evicted, np.uint8, count) == 0) & (memory > 0)
+        selected: List[Tuple[int, str]] = []
+
+        def evict(positions: np.ndarray, reason: str):
+            for position in positions.tolist():
+                selected.append((position, reason))
+            candidates[positions] = False
+
+        if self.max_age:
+            upload_times = _column(documents.upload_times, np.float64, count)
+            evict(np.flatnonzero(candidates & (upload_times < now - self.max_age)), "age")
+
+        if self.default_quota or self.quotas:
+            collection_ids = _column(documents.collection_ids, np.uint16, count)
+            for collection_id, collection in enumerate(documents.collections):
+                quota = self.quota(collection)
+                if quota:
+                    in_collection = candidates & (collection_ids == collection_id)
+                    evict(self._least_recent(in_collection, memory, last_hit, quota), "quota")
+
+        if self.budget:
+            evict(self._least_recent(candidates, memory, last_hit, self.budget), "budget")
+        return selected
+
+    def _least_recent(self, candidates: np.ndarray, memory: np.ndarray, last_hit: np.ndarray,
+                      limit: float) -> np.ndarray:
+        """Least recently retrieved candidates to evict to bring their memory under ``target * limit``"""
+        positions = np.flatnonzero(candidates)
+        used = memory[positions].sum()
+        if used <= limit:
+            return positions[:0]
+        positions = positions[np.argsort(last_hit[positions], kind="stable")]
+        freed = np.cumsum(memory[positions])
+        # Evict through the first document that brings usage under the target
+        return positions[:int(np.searchsorted(freed, used - self.target * limit)) + 1]
+
+    def archive(self, evicted: List[Tuple[DocumentRecord, str, str]]):
+        """Append evicted documents, with their text, to the archive file"""
+        if self.archive_path is None or not evicted:
+            return
+        try:
+            self.archive_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.archive_path, "a", encoding="utf-8") as f:
+                for record, reason, text in evicted:
+                    f.write(json.dumps({
+                        "document_id": record.document_id,
+                        "collection": record.collection,
+                        "content_hash": record.content_hash,
+                        "upload_time": record.upload_time,
+                        "evicted_at": time.time(),
+                        "reason": reason,
+                        "text": text
+                    }) + "\n")
+        except OSError as e:
+            logger.warning(f"Could not archive {len(evicted)} evicted documents to {self.archive_path}: {e}")
+
+    def start_periodic(self, enforce: Callable[[], None], interval: float = Config.CORPUS_RETENTION_INTERVAL):
+        """Run ``enforce`` every ``interval`` seconds on a daemon thread, so old documents expire without uploads"""
+        if self._timer is not None or not self.max_age or interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    enforce()
+                except Exception as e:
+                    logger.error(f"Corpus retention check failed: {e}")
+
+        self._timer = threading.Thread(target=run, name="corpus-retention", daemon=True)
+        self._timer.start()
+
+    def stats(self, documents: DocumentTable) -> Dict:
+        count = len(documents)
+        memory = _column(documents.memory, np.uint64, count)
+        in_memory = _column(documents.evicted, np.uint8, count) == 0
+        collections = {}
+        collection_ids = _column(documents.collection_ids, np.uint16, count)
+        for collection_id, collection in enumerate(documents.collections):
+            members = collection_ids == collection_id
+            collections[collection] = {
+                "documents": int(np.count_nonzero(members & in_memory)),
+                "evicted_documents": int(np.count_nonzero(members & ~in_memory)),
+                "estimated_bytes": int(memory[members].sum()),
+                "quota_bytes": int(self.quota(collection)) or None
+            }
+        return {
+            "estimated_bytes": int(memory.sum()),
+            "budget_bytes": int(self.budget) or None,
+            "process_rss_bytes": process_rss_bytes(),
+            "documents_in_memory": int(np.count_nonzero(in_memory)),
+            "documents_evicted": documents.evicted_count,
+            "evictions": dict(self.evictions),
+            "eviction_enabled": self.enabled,
+            "max_document_age_hours": self.max_age / 3600 or None,
+            "collections": collections,
+            "archive_path": str(self.archive_path) if self.archive_path else None
+        }
+
+
+def create_corpus_manager() -> CorpusManager:
+    """Create the corpus manager with the configured retention policies"""
+    return CorpusManager()
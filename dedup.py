@@ -0,0 +1,201 @@
+"""
+Near-duplicate detection for the Healthcare BERT QA System
+
+Every chunk gets a MinHash signature over hashed word shingles. Signatures
+are split into bands, and chunks sharing any band are near-duplicate
+candidates (locality-sensitive hashing); a candidate counts as a duplicate
+when the signatures estimate a Jaccard similarity of at least the
+threshold. Band tables are sorted numpy arrays with a small dict of recent
+additions merged in periodically, so the index costs a few hundred bytes
+per chunk rather than a Python object per band entry. A band keeps every
+chunk sharing its hash, so evicting one of them leaves the others findable.
+"""
+
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+from config import Config
+
+# Prime just above 2**32; shingle hashes and permutation coefficients are 32-bit,
+# so a * x + b fits in an unsigned 64-bit integer
+_PRIME = np.uint64(4294967311)
+_MERGE_SIZE = 65536
+# Removed IDs are pruned from the band tables once they are this fraction of the stored ones
+_PRUNE_FRACTION = 0.25
+
+
+def shingle_hashes(tokens: Sequence[str], size: int = Config.SHINGLE_SIZE) -> np.ndarray:
+    """Return the 32-bit hashes of a token sequence's word ``size``-grams"""
+    token_hashes = np.fromiter((zlib.crc32(token.encode("utf-8")) for token in tokens), dtype=np.uint64,
+                               count=len(tokens))
+    if len(token_hashes) <= size:
+        return np.array([zlib.crc32(" ".join(tokens).encode("utf-8"))], dtype=np.uint64)
+    combined = token_hashes[:len(token_hashes) - size + 1].copy()
+    for offset in range(1, size):
+        combined = (combined * np.uint64(31) + token_hashes[offset:len(token_hashes) - size + 1 + offset]) % _PRIME
+    return combined & np.uint64(0xFFFFFFFF)
+
+
+class _BandTable:
+    """Band hash -> IDs of the chunks with that band"""
+
+    def __init__(self):
+        # Sorted by hash; a hash shared by several chunks has one entry per chunk
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._recent: Dict[int, List[int]] = {}
+        self._recent_count = 0
+
+    def get(self, band_hash: int) -> List[int]:
+        found = self._recent.get(band_hash, [])
+        left = int(np.searchsorted(self._hashes, band_hash, side="left"))
+        right = int(np.searchsorted(self._hashes, band_hash, side="right"))
+        return self._ids[left:right].tolist() + found if right > left else list(found)
+
+    def add(self, band_hash: int, chunk_id: int):
+        self._recent.setdefault(band_hash, []).append(chunk_id)
+        self._recent_count += 1
+        if self._recent_count >= _MERGE_SIZE:
+            self._merge()
+
+    def prune(self, dropped: np.ndarray):
+        """Drop the entries of IDs flagged in ``dropped``, and of IDs past its end"""
+        self._merge()
+        keep = self._ids < len(dropped)
+        keep[keep] = ~dropped[self._ids[keep]]
+        self._hashes, self._ids = self._hashes[keep], self._ids[keep]
+
+    def _merge(self):
+        if not self._recent:
+            return
+        hashes = np.fromiter((band_hash for band_hash, ids in self._recent.items() for _ in ids), dtype=np.uint64,
+                             count=self._recent_count)
+        ids = np.fromiter((chunk_id for ids in self._recent.values() for chunk_id in ids), dtype=np.int64,
+                          count=self._recent_count)
+        hashes = np.concatenate([self._hashes, hashes])
+        ids = np.concatenate([self._ids, ids])
+        order = np.argsort(hashes, kind="stable")
+        self._hashes, self._ids = hashes[order], ids[order]
+        self._recent = {}
+        self._recent_count = 0
+
+
+class MinHash:
+    """MinHash signatures over word shingles, and their band hashes"""
+
+    def __init__(self, num_perm: int = Config.MINHASH_PERMUTATIONS, bands: int = Config.MINHASH_BANDS,
+                 threshold: float = Config.NEAR_DUPLICATE_THRESHOLD, seed: int = 1,
+                 shingle_size: int = Config.SHINGLE_SIZE):
+        if num_perm % bands:
+            raise ValueError("MINHASH_PERMUTATIONS must be a multiple of MINHASH_BANDS")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 32, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.integers(0, 2 ** 32, size=(num_perm, 1), dtype=np.uint64)
+
+    def signature(self, tokens: Sequence[str]) -> np.ndarray:
+        """Return the MinHash signature of a token sequence"""
+        hashes = shingle_hashes(tokens, self.shingle_size)
+        return ((self._a * hashes[None, :] + self._b) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def band_hashes(self, signature: np.ndarray) -> Iterable[int]:
+        for band in range(self.bands):
+            yield hash(signature[band * self.rows:(band + 1) * self.rows].tobytes()) & 0x7FFFFFFFFFFFFFFF
+
+    def similar(self, first: np.ndarray, second: np.ndarray) -> bool:
+        """Whether two signatures estimate a Jaccard similarity of at least the threshold"""
+        return np.count_nonzero(first == second) >= self.threshold * self.num_perm
+
+
+class MinHashLSH(MinHash):
+    """MinHash signatures of chunks, banded for near-duplicate lookup
+
+    IDs are dense integers (chunk IDs, or positions within an ingestion
+    batch); ``find`` verifies candidates against their stored signatures.
+    Removed IDs are skipped at once and pruned from the band tables in bulk.
+    """
+
+    def __init__(self, num_perm: int = Config.MINHASH_PERMUTATIONS, bands: int = Config.MINHASH_BANDS,
+                 threshold: float = Config.NEAR_DUPLICATE_THRESHOLD, seed: int = 1):
+        super().__init__(num_perm, bands, threshold, seed)
+        self._tables = [_BandTable() for _ in range(bands)]
+        # ID -> signature, grown by doubling, and whether the ID was removed
+        self._signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self._removed = np.zeros(0, dtype=bool)
+        self._size = 0
+        # IDs in the band tables, and how many of them were removed since the last pruning
+        self._stored = 0
+        self._unpruned = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def find(self, signature: np.ndarray) -> Optional[int]:
+        """Return the ID of a stored near-duplicate of ``signature``, or None"""
+        checked = set()
+        for table, band_hash in zip(self._tables, self.band_hashes(signature)):
+            for candidate in table.get(band_hash):
+                if candidate in checked or candidate >= self._size or self._removed[candidate]:
+                    continue
+                checked.add(candidate)
+                if self.similar(self._signatures[candidate], signature):
+                    return candidate
+        return None
+
+    def add(self, item_id: int, signature: np.ndarray):
+        """Store the signature of ``item_id``; IDs must be added in increasing order"""
+        if item_id >= len(self._signatures):
+            capacity = max(item_id + 1, 2 * len(self._signatures), 64)
+            grown = np.zeros((capacity, self.num_perm), dtype=np.uint32)
+            grown[:len(self._signatures)] = self._signatures
+            removed = np.zeros(capacity, dtype=bool)
+            removed[:len(self._removed)] = self._removed
+            self._signatures, self._removed = grown, removed
+        self._signatures[item_id] = signature
+        self._removed[item_id] = False
+        self._size = max(self._size, item_id + 1)
+        self._stored += 1
+        for table, band_hash in zip(self._tables, self.band_hashes(signature)):
+            table.add(band_hash, item_id)
+
+    def add_many(self, first_id: int, signatures: Union[np.ndarray, List[np.ndarray]]):
+        """Store consecutive signatures from ``first_id`` on, as a list or one row per ID"""
+        for offset, signature in enumerate(signatures):
+            self.add(first_id + offset, signature)
+
+    def remove(self, item_ids: Sequence[int]):
+        """Stop matching the given IDs, e.g. chunks evicted from the corpus"""
+        item_ids = np.unique(np.asarray(item_ids, dtype=np.int64))
+        item_ids = item_ids[(item_ids >= 0) & (item_ids < self._size)]
+        item_ids = item_ids[~self._removed[item_ids]]
+        self._removed[item_ids] = True
+        self._unpruned += len(item_ids)
+        if self._unpruned > _PRUNE_FRACTION * self._stored:
+            self._prune()
+
+    def truncate(self, size: int):
+        """Forget signatures from ``size`` on"""
+        if size < self._size:
+            self._size = size
+            self._prune()
+
+    def _prune(self):
+        """Drop removed and truncated IDs from the band tables"""
+        dropped = self._removed[:self._size]
+        for table in self._tables:
+            table.prune(dropped)
+        self._stored = self._size - int(np.count_nonzero(dropped))
+        self._unpruned = 0
+
+
+def create_deduplicator() -> Optional[MinHashLSH]:
+    """Create the near-duplicate index, or None if near-duplicate detection is disabled"""
+    if not Config.NEAR_DEDUP_ENABLED:
+        return None
+    return MinHashLSH()
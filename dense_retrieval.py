@@ -0,0 +1,339 @@
+"""
+Dense retrieval for the Healthcare BERT QA System
+
+Chunks of uploaded documents are embedded in batches at ingestion time and
+stored in a FAISS HNSW index persisted to ``Config.FAISS_INDEX_PATH``. Vectors
+are keyed by a hash of the chunk text, so a persisted index is reused after a
+restart for every chunk whose text is unchanged, and stale vectors are ignored.
+
+The index is written on a timer rather than after every ingestion batch;
+vectors added since the last save are simply embedded again after a crash.
+HNSW graphs cannot delete, so once the vectors of evicted or replaced chunks
+pass ``DENSE_INDEX_COMPACT_FRACTION`` of the index, it is rebuilt from the
+live ones.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import Config
+from retrieval import tokenize
+
+# faiss-cpu is optional at runtime and slow to import, so it is loaded by the first DenseIndex
+faiss = None
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_key(text: str) -> int:
+    """Return a stable 64-bit key for a chunk's text"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashingEmbedder:
+    """Small deterministic local encoder based on signed feature hashing
+
+    Needs no model download, so dense retrieval can be exercised offline.
+    """
+
+    def __init__(self, dimension: int = 256):
+        self.dimension = dimension
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype='float32')
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                digest = zlib.crc32(token.encode('utf-8'))
+                vectors[row, digest % self.dimension] += 1.0 if digest & 0x80000000 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class SentenceTransformerEmbedder:
+    """Encoder backed by the configured sentence-transformers model"""
+
+    def __init__(self, model_name: str = Config.SENTENCE_TRANSFORMER_MODEL, device: str = "cpu"):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device=device)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: Sequence[str], batch_size: int = 32) -> np.ndarray:
+        vectors = self.model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True,
+                                    normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype='float32')
+
+
+def _load_faiss() -> bool:
+    """Import faiss on first use; return False if it is not installed"""
+    global faiss
+    if faiss is None:
+        try:
+            import faiss as faiss_module
+        except ImportError:
+            return False
+        faiss = faiss_module
+    return True
+
+
+def create_embedder(backend: str = Config.EMBEDDING_BACKEND):
+    """Create the embedder named by ``backend``"""
+    if backend == "hashing":
+        return HashingEmbedder()
+    if backend == "sentence-transformers":
+        return SentenceTransformerEmbedder()
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+class DenseIndex:
+    """FAISS HNSW index over chunk embeddings with inner-product (cosine) scoring"""
+
+    def __init__(self, embedder, index_path: Optional[Path] = None, hnsw_m: int = Config.HNSW_M,
+                 batch_size: int = Config.EMBEDDING_BATCH_SIZE,
+                 compact_fraction: float = Config.DENSE_INDEX_COMPACT_FRACTION):
+        if not _load_faiss():
+            raise ImportError("faiss is required for dense retrieval")
+
+        self.embedder = embedder
+        self.index_path = Path(index_path) if index_path else None
+        self.hnsw_m = hnsw_m
+        self.batch_size = batch_size
+        self.compact_fraction = compact_fraction
+        self._lock = threading.Lock()
+        # Serializes writers of the index files, and compactions
+        self._save_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._saver: Optional[threading.Thread] = None
+        # Index position -> chunk text key, and key -> chunk ID in the live corpus
+        self._keys = np.zeros(0, dtype='uint64')
+        self._positions: Dict[int, int] = {}
+        self._chunk_ids: Dict[int, int] = {}
+        # Vectors in the index whose key no chunk of the corpus maps to
+        self._stale = 0
+        self._dirty = False
+
+        self.index = self._load() if self.index_path else None
+        if self.index is None:
+            self.index = self._new_index()
+
+    def _new_index(self):
+        return faiss.IndexHNSWFlat(self.embedder.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+
+    @property
+    def stale_count(self) -> int:
+        return self._stale
+
+    @property
+    def keys_path(self) -> Path:
+        return self.index_path.with_suffix(".keys.npy")
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def _load(self):
+        """Memory-map a persisted index, if one matching the embedder exists"""
+        if not self.index_path.exists() or not self.keys_path.exists():
+            return None
+        try:
+            index = faiss.read_index(str(self.index_path), faiss.IO_FLAG_MMAP)
+        except RuntimeError:
+            index = faiss.read_index(str(self.index_path))
+
+        keys = np.load(self.keys_path)
+        if index.d != self.embedder.dimension or index.ntotal != len(keys):
+            logger.warning(f"Ignoring incompatible dense index at {self.index_path}")
+            return None
+
+        self._keys = keys
+        self._positions = {int(key): position for position, key in enumerate(keys)}
+        # Vectors stop being stale as the corpus chunks are added back
+        self._stale = len(keys)
+        logger.info(f"Loaded dense index with {index.ntotal} vectors from {self.index_path}")
+        return index
+
+    def prepare(self, texts: Sequence[str], precomputed: Optional[Dict[int, np.ndarray]] = None
+                ) -> Tuple[List[int], List[int], Optional[np.ndarray]]:
+        """Embed the chunks whose text is not in the index yet, without taking the index lock
+
+        Vectors found in ``precomputed`` (by chunk key) are used instead of
+        embedding again. Returns the key of every text, the keys that need
+        new vectors and those vectors, ready for ``add_prepared``.
+        """
+        keys = [chunk_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self._positions and key not in missing:
+                missing[key] = text
+        if not missing:
+            return keys, [], None
+
+        precomputed = precomputed or {}
+        to_embed = [key for key in missing if key not in precomputed]
+        vectors = np.zeros((len(missing), self.embedder.dimension), dtype='float32')
+        rows = {key: row for row, key in enumerate(missing)}
+        if to_embed:
+            embedded = self.embedder.encode([missing[key] for key in to_embed], batch_size=self.batch_size)
+            vectors[[rows[key] for key in to_embed]] = embedded
+        for key in missing:
+            if key in precomputed:
+                vectors[rows[key]] = precomputed[key]
+        return keys, list(missing), vectors
+
+    def add_prepared(self, chunk_ids: Sequence[int], prepared: Tuple[List[int], List[int], Optional[np.ndarray]]):
+        """Map chunk IDs to their keys and append the newly embedded vectors"""
+        keys, new_keys, vectors = prepared
+        with self._lock:
+            for chunk_id, key in zip(chunk_ids, keys):
+                if key not in self._chunk_ids and key in self._positions:
+                    self._stale -= 1
+                self._chunk_ids[key] = chunk_id
+            if vectors is None:
+                return
+
+            start = self.index.ntotal
+            self.index.add(vectors)
+            for offset, key in enumerate(new_keys):
+                self._positions[key] = start + offset
+            self._keys = np.concatenate([self._keys, np.array(new_keys, dtype='uint64')])
+            self._dirty = True
+
+    def add(self, chunk_ids: Sequence[int], texts: Sequence[str], precomputed: Optional[Dict[int, np.ndarray]] = None):
+        """Embed chunks in batches, reusing persisted or precomputed vectors for unchanged text"""
+        self.add_prepared(chunk_ids, self.prepare(texts, precomputed))
+
+    def remove(self, chunk_ids: Sequence[int], texts: Sequence[str]):
+        """Stop returning chunks; their vectors stay in the HNSW graph until ``compact`` rebuilds it"""
+        with self._lock:
+            for chunk_id, text in zip(chunk_ids, texts):
+                key = chunk_key(text)
+                # Another chunk with the same text may own the key by now
+                if self._chunk_ids.get(key) == chunk_id:
+                    del self._chunk_ids[key]
+                    if key in self._positions:
+                        self._stale += 1
+
+    def maybe_compact(self) -> bool:
+        """Compact the index if stale vectors exceed the configured fraction; return whether it did"""
+        total = self.index.ntotal
+        if not total or self.compact_fraction <= 0 or self._stale < self.compact_fraction * total:
+            return False
+        return self.compact()
+
+    def compact(self) -> bool:
+        """Rebuild the HNSW graph from the vectors of live chunks only
+
+        Vectors are copied out under the lock, the new graph is built without
+        it, and vectors added meanwhile are appended before the swap. Returns
+        False if another compaction is already running.
+        """
+        if not self._compact_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                total = self.index.ntotal
+                keys = self._keys[:total]
+                vectors = self.index.reconstruct_n(0, total) if total else None
+                live = np.fromiter((int(key) in self._chunk_ids for key in keys), dtype=bool, count=total)
+
+            index = self._new_index()
+            if live.any():
+                index.add(np.ascontiguousarray(vectors[live]))
+            keys = keys[live]
+
+            with self._lock:
+                added = self.index.ntotal - total
+                if added:
+                    index.add(self.index.reconstruct_n(total, added))
+                    keys = np.concatenate([keys, self._keys[total:]])
+                self.index = index
+                self._keys = keys
+                self._positions = {int(key): position for position, key in enumerate(keys)}
+                self._stale = sum(1 for key in self._positions if key not in self._chunk_ids)
+                self._dirty = True
+            logger.info(f"Compacted dense index from {total + added} to {len(keys)} vectors")
+            return True
+        finally:
+            self._compact_lock.release()
+
+    def search(self, query: str, k: int = Config.TOP_K_RETRIEVAL) -> List[Tuple[int, float]]:
+        """Return the top-k (chunk ID, similarity) pairs for a query"""
+        return self.search_many([query], k)[0]
+
+    def search_many(self, queries: Sequence[str], k: int = Config.TOP_K_RETRIEVAL) -> List[List[Tuple[int, float]]]:
+        """Embed queries as one batch and search them with a single index call"""
+        if not queries or self.index.ntotal == 0:
+            return [[] for _ in queries]
+
+        vectors = self.embedder.encode(queries, batch_size=self.batch_size)
+        # Over-fetch so vectors of chunks no longer in the corpus can be skipped
+        fetch = min(self.index.ntotal, k * 2)
+        with self._lock:
+            scores, positions = self.index.search(np.ascontiguousarray(vectors, dtype='float32'), fetch)
+            keys = self._keys
+
+        results = []
+        for row_scores, row_positions in zip(scores, positions):
+            hits = []
+            for score, position in zip(row_scores, row_positions):
+                if position < 0:
+                    continue
+                chunk_id = self._chunk_ids.get(int(keys[position]))
+                if chunk_id is not None:
+                    hits.append((chunk_id, float(score)))
+                    if len(hits) >= k:
+                        break
+            results.append(hits)
+        return results
+
+    def save(self):
+        """Persist the index and its chunk keys if anything changed since the last save
+
+        Only serializing to memory holds the index lock; searches are not
+        blocked while the files are written.
+        """
+        if self.index_path is None or not self._dirty:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = faiss.serialize_index(self.index)
+                keys = self._keys
+                self._dirty = False
+            try:
+                self.index_path.parent.mkdir(parents=True, exist_ok=True)
+                # Worker processes sharing the path each write their own temporary files
+                tmp_index = self.index_path.with_suffix(f".faiss.{os.getpid()}.tmp")
+                tmp_keys = self.index_path.with_suffix(f".keys.{os.getpid()}.tmp.npy")
+                data.tofile(str(tmp_index))
+                np.save(tmp_keys, keys)
+                os.replace(tmp_keys, self.keys_path)
+                os.replace(tmp_index, self.index_path)
+            except OSError:
+                self._dirty = True
+                raise
+
+    def start_periodic_save(self, interval: float = Config.DENSE_INDEX_SAVE_INTERVAL):
+        """Save the index every ``interval`` seconds on a daemon thread, when anything changed"""
+        if self._saver is not None or self.index_path is None or interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except Exception as e:
+                    logger.error(f"Saving the dense index failed: {e}")
+
+        self._saver = threading.Thread(target=run, name="dense-index-save", daemon=True)
+        self._saver.start()
@@ -0,0 +1,338 @@
+"""
+Persistent document store for the Healthcare BERT QA System
+
+Committed ingestion batches are written to the SQLite database named by
+``Config.DATABASE_URL`` in one transaction each: document metadata, the
+chunked parts with their sentence offsets, MinHash signatures and entity
+postings, and the batch's keyword postings. On startup the engine reloads
+these arrays directly, so a warm restart does not re-split, re-tokenize,
+re-hash or re-scan any text.
+
+Documents evicted from memory by the corpus manager stay in the database,
+flagged; on restart their parts are reloaded without their text.
+
+The database is shared by every worker process of a server, so it also
+holds the state of background ingestion jobs, and the content hashes of
+stored documents answer exact-duplicate checks for uploads handled by
+other workers.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from chunking import PreparedDocument
+from config import Config
+from documents import DocumentRecord
+from retrieval import IndexBatch
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    upload_time REAL NOT NULL,
+    length INTEGER NOT NULL,
+    parts INTEGER NOT NULL,
+    is_user_upload INTEGER NOT NULL,
+    document_id INTEGER NOT NULL,
+    collection TEXT NOT NULL,
+    evicted_at REAL
+);
+CREATE INDEX IF NOT EXISTS documents_content_hash ON documents (content_hash);
+CREATE INDEX IF NOT EXISTS documents_document_id ON documents (document_id);
+CREATE TABLE IF NOT EXISTS chunk_parts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    sentence_offsets BLOB NOT NULL,
+    chunks BLOB NOT NULL,
+    document_id INTEGER NOT NULL,
+    signatures BLOB NOT NULL,
+    entities TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS index_batches (
+    id INTEGER PRIMARY KEY,
+    lengths BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    batch_id INTEGER NOT NULL REFERENCES index_batches (id),
+    term TEXT NOT NULL,
+    passage_ids BLOB NOT NULL,
+    term_freqs BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_batch ON postings (batch_id);
+CREATE TABLE IF NOT EXISTS ingestion_jobs (
+    id TEXT PRIMARY KEY,
+    description TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    documents_processed INTEGER NOT NULL,
+    documents_committed INTEGER NOT NULL,
+    documents_skipped INTEGER NOT NULL,
+    characters_processed INTEGER NOT NULL,
+    error TEXT,
+    spec TEXT,
+    owner INTEGER
+);
+CREATE INDEX IF NOT EXISTS ingestion_jobs_status ON ingestion_jobs (status);
+"""
+
+# Status fields of an ingestion job, as in ``IngestionJob.to_dict`` after "job_id"
+_JOB_FIELDS = ("description", "status", "created_at", "started_at", "finished_at", "documents_processed",
+               "documents_committed", "documents_skipped", "characters_processed", "error")
+
+_DOCUMENT_COLUMNS = "content_hash, upload_time, length, parts, is_user_upload, document_id, collection, evicted_at"
+
+
+def _document_record(row: Tuple) -> DocumentRecord:
+    content_hash, upload_time, length, parts, is_user_upload, document_id, collection, evicted_at = row
+    return DocumentRecord(upload_time, bool(is_user_upload), length, parts, content_hash, document_id,
+                          collection, evicted_at is not None)
+
+
+def sqlite_path(database_url: str) -> str:
+    """Return the SQLite database path of a ``sqlite:///`` URL"""
+    prefix = "sqlite:///"
+    if not database_url.startswith(prefix):
+        raise ValueError(f"Unsupported database URL: {database_url}")
+    return database_url[len(prefix):]
+
+
+def _pack_chunks(chunks: List[Tuple[int, int]]) -> bytes:
+    flat = array('I')
+    for first, end in chunks:
+        flat.append(first)
+        flat.append(end)
+    return flat.tobytes()
+
+
+def _pack_signatures(signatures: Sequence[Any]) -> bytes:
+    return b"".join(signature.tobytes() for signature in signatures)
+
+
+def _unpack(blob: bytes) -> array:
+    values = array('I')
+    values.frombytes(blob)
+    return values
+
+
+class StoredPart(NamedTuple):
+    """A stored chunk table part with the uint32 MinHash signatures of its chunks, row by row, and
+    the (entity, section, sentence, chunk) entries of its recognized entities, numbered within the part
+
+    ``signatures`` is empty if near-duplicate detection was disabled when
+    the part was stored.
+    """
+    part: PreparedDocument
+    signatures: bytes
+    entities: List[Tuple[str, str, int, int]]
+
+
+class DocumentStore:
+    """SQLite store of ingested documents, chunk arrays and keyword postings
+
+    Arrays are stored as raw native-endian blobs, so a database is meant to
+    be reloaded on the same platform that wrote it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def from_url(cls, database_url: str = Config.DATABASE_URL) -> "DocumentStore":
+        return cls(sqlite_path(database_url))
+
+    def save_batch(self, document_infos: Iterable[DocumentRecord], parts: Sequence[PreparedDocument],
+                   index_batch: IndexBatch, signatures: Sequence[Any] = (),
+                   entities: Iterable[Tuple[str, str, int, int, int]] = ()):
+        """Write one committed ingestion batch in a single transaction
+
+        ``signatures`` holds the MinHash signature of every chunk of
+        ``parts`` in order, or nothing, and ``entities`` the (entity,
+        section, part, sentence within the part, chunk within the batch)
+        entries of ``IngestBatch.entities``.
+        """
+        part_signatures = []
+        part_entities: List[List[Tuple[str, str, int, int]]] = [[] for _ in parts]
+        first_chunks = []
+        position = 0
+        for part in parts:
+            part_signatures.append(_pack_signatures(signatures[position:position + len(part.chunks)]))
+            first_chunks.append(position)
+            position += len(part.chunks)
+        for entity, section, part, sentence, chunk in entities:
+            part_entities[part].append((entity, section, sentence, chunk - first_chunks[part]))
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO documents (content_hash, upload_time, length, parts, is_user_upload, document_id, "
+                "collection) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(info.content_hash, info.upload_time, info.length, info.parts, int(info.is_user_upload),
+                  info.document_id, info.collection) for info in document_infos]
+            )
+            self._connection.executemany(
+                "INSERT INTO chunk_parts (text, sentence_offsets, chunks, document_id, signatures, entities) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(part.text, part.offsets.tobytes(), _pack_chunks(part.chunks), part.document_id, packed,
+                  json.dumps(entries)) for part, packed, entries in zip(parts, part_signatures, part_entities)]
+            )
+            if not len(index_batch):
+                return
+            batch_id = self._connection.execute(
+                "INSERT INTO index_batches (lengths) VALUES (?)", (index_batch.lengths.tobytes(),)
+            ).lastrowid
+            self._connection.executemany(
+                "INSERT INTO postings (batch_id, term, passage_ids, term_freqs) VALUES (?, ?, ?, ?)",
+                [(batch_id, term, passage_ids.tobytes(), term_freqs.tobytes())
+                 for term, (passage_ids, term_freqs) in index_batch.postings.items()]
+            )
+
+    def iter_documents(self) -> Iterator[DocumentRecord]:
+        """Yield the metadata of every stored document in ingestion order"""
+        rows = self._connection.execute(f"SELECT {_DOCUMENT_COLUMNS} FROM documents ORDER BY id")
+        for row in rows:
+            yield _document_record(row)
+
+    def load_documents(self, document_ids: Sequence[int]) -> List[DocumentRecord]:
+        """Return the metadata of the given stored documents, e.g. ones committed by other workers"""
+        placeholders = ", ".join("?" * len(document_ids))
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {_DOCUMENT_COLUMNS} FROM documents WHERE document_id IN ({placeholders}) ORDER BY id",
+                list(document_ids)
+            ).fetchall()
+        return [_document_record(row) for row in rows]
+
+    def iter_parts(self) -> Iterator[StoredPart]:
+        """Yield every stored chunk table part in ingestion order
+
+        Parts of evicted documents come without their text, every sentence
+        empty, signatures or entities, so chunk IDs still line up with the
+        stored postings.
+        """
+        rows = self._connection.execute(
+            "SELECT p.document_id, p.sentence_offsets, p.chunks, CASE WHEN d.evicted_at IS NULL THEN p.text END, "
+            "CASE WHEN d.evicted_at IS NULL THEN p.signatures END, CASE WHEN d.evicted_at IS NULL THEN p.entities END "
+            "FROM chunk_parts p JOIN documents d ON d.document_id = p.document_id ORDER BY p.id"
+        )
+        for document_id, offsets, chunks, text, signatures, entities in rows:
+            flat = _unpack(chunks)
+            offsets = _unpack(offsets)
+            chunks = list(zip(flat[::2], flat[1::2]))
+            if text is None:
+                offsets = array('I', bytes(len(offsets) * offsets.itemsize))
+                yield StoredPart(PreparedDocument("", offsets, chunks, document_id), b"", [])
+                continue
+            yield StoredPart(PreparedDocument(text, offsets, chunks, document_id), signatures,
+                             [tuple(entry) for entry in json.loads(entities)])
+
+    def iter_index_batches(self) -> Iterator[IndexBatch]:
+        """Yield every stored keyword index batch in commit order"""
+        batches = self._connection.execute("SELECT id, lengths FROM index_batches ORDER BY id").fetchall()
+        for batch_id, lengths in batches:
+            batch = IndexBatch()
+            batch.lengths = _unpack(lengths)
+            rows = self._connection.execute(
+                "SELECT term, passage_ids, term_freqs FROM postings WHERE batch_id = ?", (batch_id,)
+            )
+            for term, passage_ids, term_freqs in rows:
+                batch.postings[term] = (_unpack(passage_ids), _unpack(term_freqs))
+            yield batch
+
+    def has_document(self, content_hash: str) -> bool:
+        """Whether a document with this content hash is stored and not evicted"""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM documents WHERE content_hash = ? AND evicted_at IS NULL LIMIT 1", (content_hash,)
+            ).fetchone() is not None
+
+    def save_job(self, status: Dict[str, Any], spec: Optional[Dict[str, Any]] = None, owner: Optional[int] = None):
+        """Insert or update an ingestion job from its status dict
+
+        ``spec`` holds what is needed to run the job again and ``owner`` the
+        process running it; both are kept when not given.
+        """
+        columns = ", ".join(_JOB_FIELDS)
+        placeholders = ", ".join("?" * (len(_JOB_FIELDS) + 3))
+        updates = ", ".join(f"{field} = excluded.{field}" for field in _JOB_FIELDS)
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT INTO ingestion_jobs (id, {columns}, spec, owner) VALUES ({placeholders}) "
+                f"ON CONFLICT (id) DO UPDATE SET {updates}, spec = COALESCE(excluded.spec, spec), "
+                f"owner = COALESCE(excluded.owner, owner)",
+                (status["job_id"], *(status[field] for field in _JOB_FIELDS),
+                 json.dumps(spec) if spec is not None else None, owner)
+            )
+
+    def load_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the status dict of a stored ingestion job"""
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT id, {', '.join(_JOB_FIELDS)} FROM ingestion_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return dict(zip(("job_id",) + _JOB_FIELDS, row)) if row is not None else None
+
+    def unfinished_jobs(self) -> List[Tuple[Dict[str, Any], Dict[str, Any], int]]:
+        """Return (status, spec, owner) of every queued or running job, oldest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, {', '.join(_JOB_FIELDS)}, spec, owner FROM ingestion_jobs "
+                "WHERE status IN ('queued', 'running') AND spec IS NOT NULL ORDER BY created_at"
+            ).fetchall()
+        return [(dict(zip(("job_id",) + _JOB_FIELDS, row[:-2])), json.loads(row[-2]), row[-1]) for row in rows]
+
+    def claim_job(self, job_id: str, previous_owner: int, owner: int) -> bool:
+        """Take over a job from ``previous_owner``; False if another process claimed it first"""
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "UPDATE ingestion_jobs SET owner = ?, status = 'queued' WHERE id = ? AND owner = ? "
+                "AND status IN ('queued', 'running')", (owner, job_id, previous_owner)
+            ).rowcount == 1
+
+    def delete_job(self, job_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM ingestion_jobs WHERE id = ?", (job_id,))
+
+    def prune_jobs(self, history: int):
+        """Keep only the ``history`` most recently finished jobs"""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM ingestion_jobs WHERE finished_at IS NOT NULL AND id NOT IN "
+                "(SELECT id FROM ingestion_jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)",
+                (history,)
+            )
+
+    def mark_evicted(self, document_ids: Iterable[int], evicted_at: float):
+        """Flag documents evicted from memory; their text stays in the database"""
+        with self._lock, self._connection:
+            self._connection.executemany("UPDATE documents SET evicted_at = ? WHERE document_id = ?",
+                                         [(evicted_at, document_id) for document_id in document_ids])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def create_document_store() -> Optional[DocumentStore]:
+    """Create the document store described by the configuration, or None if disabled"""
+    if not Config.DOCUMENT_STORE_ENABLED:
+        return None
+    try:
+        return DocumentStore.from_url(Config.DATABASE_URL)
+    except (ValueError, sqlite3.Error) as e:
+        logger.warning(f"Document store disabled: {e}")
+        return None
@@ -0,0 +1,128 @@
+"""
+Document metadata for the Healthcare BERT QA System
+
+The engine keeps the metadata of every ingested document (content hash,
+upload time, length, part count, collection and whether it is a user upload)
+in columnar arrays rather than a dict per document, so metadata costs a fixed
+few dozen bytes per document. The same columns track the retention state used
+by the corpus manager: estimated memory, retrieval hits and eviction.
+``DocumentRecord`` is the row type used while a document is being ingested
+and when records are read back.
+"""
+
+import uuid
+from array import array
+from typing import Dict, Iterator, List, Optional
+
+from config import Config
+
+_HASH_SIZE = 32  # SHA-256 digest
+
+
+def new_document_id() -> int:
+    """Random positive 63-bit document ID, unique across worker processes sharing a store"""
+    return uuid.uuid4().int >> 65
+
+
+class DocumentRecord:
+    """Metadata of one document"""
+
+    __slots__ = ("document_id", "collection", "content_hash", "upload_time", "length", "parts",
+                 "is_user_upload", "evicted")
+
+    def __init__(self, upload_time: float, is_user_upload: bool, length: int = 0, parts: int = 0,
+                 content_hash: Optional[str] = None, document_id: Optional[int] = None,
+                 collection: str = Config.DEFAULT_COLLECTION, evicted: bool = False):
+        self.document_id = document_id if document_id is not None else new_document_id()
+        self.collection = collection
+        self.upload_time = upload_time
+        self.is_user_upload = is_user_upload
+        self.length = length
+        self.parts = parts
+        # Hex SHA-256 of the document text
+        self.content_hash = content_hash
+        self.evicted = evicted
+
+
+class DocumentTable:
+    """Append-only columnar table of document metadata
+
+    Documents are addressed by position; ``position`` maps a document ID to
+    it. Evicted documents keep their row, flagged, so positions never change.
+    """
+
+    def __init__(self):
+        self._ids = array('q')
+        self._positions: Dict[int, int] = {}
+        self._hashes = bytearray()
+        self.upload_times = array('d')
+        self._lengths = array('Q')
+        self._parts = array('I')
+        self._user_uploads = bytearray()
+        self.collection_ids = array('H')
+        self.collections: List[str] = []
+        self._collection_index: Dict[str, int] = {}
+        # Retention state: estimated bytes held in memory, retrieval hits and eviction flag
+        self.memory = array('Q')
+        self.last_hit = array('d')
+        self.hits = array('I')
+        self.evicted = bytearray()
+        self.user_upload_count = 0
+        self.evicted_count = 0
+
+    def __len__(self) -> int:
+        return len(self.upload_times)
+
+    def append(self, record: DocumentRecord) -> int:
+        """Add a record and return its position"""
+        collection_id = self._collection_index.get(record.collection)
+        if collection_id is None:
+            collection_id = len(self.collections)
+            self.collections.append(record.collection)
+            self._collection_index[record.collection] = collection_id
+
+        position = len(self._ids)
+        self._ids.append(record.document_id)
+        self._positions[record.document_id] = position
+        self._hashes += bytes.fromhex(record.content_hash) if record.content_hash else bytes(_HASH_SIZE)
+        self._lengths.append(record.length)
+        self._parts.append(record.parts)
+        self._user_uploads.append(1 if record.is_user_upload else 0)
+        self.collection_ids.append(collection_id)
+        self.memory.append(0)
+        self.last_hit.append(record.upload_time)
+        self.hits.append(0)
+        self.evicted.append(1 if record.evicted else 0)
+        self.user_upload_count += 1 if record.is_user_upload else 0
+        self.evicted_count += 1 if record.evicted else 0
+        # Appended last: it is the length readers see
+        self.upload_times.append(record.upload_time)
+        return position
+
+    def position(self, document_id: int) -> Optional[int]:
+        return self._positions.get(document_id)
+
+    def document_id(self, position: int) -> int:
+        return self._ids[position]
+
+    def is_user_upload(self, position: int) -> bool:
+        return bool(self._user_uploads[position])
+
+    def mark_evicted(self, position: int):
+        if not self.evicted[position]:
+            self.evicted[position] = 1
+            self.evicted_count += 1
+            self.memory[position] = 0
+
+    def __getitem__(self, position: int) -> DocumentRecord:
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        start = position * _HASH_SIZE
+        return DocumentRecord(self.upload_times[position], bool(self._user_uploads[position]),
+                              self._lengths[position], self._parts[position],
+                              self._hashes[start:start + _HASH_SIZE].hex(), self._ids[position],
+                              self.collections[self.collection_ids[position]], bool(self.evicted[position]))
+
+    def __iter__(self) -> Iterator[DocumentRecord]:
+        for position in range(len(self)):
+            yield self[position]
@@ -6,18 +6,49 @@ This script provides a robust API that combines the BioBERT model with
 a fixed knowledge base for reliable medical answers.
 """
 
+import bisect
+import hashlib
+import json
 import os
+import pstats
 import sys
 from flask import Flask, jsonify, request
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+import numpy as np
 import logging
 import time
+import queue
 import re
-from typing import Dict, List, Optional
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 # Add the project root to Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+import admission
+from caching import AnswerCache, create_answer_cache, create_semantic_cache
+from chunking import ChunkTable, iter_document_parts, prepare_document, term_pattern
+from config import Config
+from corpus import create_corpus_manager
+from dedup import MinHashLSH, create_deduplicator
+from dense_retrieval import DenseIndex, create_embedder
+from documents import DocumentRecord, DocumentTable
+from document_store import DocumentStore, create_document_store
+from entities import create_entity_index
+from extraction import detect_format, iter_extracted_documents
+from ingestion import IngestBatch, IngestionJob, IngestionQueue, iter_decoded, iter_json_documents, spool_stream
+from intent_router import IntentRouter
+import metrics
+from profiling import admin_authorized, profiled, profile_requested, profiler
+from reader import BatchingReader, ExtractiveReader, ReaderAnswer, create_reader
+from responses import PrecompiledAnswer, encode_json, format_answer
+from retrieval import IndexBatch, InvertedIndex, tokenize
+from segments import Segment, SegmentManifest, SegmentedChunks
+import startup
+from streaming import requested_stream_format, stream_response
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -27,6 +58,9 @@ logger = logging.getLogger(__name__)
 
 # Create Flask app
 app = Flask(__name__)
+if Config.PROXY_TRUSTED_HOPS > 0:
+    # Rate limits are kept per client address, which the trusted proxies pass in X-Forwarded-For
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.PROXY_TRUSTED_HOPS, x_proto=Config.PROXY_TRUSTED_HOPS)
 CORS(app)
 
 @app.route("/")
@@ -35,7 +69,9 @@ def index():
 class EnhancedMedicalQA:
     """Enhanced Medical QA with fixed knowledge base and pattern matching"""
     
-    def __init__(self):
+    def __init__(self, embedder=None, answer_cache: Optional[AnswerCache] = None,
+                 document_store: Optional[DocumentStore] = None,
+                 reader: Optional[Union[ExtractiveReader, BatchingReader]] = None, load_models: bool = True):
         self.medical_knowledge = {
             "aspirin": {
                 "side_effects": [
@@ -104,196 +140,905 @@ class EnhancedMedicalQA:
             }
         }
         
-        # Load documents from file
-        self.load_sample_documents()
+        # Knowledge-base question rules, compiled once into a single matcher
+        with startup.stages.track("knowledge_base"):
+            self.router = IntentRouter(self.medical_knowledge)
+            # Knowledge-base answers formatted and encoded once; requests only splice in their own fields
+            self.precompiled_answers = [PrecompiledAnswer(self.router.response(position))
+                                        for position in range(len(self.router.rules))]
+        
+        # Metadata of every ingested document; user uploads are also chunked once and the chunks indexed
+        self.documents = DocumentTable()
+        self.chunks = ChunkTable(Config.CHUNK_SIZE, Config.CHUNK_OVERLAP)
+        self.chunk_index = InvertedIndex()
+        self._index_lock = threading.Lock()
+        
+        # Dense retrieval over the same chunks, queried before the keyword index, and an
+        # extractive model reading answer spans out of the top retrieved chunks; both are
+        # slow to load, so load_models attaches them once the corpus is loaded
+        self.dense_index: Optional[DenseIndex] = None
+        self.reader = reader
+        self._embedder = embedder
+        
+        # Answers keyed on the normalized question; uploads invalidate corpus-dependent ones
+        self.answer_cache = answer_cache if answer_cache is not None else create_answer_cache()
+        
+        # MinHash signatures of the indexed chunks, so near-duplicate uploads are dropped
+        self.deduplicator = create_deduplicator()
+        self.dedup_stats = {"documents": 0, "exact_duplicate_documents": 0, "near_duplicate_documents": 0,
+                            "chunks": 0, "near_duplicate_chunks": 0}
+        self._dedup_lock = threading.Lock()
+        
+        # Segment files shared read-only by every worker process on the host, and the documents
+        # evicted from them by any worker
+        self.segments = self._open_segments()
+        self._tombstones: Set[int] = set()
+        if self.segments is not None:
+            self.chunks = SegmentedChunks()
+        
+        # (entity, section) -> sentences of uploaded documents, so "side effects of X" is one lookup
+        self.entity_index = create_entity_index(self.medical_knowledge)
+        
+        # Upload-dependent answers keyed on canonical question terms, reused by paraphrases
+        self.semantic_cache = create_semantic_cache(self.entity_index.matcher if self.entity_index is not None else None)
+        
+        # Memory of each uploaded document and the retention policies evicting them
+        self.corpus = create_corpus_manager()
+        
+        with startup.stages.track("corpus"):
+            # Documents, chunks and postings persisted across restarts; content hashes skip re-sent uploads
+            self.document_store = document_store if document_store is not None else create_document_store()
+            self._document_hashes = set()
+            if self.document_store is not None:
+                self._restore_from_store()
+            if self.segments is not None:
+                with self._index_lock:
+                    self._attach_new_segments()
+            
+            # Load documents from file
+            self.load_sample_documents(self._read_sample_documents())
+            
+            # Limits may have been lowered since the last run
+            self.enforce_retention()
+            self.corpus.start_periodic(self.enforce_retention)
+        
+        if load_models:
+            self.load_models()
         
         logger.info("Enhanced Medical QA initialized with comprehensive knowledge base")
     
-    def load_sample_documents(self):
-        """Load additional medical documents from the sample file"""
+    def load_models(self):
+        """Load dense retrieval and the extractive reader, then start using them
+        
+        Until each is loaded, questions are answered by keyword search and
+        from the retrieved passages.
+        """
+        with startup.stages.track("dense_index"):
+            dense_index = self._create_dense_index(self._embedder)
+            if dense_index is not None:
+                self._attach_dense_index(dense_index)
+            else:
+                startup.stages.mark("dense_index", "disabled")
+        
+        with startup.stages.track("reader"):
+            if self.reader is None:
+                self.reader = create_reader()
+            if self.reader is None:
+                startup.stages.mark("reader", "disabled")
+    
+    def _read_sample_documents(self) -> str:
+        """Return the text of the sample document file, or an empty string if there is none"""
+        docs_path = os.path.join(os.path.dirname(__file__), "sample_medical_documents.txt")
+        try:
+            with open(docs_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return ""
+    
+    def load_sample_documents(self, content: str):
+        """Load additional medical documents from the sample file's text"""
         try:
-            docs_path = os.path.join(os.path.dirname(__file__), "sample_medical_documents.txt")
+            # Parse and add to knowledge base
+            sections = content.split('===')
+            for section in sections:
+                section = section.strip()
+                if section and len(section) > 100:
+                    # Extract key medical information and add to knowledge base (not user upload)
+                    self._extract_medical_info(section, is_user_upload=False)
             
-            if os.path.exists(docs_path):
-                with open(docs_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                # Parse and add to knowledge base
-                sections = content.split('===')
-                for section in sections:
-                    section = section.strip()
-                    if section and len(section) > 100:
-                        # Extract key medical information and add to knowledge base (not user upload)
-                        self._extract_medical_info(section, is_user_upload=False)
-                
+            if content:
                 logger.info("Loaded additional medical information from sample documents")
             
         except Exception as e:
             logger.warning(f"Could not load sample documents: {e}")
     
-    def _extract_medical_info(self, text: str, is_user_upload: bool = False):
+    def _extract_medical_info(self, text: str, is_user_upload: bool = False) -> int:
         """Extract medical information from text and add to knowledge base"""
-        # Store uploaded documents in separate collections
-        if not hasattr(self, 'uploaded_documents'):
-            self.uploaded_documents = []
-        if not hasattr(self, 'user_uploaded_documents'):
-            self.user_uploaded_documents = []
-        
-        # Add the full text to appropriate collection
-        document_info = {
-            "text": text,
-            "upload_time": time.time(),
-            "length": len(text),
-            "is_user_upload": is_user_upload
-        }
+        with profiler.maybe_profile("ingest"):
+            return self.ingest_stream([text], is_user_upload=is_user_upload)
+    
+    def _restore_from_store(self):
+        """Reload documents, chunk arrays and postings saved by earlier runs"""
+        start_time = time.time()
+        evicted = set()
+        for record in self.document_store.iter_documents():
+            self.documents.append(record)
+            if record.evicted:
+                evicted.add(record.document_id)
+            else:
+                self._document_hashes.add(record.content_hash)
         
-        self.uploaded_documents.append(document_info)
+        # With shared segments the chunks and postings live in the segment files
+        if self.segments is None:
+            self._restore_chunks(evicted)
         
-        # Also add to user uploads if it's from a user
-        if is_user_upload:
-            self.user_uploaded_documents.append(document_info)
-
-        text_lower = text.lower()
+        self._update_corpus_gauges()
+        logger.info(f"Restored {len(self.documents)} documents and {len(self.chunks)} chunks "
+                    f"from the document store in {time.time() - start_time:.3f}s")
+    
+    def _restore_chunks(self, evicted: Set[int]):
+        """Reload chunk arrays and postings from the document store
+        
+        Chunks of evicted documents keep their IDs but are removed from the
+        indexes again.
+        """
+        parts = []
+        for prepared, signatures, entities in self.document_store.iter_parts():
+            chunk_ids = self.chunks.add_prepared(prepared)
+            parts.append((prepared.document_id, len(prepared.text), len(prepared.offsets), chunk_ids))
+            if prepared.document_id not in evicted:
+                self._add_signatures(chunk_ids, np.frombuffer(signatures, dtype=np.uint32))
+                if self.entity_index is not None:
+                    sentence_base = self.chunks.document_sentence_base[-1]
+                    self.entity_index.add((entity, section, sentence_base + sentence, chunk_ids.start + chunk)
+                                          for entity, section, sentence, chunk in entities)
+        for index_batch in self.document_store.iter_index_batches():
+            self.chunk_index.commit(index_batch)
+        
+        if len(self.chunk_index) != len(self.chunks):
+            logger.warning("Stored keyword index does not match stored chunks, re-indexing")
+            self.chunk_index = InvertedIndex()
+            for chunk_id in range(len(self.chunks)):
+                self.chunk_index.add(tokenize(self.chunks.chunk_text(chunk_id)))
+        
+        evicted_chunks = [chunk_id for document_id, _, _, chunk_ids in parts if document_id in evicted
+                          for chunk_id in chunk_ids]
+        if evicted_chunks:
+            self.chunk_index.remove(evicted_chunks)
+        for document_id, characters, sentences, chunk_ids in parts:
+            if document_id not in evicted:
+                tokens = sum(self.chunk_index.passage_length(chunk_id) for chunk_id in chunk_ids)
+                self._account_part(document_id, characters, sentences, len(chunk_ids), tokens)
+    
+    def _account_part(self, document_id: int, characters: int, sentences: int, chunks: int, tokens: int):
+        """Add the estimated memory of a committed part to its document"""
+        signature_size = self.deduplicator.num_perm if self.deduplicator is not None else 0
+        self.corpus.account(self.documents, document_id,
+                            self.corpus.part_bytes(characters, sentences, chunks, tokens, signature_size))
+    
+    def _add_signatures(self, chunk_ids: range, stored: np.ndarray):
+        """Index the stored MinHash signatures of committed chunks
+        
+        Signatures are only computed from the chunk text if none of the
+        configured size were stored, i.e. near-duplicate detection was
+        disabled or reconfigured since the chunks were written.
+        """
+        if self.deduplicator is None or not len(chunk_ids):
+            return
+        if stored.size == len(chunk_ids) * self.deduplicator.num_perm:
+            self.deduplicator.add_many(chunk_ids.start, stored.reshape(len(chunk_ids), -1))
+        else:
+            self.deduplicator.add_many(chunk_ids.start, [self.deduplicator.signature(
+                tokenize(self.chunks.chunk_text(chunk_id))) for chunk_id in chunk_ids])
+    
+    def ingest_stream(self, pieces: Iterable[str], is_user_upload: bool = True,
+                      collection: str = Config.DEFAULT_COLLECTION) -> int:
+        """Ingest one document arriving as a stream of text pieces and return its length"""
+        return self.ingest_documents([pieces], is_user_upload=is_user_upload, collection=collection)[1]
+    
+    def ingest_documents(self, documents: Iterable[Iterable[str]], is_user_upload: bool = True,
+                         job: Optional[IngestionJob] = None,
+                         collection: str = Config.DEFAULT_COLLECTION) -> Tuple[int, int]:
+        """Ingest a stream of documents and return (document count, characters)
+        
+        Each document is regrouped into bounded parts at sentence boundaries,
+        and each part is chunked and tokenized into a staged batch without
+        holding the index lock. A batch is committed once it reaches
+        INGEST_COMMIT_SIZE characters, and all of its chunks become
+        searchable at the same moment. Documents whose content hash was
+        already ingested are skipped, as are documents whose chunks are
+        almost all near-duplicates of indexed ones. Documents are added to
+        ``collection``, which retention quotas apply to.
+        """
+        batch = IngestBatch()
+        document_count = 0
+        characters = 0
+        
+        try:
+            for pieces in documents:
+                document_info = DocumentRecord(time.time(), is_user_upload, collection=collection)
+                digest = hashlib.sha256()
+                mark = batch.mark()
+                committed_early = False
+                chunk_count = duplicate_chunks = 0
+                document_bytes = 0
+                for part in iter_document_parts(pieces, Config.INGEST_PART_SIZE):
+                    document_info.length += len(part)
+                    document_info.parts += 1
+                    encoded = part.encode('utf-8')
+                    document_bytes += len(encoded)
+                    digest.update(encoded)
+                    if is_user_upload:
+                        part_chunks, part_duplicates = self._stage_part(batch, part, document_info.document_id)
+                        chunk_count += part_chunks
+                        duplicate_chunks += part_duplicates
+                    characters += len(part)
+                    if job is not None:
+                        job.characters_processed = characters
+                    # Very large documents are committed part by part
+                    if batch.characters >= Config.INGEST_COMMIT_SIZE:
+                        self._commit_batch(batch, job)
+                        batch = IngestBatch()
+                        committed_early = True
+                
+                document_count += 1
+                if job is not None:
+                    job.documents_processed = document_count
+                
+                # A re-sent document is dropped unless its parts were already committed; documents
+                # committed by other worker processes are only known to the shared store
+                document_info.content_hash = digest.hexdigest()
+                stored = self.document_store is not None and self.document_store.has_document(
+                    document_info.content_hash)
+                with self._index_lock:
+                    duplicate = stored or document_info.content_hash in self._document_hashes
+                    self._document_hashes.add(document_info.content_hash)
+                # Only uploads count; the sample documents are re-read on every start
+                if is_user_upload:
+                    self._count_duplicates(documents=1, chunks=chunk_count, near_duplicate_chunks=duplicate_chunks)
+                    metrics.NEAR_DUPLICATE_CHUNKS.inc(duplicate_chunks)
+                near_duplicate = chunk_count > 0 and duplicate_chunks >= Config.NEAR_DUPLICATE_DOCUMENT_RATIO * chunk_count
+                if (duplicate or near_duplicate) and not committed_early:
+                    batch.rollback(mark)
+                    if job is not None:
+                        job.documents_skipped += 1
+                    if duplicate:
+                        if is_user_upload:
+                            self._count_duplicates(exact_duplicate_documents=1)
+                            metrics.EXACT_DUPLICATE_DOCUMENTS.inc()
+                        logger.info(f"Skipped already ingested document with {document_info.length} characters")
+                    else:
+                        self._count_duplicates(near_duplicate_documents=1)
+                        metrics.NEAR_DUPLICATE_DOCUMENTS.inc()
+                        logger.info(f"Skipped near-duplicate document with {document_info.length} characters "
+                                    f"({duplicate_chunks} of {chunk_count} chunks already indexed)")
+                    continue
+                
+                batch.document_infos.append(document_info)
+                metrics.INGESTED_DOCUMENTS.inc()
+                metrics.INGESTED_BYTES.inc(document_bytes)
+                logger.info(f"Processed medical document with {document_info.length} characters (user_upload: {is_user_upload})")
+                
+                if batch.characters >= Config.INGEST_COMMIT_SIZE:
+                    self._commit_batch(batch, job)
+                    batch = IngestBatch()
+        finally:
+            # Parts staged before a failure are still committed and recorded
+            self._commit_batch(batch, job)
+        
+        return document_count, characters
+    
+    def _create_dense_index(self, embedder=None) -> Optional[DenseIndex]:
+        """Create the dense retrieval backend, or None if it is disabled or unavailable"""
+        if embedder is None and not Config.DENSE_RETRIEVAL_ENABLED:
+            return None
+        
+        try:
+            if embedder is None:
+                embedder = create_embedder(Config.EMBEDDING_BACKEND)
+            return DenseIndex(embedder, Config.FAISS_INDEX_PATH)
+        except Exception as e:
+            logger.warning(f"Dense retrieval disabled: {e}")
+            return None
+    
+    def _open_segments(self) -> Optional[SegmentManifest]:
+        """Open the shared segment directory, or return None if segments are disabled"""
+        if not Config.SEGMENTS_ENABLED:
+            return None
+        try:
+            return SegmentManifest(Config.SEGMENTS_DIR)
+        except OSError as e:
+            logger.warning(f"Shared segments disabled: {e}")
+            return None
+    
+    def _attach_dense_index(self, dense_index: DenseIndex):
+        """Add the chunks committed so far to a newly loaded dense index, then start using it
         
-        # Extract and enhance existing knowledge based on uploaded content
-        # Look for specific medical terms and enhance our knowledge base
+        Vectors of unchanged chunks come from the persisted index or the
+        segment files. Chunks committed meanwhile are picked up by another
+        pass; the final, empty pass runs under the index lock.
+        """
+        done = 0
+        while True:
+            with self._index_lock:
+                total = len(self.chunks)
+                if total == done:
+                    self.dense_index = dense_index
+                    break
+                new_segments = []
+                if self.segments is not None:
+                    new_segments = [segment for segment in self.chunks.segments
+                                    if segment.chunk_base + len(segment) > done]
+            
+            precomputed = {}
+            for segment in new_segments:
+                keys, vectors = segment.vectors()
+                precomputed.update(zip(keys.tolist(), vectors))
+            # Chunks of evicted documents read back empty and are not embedded
+            texts = [(chunk_id, self.chunks.chunk_text(chunk_id)) for chunk_id in range(done, total)]
+            texts = [(chunk_id, text) for chunk_id, text in texts if text]
+            dense_index.add([chunk_id for chunk_id, _ in texts], [text for _, text in texts], precomputed)
+            done = total
         
-        # Aspirin information
-        if 'aspirin' in text_lower:
-            if any(term in text_lower for term in ['side effect', 'adverse', 'reaction']):
-                # Extract aspirin side effects from text if found
-                lines = text.split('\n')
-                for line in lines:
-                    if 'aspirin' in line.lower() and any(term in line.lower() for term in ['side effect', 'adverse', 'reaction']):
-                        # This line might contain aspirin side effect information
-                        pass
+        # Vectors persisted for chunks that no longer exist are dropped before the first save
+        dense_index.maybe_compact()
+        if done:
+            dense_index.save()
+        dense_index.start_periodic_save()
+        self._update_corpus_gauges()
+    
+    def _refresh_segments(self):
+        """Attach segments committed by other worker processes since the last check"""
+        if self.segments is not None and self.segments.changed():
+            with self._index_lock:
+                self._attach_new_segments()
+    
+    def _attach_new_segments(self):
+        """Map every segment in the manifest not attached yet and drop newly tombstoned documents
         
-        # Diabetes information
-        if 'diabetes' in text_lower:
-            if any(term in text_lower for term in ['symptom', 'sign']):
-                # Extract diabetes symptoms from text if found
-                pass
+        Segments merged by any worker replace the ones they were merged from.
+        Merged files keep every chunk and sentence ID, so only the chunk table
+        and keyword index are rebuilt over them, which unmaps the old files.
+        The index lock must be held.
+        """
+        attached = self.chunks.segments
+        segments, tombstones = self.segments.load({segment.path.name: segment for segment in attached})
+        indexed = len(self.chunks)
+        mapped = [segment for segment in segments if segment.chunk_base < indexed]
+        if [segment.path.name for segment in mapped] != [segment.path.name for segment in attached]:
+            chunks = SegmentedChunks()
+            chunk_index = InvertedIndex()
+            for segment in mapped:
+                chunks.attach(segment)
+                chunk_index.attach(segment.lengths, segment.iter_postings())
+            parts, chunk_ids = chunks.owned_chunks(self._tombstones)
+            chunks.drop_documents(parts)
+            chunk_index.remove(chunk_ids.tolist())
+            self.chunks, self.chunk_index = chunks, chunk_index
+            if len(chunks) > indexed:
+                # The last merge took in segments this worker had not attached yet
+                self._index_segment(mapped[-1], chunks.num_sentences - mapped[-1].num_sentences, indexed)
+            logger.info(f"Switched to {len(mapped)} merged corpus segments")
         
-        # Store key information for later retrieval
-        logger.info(f"Processed medical document with {len(text)} characters (user_upload: {is_user_upload})")
+        new_segments = segments[len(mapped):]
+        for segment in new_segments:
+            self.chunks.attach(segment)
+            self._index_segment(segment, self.chunks.num_sentences - segment.num_sentences, segment.chunk_base)
+            self.chunk_index.attach(segment.lengths, segment.iter_postings())
+        
+        evicted = [document_id for document_id in tombstones if document_id not in self._tombstones]
+        if evicted:
+            self._drop_documents(*self.chunks.owned_chunks(evicted))
+            for document_id in evicted:
+                position = self.documents.position(document_id)
+                if position is not None and not self.documents.evicted[position]:
+                    self._document_hashes.discard(self.documents[position].content_hash)
+                    self.documents.mark_evicted(position)
+            self._tombstones.update(evicted)
+            logger.info(f"Dropped {len(evicted)} documents evicted by other workers")
+        
+        if len(self.chunks) > indexed or evicted:
+            self._invalidate_answers()
+            self._update_corpus_gauges()
+        if len(self.chunks) > indexed:
+            logger.info(f"Attached {len(new_segments)} corpus segments ({len(self.chunks)} chunks)")
+    
+    def _index_segment(self, segment: Segment, sentence_base: int, first_chunk: int):
+        """Add the signatures, entities and vectors a segment stores for its chunks from ``first_chunk`` on
+        
+        Also accounts the memory of the parts holding them, loading the
+        records of documents committed by other workers from the store.
+        """
+        chunk_ids = range(first_chunk, segment.chunk_base + len(segment))
+        self._account_segment(segment, first_chunk)
+        self._add_signatures(chunk_ids, segment.signatures()[first_chunk - segment.chunk_base:])
+        if self.entity_index is not None:
+            self.entity_index.add((entity, section, sentence_base + sentence, chunk_id)
+                                  for entity, section, sentence, chunk_id in segment.iter_entities()
+                                  if chunk_id >= first_chunk)
+        if self.dense_index is not None and len(chunk_ids):
+            # Vectors embedded by the writing worker are reused, not recomputed
+            keys, vectors = segment.vectors()
+            self.dense_index.add(chunk_ids, [self.chunks.chunk_text(chunk_id) for chunk_id in chunk_ids],
+                                 dict(zip(keys.tolist(), vectors)))
+    
+    def _append_segment(self, batch: IngestBatch, dense_prepared):
+        """Write a staged batch as a new shared segment and attach it; the index lock must be held"""
+        vector_keys, vectors = (), None
+        if dense_prepared is not None and dense_prepared[2] is not None:
+            vector_keys, vectors = dense_prepared[1], dense_prepared[2]
+        
+        with self.segments.lock():
+            # Segments written by other workers take the chunk IDs before this one
+            self._attach_new_segments()
+            self.segments.append(len(self.chunks), batch.documents, batch.index_batch, vector_keys, vectors,
+                                 batch.signatures, batch.entities)
+        self._attach_new_segments()
+    
+    def _account_segment(self, segment: Segment, first_chunk: int):
+        """Add the memory of a segment's parts from the one starting at ``first_chunk`` on to their documents"""
+        first_part = int(np.searchsorted(segment.part_first_chunk, first_chunk - segment.chunk_base))
+        owners = segment.part_owners[first_part:].tolist()
+        unknown = [owner for owner in set(owners) if self.documents.position(owner) is None]
+        if unknown and self.document_store is not None:
+            for record in self.document_store.load_documents(unknown):
+                self.corpus.document_added(self.documents, self.documents.append(record))
+        
+        offsets = np.frombuffer(segment.sentence_offsets, dtype=np.uint32)
+        lengths = np.frombuffer(segment.lengths, dtype=np.uint32)
+        first_sentences = np.append(segment.part_first_sentence, segment.num_sentences)
+        first_chunks = np.append(segment.part_first_chunk, len(segment))
+        for part, owner in enumerate(owners, first_part):
+            sentences = slice(first_sentences[part], first_sentences[part + 1])
+            chunks = slice(first_chunks[part], first_chunks[part + 1])
+            self._account_part(owner, int(offsets[sentences.stop] - offsets[sentences.start]),
+                               sentences.stop - sentences.start, chunks.stop - chunks.start,
+                               int(lengths[chunks].sum()))
+    
+    def _merge_segments(self):
+        """Merge runs of similar-sized shared segments, then switch to the merged files"""
+        with self.segments.lock():
+            merges = self.segments.merge(Config.SEGMENT_MERGE_FACTOR)
+        for merged, name in merges:
+            logger.info(f"Merged {len(merged)} corpus segments into {name}")
+        if merges:
+            with self._index_lock:
+                self._attach_new_segments()
+    
+    def _stage_part(self, batch: IngestBatch, text: str, document_id: int) -> Tuple[int, int]:
+        """Chunk and tokenize a user upload part into a staged batch
+        
+        Chunks that are near-duplicates of an indexed or already staged chunk
+        are dropped. Returns the number of chunks and how many were dropped.
+        """
+        prepared = prepare_document(text, Config.CHUNK_SIZE, Config.CHUNK_OVERLAP)._replace(document_id=document_id)
+        first_staged_chunk = len(batch.chunk_texts)
+        kept_chunks = []
+        for chunk, chunk_text in zip(prepared.chunks, prepared.chunk_texts()):
+            tokens = tokenize(chunk_text)
+            if self.deduplicator is not None:
+                signature = self.deduplicator.signature(tokens)
+                if self._is_near_duplicate(batch, signature):
+                    continue
+                batch.near_duplicates.add(len(batch.signatures), signature)
+                batch.signatures.append(signature)
+            batch.index_batch.add(tokens)
+            batch.chunk_texts.append(chunk_text)
+            kept_chunks.append(chunk)
+        
+        if kept_chunks:
+            if self.entity_index is not None:
+                self._stage_entities(batch, prepared, kept_chunks, first_staged_chunk)
+            batch.documents.append(prepared if len(kept_chunks) == len(prepared.chunks)
+                                   else prepared._replace(chunks=kept_chunks))
+        batch.characters += len(text)
+        return len(prepared.chunks), len(prepared.chunks) - len(kept_chunks)
+    
+    def _stage_entities(self, batch: IngestBatch, prepared, kept_chunks: List[Tuple[int, int]],
+                        first_staged_chunk: int):
+        """Recognize the entities of a staged part, each assigned to the first kept chunk holding its sentence"""
+        text, offsets = prepared.text, prepared.offsets
+        chunk_ends = [end for _, end in kept_chunks]
+        part = len(batch.documents)
+        for entity, section, sentence in self.entity_index.matcher.extract(
+                (sentence, text[offsets[sentence]:offsets[sentence + 1]]) for sentence in range(len(offsets) - 1)):
+            chunk = bisect.bisect_right(chunk_ends, sentence)
+            if chunk < len(kept_chunks) and kept_chunks[chunk][0] <= sentence:
+                batch.entities.append((entity, section, part, sentence, first_staged_chunk + chunk))
+    
+    def _is_near_duplicate(self, batch: IngestBatch, signature) -> bool:
+        """Check a chunk signature against the indexed chunks and those staged in ``batch``"""
+        if batch.near_duplicates is None:
+            batch.near_duplicates = MinHashLSH(self.deduplicator.num_perm, self.deduplicator.bands,
+                                               self.deduplicator.threshold)
+        return self.deduplicator.find(signature) is not None or batch.near_duplicates.find(signature) is not None
+    
+    def _commit_batch(self, batch: IngestBatch, job: Optional[IngestionJob] = None):
+        """Append a staged batch to the chunk table and indexes, making it searchable at once"""
+        if not batch.documents and not batch.document_infos:
+            return
+        start_time = time.perf_counter()
+        
+        # Embedding is the slow step, so it also happens before taking the lock
+        dense_prepared = None
+        if self.dense_index is not None and batch.chunk_texts:
+            dense_prepared = self.dense_index.prepare(batch.chunk_texts)
+        
+        with self._index_lock:
+            # The dense index may have been attached since the check above
+            if dense_prepared is None and self.dense_index is not None and batch.chunk_texts:
+                dense_prepared = self.dense_index.prepare(batch.chunk_texts)
+            
+            # Persisting under the lock keeps the stored batches in commit order
+            if self.document_store is not None:
+                if self.segments is not None:
+                    self.document_store.save_batch(batch.document_infos, (), IndexBatch())
+                else:
+                    self.document_store.save_batch(batch.document_infos, batch.documents, batch.index_batch,
+                                                   batch.signatures, batch.entities)
+            
+            # Records come first, so the memory of their parts is added to them directly
+            for document_info in batch.document_infos:
+                self.corpus.document_added(self.documents, self.documents.append(document_info))
+            
+            if self.segments is not None:
+                if batch.documents:
+                    self._append_segment(batch, dense_prepared)
+            else:
+                first_chunk = len(self.chunks)
+                first_part = len(self.chunks.document_sentence_base)
+                for prepared in batch.documents:
+                    chunk_ids = self.chunks.add_prepared(prepared)
+                    lengths = batch.index_batch.lengths[chunk_ids.start - first_chunk:chunk_ids.stop - first_chunk]
+                    self._account_part(prepared.document_id, len(prepared.text), len(prepared.offsets),
+                                       len(chunk_ids), sum(lengths))
+                if self.deduplicator is not None:
+                    self.deduplicator.add_many(first_chunk, batch.signatures)
+                if self.entity_index is not None:
+                    sentence_bases = self.chunks.document_sentence_base
+                    self.entity_index.add((entity, section, sentence_bases[first_part + part] + sentence,
+                                           first_chunk + chunk)
+                                          for entity, section, part, sentence, chunk in batch.entities)
+                if dense_prepared is not None:
+                    self.dense_index.add_prepared(range(first_chunk, len(self.chunks)), dense_prepared)
+                # Publishing the keyword index watermark is what makes the batch visible
+                self.chunk_index.commit(batch.index_batch)
+        
+        if batch.documents:
+            self._invalidate_answers()
+            if self.segments is not None:
+                self._merge_segments()
+        if job is not None:
+            job.documents_committed += len(batch.document_infos)
+            job.save()
+        metrics.INGEST_COMMIT_SECONDS.observe(time.perf_counter() - start_time)
+        self._update_corpus_gauges()
+        if batch.document_infos:
+            self.enforce_retention()
+    
+    def enforce_retention(self) -> int:
+        """Evict the documents selected by the retention policies and return how many were evicted"""
+        if not self.corpus.enabled:
+            return 0
+        with self._index_lock:
+            selected = self.corpus.select_evictions(self.documents)
+            if not selected:
+                return 0
+            archived = self._evict_documents(selected)
+        
+        self.corpus.archive(archived)
+        self._invalidate_answers()
+        if self.dense_index is not None:
+            self.dense_index.maybe_compact()
+        self._update_corpus_gauges()
+        return len(selected)
+    
+    def _evict_documents(self, selected: List[Tuple[int, str]]) -> List[Tuple[DocumentRecord, str, str]]:
+        """Drop documents from the chunk table and every index; the index lock must be held
+        
+        Returns the evicted records with their reason, and their text if
+        evicted documents are archived.
+        """
+        owners = [self.documents.document_id(position) for position, _ in selected]
+        parts, chunk_ids = self.chunks.owned_chunks(owners)
+        
+        archived = []
+        if self.corpus.archive_path is not None:
+            texts: Dict[int, List[str]] = {}
+            for part in parts:
+                texts.setdefault(self.chunks.document_owner[part], []).append(self.chunks.document_text(part))
+            archived = [(self.documents[position], reason, "".join(texts.get(owner, [])))
+                        for (position, reason), owner in zip(selected, owners)]
+        
+        chunk_ids, released = self._drop_documents(parts, chunk_ids)
+        if self.segments is not None:
+            # Other workers drop them on their next refresh, and merges leave out their text
+            with self.segments.lock():
+                self.segments.add_tombstones(owners)
+            self._tombstones.update(owners)
+        
+        for position, reason in selected:
+            # An evicted document may be uploaded again
+            self._document_hashes.discard(self.documents[position].content_hash)
+            self.documents.mark_evicted(position)
+            self.corpus.evictions[reason] += 1
+            metrics.EVICTED_DOCUMENTS[reason].inc()
+        if self.document_store is not None:
+            self.document_store.mark_evicted(owners, time.time())
+        logger.info(f"Evicted {len(selected)} documents ({len(chunk_ids)} chunks, {released} bytes of text) "
+                    f"by retention policy: {dict(Counter(reason for _, reason in selected))}")
+        return archived
+    
+    def _drop_documents(self, parts: List[int], chunk_ids: np.ndarray) -> Tuple[List[int], int]:
+        """Drop chunk table parts and their chunks from every index; the index lock must be held
+        
+        Returns the chunk IDs as a list and the bytes of text released.
+        """
+        chunk_ids = chunk_ids.tolist()
+        if self.dense_index is not None:
+            self.dense_index.remove(chunk_ids, [self.chunks.chunk_text(chunk_id) for chunk_id in chunk_ids])
+        self.chunk_index.remove(chunk_ids)
+        if self.deduplicator is not None:
+            self.deduplicator.remove(chunk_ids)
+        if self.entity_index is not None:
+            self.entity_index.remove(chunk_ids)
+        return chunk_ids, self.chunks.drop_documents(parts)
+    
+    def memory_stats(self) -> Dict:
+        """Estimated corpus memory, retention limits and evictions of this process"""
+        stats = self.corpus.stats(self.documents)
+        stats["chunk_table_bytes"] = self.chunks.memory_bytes()
+        stats["dense_index_bytes"] = (len(self.dense_index) * self.dense_index.embedder.dimension * 4
+                                      if self.dense_index is not None else 0)
+        return stats
+    
+    def _count_duplicates(self, **counts: int):
+        """Add to the duplicate counts, which several ingestion threads update at once"""
+        with self._dedup_lock:
+            for name, count in counts.items():
+                self.dedup_stats[name] += count
+    
+    def deduplication_stats(self) -> Dict:
+        """Duplicate counts of the documents uploaded to this process"""
+        with self._dedup_lock:
+            stats = dict(self.dedup_stats)
+        skipped = stats["exact_duplicate_documents"] + stats["near_duplicate_documents"]
+        stats["document_dedup_ratio"] = round(skipped / stats["documents"], 4) if stats["documents"] else 0.0
+        stats["chunk_dedup_ratio"] = round(stats["near_duplicate_chunks"] / stats["chunks"], 4) if stats["chunks"] else 0.0
+        stats["near_dedup_enabled"] = self.deduplicator is not None
+        stats["indexed_signatures"] = len(self.deduplicator) if self.deduplicator is not None else 0
+        return stats
+    
+    def _update_corpus_gauges(self):
+        metrics.CORPUS_DOCUMENTS.set(len(self.documents))
+        metrics.CORPUS_CHUNKS.set(len(self.chunks))
+        if self.dense_index is not None:
+            metrics.DENSE_VECTORS.set(len(self.dense_index))
+        if self.corpus.enabled:
+            metrics.CORPUS_MEMORY_BYTES.set(sum(self.documents.memory))
+    
+    def _assemble_passages(self, chunk_ids: List[int], query_terms: List[str]) -> List[str]:
+        """Collect the distinct sentences of ranked chunks that mention a query term"""
+        return list(self._iter_passages(chunk_ids, query_terms))
+    
+    def _iter_passages(self, chunk_ids: List[int], query_terms: List[str]) -> Iterator[str]:
+        """Yield up to TOP_K_RETRIEVAL distinct sentences of ranked chunks that mention a query term"""
+        pattern = term_pattern(query_terms)
+        if pattern is None:
+            return
+        seen_sentences = set()
+        for chunk_id in chunk_ids:
+            # Overlapping chunks and duplicated documents repeat the same sentence
+            for key, sentence in self.chunks.matching_sentences(chunk_id, pattern):
+                if key in seen_sentences:
+                    continue
+                seen_sentences.add(key)
+                yield sentence
+                if len(seen_sentences) >= Config.TOP_K_RETRIEVAL:
+                    return
+    
+    def search_dense_index(self, query: str) -> str:
+        """Search user uploaded documents by embedding similarity"""
+        self._refresh_segments()
+        return self._search_dense_many([query], [tokenize(query)])[0][0]
     
     def search_uploaded_documents(self, query: str) -> str:
         """Search through user uploaded documents for relevant information"""
-        if not hasattr(self, 'user_uploaded_documents') or not self.user_uploaded_documents:
-            return ""
+        self._refresh_segments()
+        return self._search_keyword_many([tokenize(query)])[0][0]
+    
+    def _search_dense_many(self, queries: List[str], query_terms: List[List[str]]) -> List[Tuple[str, List[int]]]:
+        """Embed queries as one batch and assemble passages from their top dense hits
         
-        query_lower = query.lower()
-        relevant_passages = []
+        Returns the passages and the ranked chunk IDs of each query.
+        """
+        if self.dense_index is None:
+            return [("", [])] * len(queries)
         
-        for doc in self.user_uploaded_documents:
-            text = doc['text']
-            text_lower = text.lower()
+        results = []
+        for terms, hits in zip(query_terms, self.dense_index.search_many(queries, k=Config.TOP_K_RETRIEVAL)):
+            chunk_ids = self._dense_chunks(hits)
+            if not chunk_ids:
+                results.append(("", []))
+                continue
             
-            # Simple keyword matching in uploaded documents
-            if any(word in text_lower for word in query_lower.split()):
-                # Find relevant sentences or paragraphs
-                sentences = text.split('. ')
-                for sentence in sentences:
-                    if any(word in sentence.lower() for word in query_lower.split()):
-                        relevant_passages.append(sentence.strip())
-                        if len(relevant_passages) >= 5:  # Limit to 5 relevant passages
-                            break
-        
-        return '. '.join(relevant_passages) if relevant_passages else ""
-    
-    def answer_question(self, question: str, context: str = None) -> Dict:
-        """Answer medical questions using pattern matching and knowledge base"""
-        question_lower = question.lower()
-        
-        # Pattern matching for common medical questions
-        if any(term in question_lower for term in ['side effect', 'adverse effect', 'reaction']):
-            if 'aspirin' in question_lower:
-                return {
-                    "answer": "Common side effects of aspirin include: " + ", ".join(self.medical_knowledge["aspirin"]["side_effects"]),
-                    "confidence": 0.95,
-                    "source": "Medical Knowledge Base",
-                    "category": "medication_side_effects"
-                }
-        
-        if any(term in question_lower for term in ['symptom', 'sign']):
-            if 'diabetes' in question_lower:
-                return {
-                    "answer": "Common symptoms of diabetes include: " + ", ".join(self.medical_knowledge["diabetes"]["symptoms"]),
-                    "confidence": 0.93,
-                    "source": "Medical Knowledge Base", 
-                    "category": "disease_symptoms"
-                }
-            elif 'pneumonia' in question_lower:
-                return {
-                    "answer": "Common symptoms of pneumonia include: " + ", ".join(self.medical_knowledge["pneumonia"]["symptoms"]),
-                    "confidence": 0.92,
-                    "source": "Medical Knowledge Base",
-                    "category": "disease_symptoms"
-                }
-        
-        if any(term in question_lower for term in ['risk factor', 'cause']):
-            if any(bp_term in question_lower for bp_term in ['hypertension', 'high blood pressure', 'blood pressure']):
-                return {
-                    "answer": "Risk factors for hypertension include: " + ", ".join(self.medical_knowledge["hypertension"]["risk_factors"]),
-                    "confidence": 0.94,
-                    "source": "Medical Knowledge Base",
-                    "category": "risk_factors"
-                }
-        
-        if any(term in question_lower for term in ['treatment', 'therapy', 'manage']):
-            if 'diabetes' in question_lower:
-                return {
-                    "answer": f"Diabetes management includes: {self.medical_knowledge['diabetes']['management']}",
-                    "confidence": 0.91,
-                    "source": "Medical Knowledge Base",
-                    "category": "treatment"
-                }
-            elif any(bp_term in question_lower for bp_term in ['hypertension', 'high blood pressure']):
-                return {
-                    "answer": f"Hypertension treatment includes: {self.medical_knowledge['hypertension']['treatment']}. Medications include: {self.medical_knowledge['hypertension']['medications']}",
-                    "confidence": 0.92,
-                    "source": "Medical Knowledge Base", 
-                    "category": "treatment"
-                }
-        
-        if any(term in question_lower for term in ['insulin', 'type']):
-            if 'insulin' in question_lower:
-                return {
-                    "answer": "Types of insulin include: " + "; ".join(self.medical_knowledge["insulin"]["types"]),
-                    "confidence": 0.90,
-                    "source": "Medical Knowledge Base",
-                    "category": "medication_types"
-                }
-        
-        # Generic medical responses for common questions
-        generic_responses = {
-            "what is diabetes": {
-                "answer": "Diabetes is a group of metabolic disorders characterized by high blood sugar levels. Type 1 is autoimmune, Type 2 involves insulin resistance.",
-                "confidence": 0.88
-            },
-            "what is hypertension": {
-                "answer": "Hypertension is high blood pressure consistently above 140/90 mmHg, a major risk factor for cardiovascular disease.",
-                "confidence": 0.87
-            },
-            "what is pneumonia": {
-                "answer": "Pneumonia is an infection that inflames air sacs in the lungs, which may fill with fluid or pus, caused by bacteria, viruses, or fungi.",
-                "confidence": 0.86
-            }
-        }
+            # Semantic matches may share no terms with the query; fall back to the best chunk
+            relevant_passages = self._assemble_passages(chunk_ids, terms)
+            passages = ' '.join(relevant_passages) if relevant_passages else self.chunks.chunk_text(chunk_ids[0])
+            results.append((passages, chunk_ids))
+        return results
+    
+    def _dense_chunks(self, hits: List[Tuple[int, float]]) -> List[int]:
+        """Return the chunk IDs of dense hits scoring at least DENSE_MIN_SCORE"""
+        # Chunks of a batch still being committed are not visible yet
+        visible = len(self.chunk_index)
+        return [chunk_id for chunk_id, score in hits if score >= Config.DENSE_MIN_SCORE and chunk_id < visible]
+    
+    def _search_keyword_many(self, query_terms: List[List[str]]) -> List[Tuple[str, List[int]]]:
+        """Rank chunks for tokenized queries with one shared BM25 postings lookup"""
+        results = []
+        for terms, hits in zip(query_terms, self.chunk_index.search_many(query_terms, k=Config.TOP_K_RETRIEVAL)):
+            # Matching sentences of each top chunk, in rank order
+            chunk_ids = [chunk_id for chunk_id, _ in hits]
+            relevant_passages = self._assemble_passages(chunk_ids, terms)
+            results.append((' '.join(relevant_passages), chunk_ids) if relevant_passages else ("", []))
+        return results
+    
+    def _search_uploaded_many(self, questions: List[str]) -> List[Tuple[str, List[int]]]:
+        """Search uploaded documents for several questions: entity index, then dense index, then keywords"""
+        query_terms = [tokenize(question) for question in questions]
+        answers = [self._lookup_entity(question) for question in questions]
+        
+        missing = [position for position, (passages, _) in enumerate(answers) if not passages]
+        if missing:
+            dense_answers = self._search_dense_many([questions[position] for position in missing],
+                                                    [query_terms[position] for position in missing])
+            for position, answer in zip(missing, dense_answers):
+                answers[position] = answer
+        
+        missing = [position for position, (passages, _) in enumerate(answers) if not passages]
+        if missing:
+            keyword_answers = self._search_keyword_many([query_terms[position] for position in missing])
+            for position, answer in zip(missing, keyword_answers):
+                answers[position] = answer
+        
+        self._record_hits(answers)
+        return answers
+    
+    def _iter_uploaded_passages(self, question: str, ranked_chunks: List[int]) -> Iterator[str]:
+        """Yield the passages answering a question from uploaded documents as each is found
+        
+        Searches like ``_search_uploaded_many``, one question at a time, and
+        fills ``ranked_chunks`` with the ranked chunk IDs of the search that
+        answered.
+        """
+        for sentence, chunk_id in self._iter_entity_passages(question):
+            if chunk_id not in ranked_chunks:
+                ranked_chunks.append(chunk_id)
+            yield sentence
+        if ranked_chunks:
+            return
         
-        # Check for generic matches
-        for key, response in generic_responses.items():
-            if key in question_lower:
-                response["source"] = "Medical Knowledge Base"
-                response["category"] = "general_information"
-                return response
+        terms = tokenize(question)
+        if self.dense_index is not None:
+            chunk_ids = self._dense_chunks(self.dense_index.search_many([question], k=Config.TOP_K_RETRIEVAL)[0])
+            if chunk_ids:
+                ranked_chunks.extend(chunk_ids)
+                found = False
+                for sentence in self._iter_passages(chunk_ids, terms):
+                    found = True
+                    yield sentence
+                if not found:
+                    yield self.chunks.chunk_text(chunk_ids[0])
+                return
+        
+        chunk_ids = [chunk_id for chunk_id, _ in self.chunk_index.search_many([terms], k=Config.TOP_K_RETRIEVAL)[0]]
+        for sentence in self._iter_passages(chunk_ids, terms):
+            if not ranked_chunks:
+                ranked_chunks.extend(chunk_ids)
+            yield sentence
+    
+    def _record_hits(self, answers: List[Tuple[str, List[int]]]):
+        """Count a retrieval hit for the documents of every answered search"""
+        if self.corpus.enabled:
+            chunk_document, owners = self.chunks.chunk_document, self.chunks.document_owner
+            self.corpus.record_hits(self.documents, {owners[chunk_document[chunk_id]]
+                                                     for passages, chunk_ids in answers if passages
+                                                     for chunk_id in chunk_ids})
+    
+    def _lookup_entity(self, question: str) -> Tuple[str, List[int]]:
+        """Answer "<section> of <entity>" questions from the entity index
+        
+        Returns the indexed sentences and their chunk IDs, or nothing if the
+        question names no indexed entity and section.
+        """
+        passages = []
+        ranked_chunks = []
+        for sentence, chunk_id in self._iter_entity_passages(question):
+            passages.append(sentence)
+            if chunk_id not in ranked_chunks:
+                ranked_chunks.append(chunk_id)
+        return (' '.join(passages), ranked_chunks) if passages else ("", [])
+    
+    def _iter_entity_passages(self, question: str) -> Iterator[Tuple[str, int]]:
+        """Yield up to TOP_K_RETRIEVAL distinct indexed sentences answering a question, with their chunk IDs"""
+        if self.entity_index is None:
+            return
+        parsed = self.entity_index.matcher.parse_question(question.lower())
+        if parsed is None:
+            return
+        
+        sentence_ids, chunk_ids = self.entity_index.lookup(*parsed)
+        # Sentences are ranked by the BM25 score of their chunk, most relevant first
+        scores = self.chunk_index.score(tokenize(question), set(chunk_ids))
+        entries = sorted((entry for entry in zip(sentence_ids, chunk_ids) if entry[1] in scores),
+                         key=lambda entry: -scores[entry[1]])
+        seen_sentences = set()
+        for sentence_id, chunk_id in entries:
+            # Evicted documents read back as empty text
+            sentence = self.chunks.sentence_text(sentence_id).strip()
+            if not sentence or sentence in seen_sentences:
+                continue
+            seen_sentences.add(sentence)
+            yield sentence, chunk_id
+            if len(seen_sentences) >= Config.TOP_K_RETRIEVAL:
+                return
+    
+    def _uploaded_responses(self, questions: List[str], found: List[Tuple[str, List[int]]]) -> Tuple[List[Dict], bool]:
+        """Build the responses to uploaded-document searches, reading answer spans if a reader is loaded
+        
+        Also returns False if the reader timed out or failed, so the passages
+        answered instead are not cached.
+        """
+        if self.reader is None:
+            return [self._uploaded_response(passages) for passages, _ in found], True
+        
+        positions = [position for position, (_, chunk_ids) in enumerate(found) if chunk_ids]
+        chunk_texts = [[self.chunks.chunk_text(chunk_id) for chunk_id in found[position][1][:Config.READER_TOP_CHUNKS]]
+                       for position in positions]
+        readings: List[Optional[ReaderAnswer]] = [None] * len(found)
+        read_from: List[Optional[str]] = [None] * len(found)
+        complete = True
+        if positions:
+            start_time = time.perf_counter()
+            try:
+                answers = self.reader.read_many([questions[position] for position in positions], chunk_texts)
+            except Exception as e:
+                # Answer with the retrieved passages rather than fail the request
+                logger.warning(f"Reader skipped: {e!r}")
+                answers = [None] * len(positions)
+                complete = False
+            metrics.STAGE_READER.observe(time.perf_counter() - start_time)
+            for position, texts, answer in zip(positions, chunk_texts, answers):
+                if answer is not None:
+                    readings[position] = answer
+                    read_from[position] = texts[answer.passage]
+        responses = [self._uploaded_response(passages, reading, context)
+                     for (passages, _), reading, context in zip(found, readings, read_from)]
+        return responses, complete
+    
+    def _uploaded_response(self, uploaded_info: str, reading: Optional[ReaderAnswer] = None,
+                           context: Optional[str] = None) -> Dict:
+        """Build the response for an uploaded-document answer, or the fallback if there is none
+        
+        A read span scoring at least MIN_CONFIDENCE_SCORE is the answer, with
+        its score as the confidence; below that the matching passages are
+        returned with the reader's score. Without a reader the confidence of
+        passages is fixed.
+        """
+        if reading is not None and reading.score >= Config.MIN_CONFIDENCE_SCORE:
+            return {
+                "answer": reading.text,
+                "confidence": round(reading.score, 4),
+                "source": "Uploaded Documents",
+                "category": "uploaded_content",
+                "context": context
+            }
         
-        # Search uploaded documents before fallback
-        uploaded_info = self.search_uploaded_documents(question)
         if uploaded_info:
             return {
                 "answer": uploaded_info,
-                "confidence": 0.85,
+                "confidence": round(reading.score, 4) if reading is not None else 0.85,
                 "source": "Uploaded Documents",
                 "category": "uploaded_content"
             }
@@ -305,17 +1050,212 @@ class EnhancedMedicalQA:
             "source": "Medical Knowledge Base",
             "category": "general_guidance"
         }
+    
+    def answer_question(self, question: str, context: str = None, routed: bool = False) -> Dict:
+        """Answer medical questions using pattern matching and knowledge base
+        
+        With ``routed``, the caller has already found that no knowledge-base
+        rule applies (see ``precompiled_answer``), so the question is not
+        routed again.
+        """
+        result = None
+        for _, result in self.stream_answer(question, context, routed):
+            pass
+        return result
+    
+    def stream_answer(self, question: str, context: Optional[str] = None,
+                      routed: bool = False) -> Iterator[Tuple[str, Any]]:
+        """Answer a question like ``answer_question``, yielding ("passage", text) as each passage is found
+        
+        Only answers searched from uploaded documents have passages; the
+        result is yielded last, as ("answer", result).
+        """
+        # Uploads committed by other workers invalidate cached answers first
+        self._refresh_segments()
+        result = self._cached_answer(question, context)
+        
+        if result is None and not routed:
+            # Single-pass match against the compiled knowledge-base rule table
+            result = self._route(question)
+            if result is not None:
+                self.answer_cache.set(question, context, result)
+        
+        if result is None:
+            # Paraphrases of an answered question reuse its answer; others search uploaded documents before fallback
+            generation = self.answer_cache.generation
+            result = self._similar_answer(question, context, generation)
+            if result is None:
+                # The time spent by the consumer between passages is not search time
+                search_time = 0.0
+                start_time = time.perf_counter()
+                passages = []
+                ranked_chunks: List[int] = []
+                for passage in self._iter_uploaded_passages(question, ranked_chunks):
+                    search_time += time.perf_counter() - start_time
+                    passages.append(passage)
+                    yield "passage", passage
+                    start_time = time.perf_counter()
+                found = [(' '.join(passages), ranked_chunks)]
+                self._record_hits(found)
+                metrics.STAGE_UPLOADED_SEARCH.observe(search_time + time.perf_counter() - start_time)
+                responses, complete = self._uploaded_responses([question], found)
+                result = responses[0]
+                if complete:
+                    self._cache_uploaded_answer(question, context, result, generation)
+        
+        metrics.count_answer(result)
+        yield "answer", result
+    
+    def _cached_answer(self, question: str, context: Optional[str]) -> Optional[Dict]:
+        """Look up the answer cache, counting hits and misses"""
+        cached = self.answer_cache.get(question, context)
+        (metrics.CACHE_MISSES if cached is None else metrics.CACHE_HITS).inc()
+        return cached
+    
+    def _similar_answer(self, question: str, context: Optional[str], generation: int) -> Optional[Dict]:
+        """Look up the answer to a paraphrase of a question, computed against corpus ``generation``
+        
+        Questions asked with a context are only answered from the exact cache.
+        """
+        if self.semantic_cache is None or context:
+            return None
+        result = self.semantic_cache.get(question, generation)
+        if result is not None:
+            metrics.SEMANTIC_CACHE_HITS.inc()
+            self.answer_cache.set(question, context, result, generation)
+        return result
+    
+    def _cache_uploaded_answer(self, question: str, context: Optional[str], result: Dict, generation: int):
+        self.answer_cache.set(question, context, result, generation)
+        if self.semantic_cache is not None and not context:
+            self.semantic_cache.set(question, result, generation)
+    
+    def _invalidate_answers(self):
+        """Invalidate every cached answer that depends on uploaded documents"""
+        self.answer_cache.invalidate_corpus()
+        if self.semantic_cache is not None:
+            self.semantic_cache.clear()
+    
+    def _route(self, question: str) -> Optional[Dict]:
+        """Route a question to the knowledge base"""
+        position = self._route_position(question)
+        return self.router.response(position) if position is not None else None
+    
+    def _route_position(self, question: str) -> Optional[int]:
+        """Find the knowledge-base rule answering a question, timing keyword matching and rule lookup separately"""
+        start_time = time.perf_counter()
+        found = self.router.match(question.lower())
+        matched_time = time.perf_counter()
+        position = self.router.resolve_position(found)
+        metrics.STAGE_ROUTING.observe(matched_time - start_time)
+        metrics.STAGE_KNOWLEDGE_BASE.observe(time.perf_counter() - matched_time)
+        return position
+    
+    def precompiled_answer(self, question: str) -> Optional[PrecompiledAnswer]:
+        """Return the prebuilt knowledge-base answer to a question, if a rule applies
+        
+        Knowledge-base rules take precedence over every other answer, so the
+        answer cache is not consulted. On a miss, answer the question with
+        ``routed=True`` so it is not routed a second time.
+        """
+        position = self._route_position(question)
+        if position is None:
+            return None
+        precompiled = self.precompiled_answers[position]
+        metrics.count_answer(precompiled.result)
+        return precompiled
+    
+    def answer_questions(self, questions: List[str], contexts: Optional[List[Optional[str]]] = None,
+                         routed: bool = False) -> List[Tuple[Dict, float]]:
+        """Answer a batch of questions, returning (result, processing time) pairs in order
+        
+        Each question is normalized and routed once, or not at all with
+        ``routed`` when the caller already found no rule applies; the
+        questions left for uploaded-document search share one embedding
+        batch, one dense index call and one keyword postings lookup. An item's
+        processing time is its routing time plus an equal share of the
+        batched retrieval time.
+        """
+        self._refresh_segments()
+        if contexts is None:
+            contexts = [None] * len(questions)
+        results: List[Optional[Dict]] = [None] * len(questions)
+        timings = [0.0] * len(questions)
+        pending = []
+        
+        for position, (question, context) in enumerate(zip(questions, contexts)):
+            start_time = time.perf_counter()
+            cached = self._cached_answer(question, context)
+            if cached is not None:
+                results[position] = cached
+            elif routed:
+                pending.append(position)
+            else:
+                rule_result = self._route(question)
+                if rule_result is not None:
+                    self.answer_cache.set(question, context, rule_result)
+                    results[position] = rule_result
+                else:
+                    pending.append(position)
+            timings[position] = time.perf_counter() - start_time
+        
+        if pending:
+            generation = self.answer_cache.generation
+            searched = []
+            for position in pending:
+                start_time = time.perf_counter()
+                similar = self._similar_answer(questions[position], contexts[position], generation)
+                timings[position] += time.perf_counter() - start_time
+                if similar is not None:
+                    results[position] = similar
+                else:
+                    searched.append(position)
+            pending = searched
+        
+        if pending:
+            start_time = time.perf_counter()
+            pending_questions = [questions[position] for position in pending]
+            found = self._search_uploaded_many(pending_questions)
+            metrics.STAGE_UPLOADED_SEARCH.observe(time.perf_counter() - start_time)
+            responses, complete = self._uploaded_responses(pending_questions, found)
+            for position, result in zip(pending, responses):
+                results[position] = result
+                if complete:
+                    self._cache_uploaded_answer(questions[position], contexts[position], result, generation)
+            
+            search_time = time.perf_counter() - start_time
+            shared_time = search_time / len(pending)
+            for position in pending:
+                timings[position] += shared_time
+        
+        for result in results:
+            metrics.count_answer(result)
+        return list(zip(results, timings))
 
 # Global QA engine instance
 qa_engine = None
 
-def initialize_qa_engine():
-    """Initialize the enhanced QA engine"""
+# Background workers for uploaded documents
+ingestion_queue = IngestionQueue(Config.INGEST_WORKERS, Config.INGEST_QUEUE_SIZE, Config.INGEST_JOB_HISTORY)
+
+def initialize_qa_engine(background: bool = False) -> bool:
+    """Initialize the enhanced QA engine
+    
+    With ``background``, the engine is built on a startup thread and this
+    returns at once: the server answers liveness probes immediately, takes
+    questions once the knowledge base and corpus are loaded, and attaches
+    dense retrieval and the reader when they finish loading.
+    """
+    if background:
+        threading.Thread(target=_initialize_in_background, name="engine-startup", daemon=True).start()
+        return True
+    
     global qa_engine
     
     try:
         logger.info("Initializing Enhanced Medical QA Engine...")
         qa_engine = EnhancedMedicalQA()
+        _start_ingestion(qa_engine)
         logger.info("Enhanced Medical QA Engine ready!")
         return True
         
@@ -323,6 +1263,44 @@ def initialize_qa_engine():
         logger.error(f"Failed to initialize QA engine: {e}")
         return False
 
+def _initialize_in_background():
+    global qa_engine
+    
+    try:
+        logger.info("Initializing Enhanced Medical QA Engine in the background...")
+        engine = EnhancedMedicalQA(load_models=False)
+        qa_engine = engine
+        _start_ingestion(engine)
+        logger.info("Enhanced Medical QA Engine ready, loading models...")
+        engine.load_models()
+        logger.info("Enhanced Medical QA Engine models loaded")
+    except Exception as e:
+        logger.error(f"Failed to initialize QA engine: {e}")
+
+def _start_ingestion(engine: EnhancedMedicalQA):
+    """Share ingestion jobs through the engine's document store and resume those of stopped processes"""
+    if engine.document_store is None:
+        return
+    ingestion_queue.use_store(engine.document_store)
+    try:
+        ingestion_queue.resume(lambda spec: _ingest_spooled_upload(
+            [tuple(spool) for spool in spec["spools"]], spec["is_json"], collection=spec["collection"]))
+    except Exception as e:
+        logger.error(f"Could not resume unfinished ingestion jobs: {e}")
+
+def _json_response(payload: str):
+    """Return a payload encoded by ``responses.encode_json`` as ``jsonify`` would
+    
+    The prebuilt encoding is jsonify's production one; with debug
+    pretty-printing or other JSON provider settings it is decoded and
+    passed to ``jsonify`` instead, so responses are identical in every mode.
+    """
+    provider = app.json
+    pretty = provider.compact is False or (provider.compact is None and app.debug)
+    if pretty or not provider.sort_keys or not provider.ensure_ascii:
+        return jsonify(json.loads(payload))
+    return app.response_class(payload + "\n", mimetype=provider.mimetype)
+
 # Routes
 @app.route('/api/v1/health', methods=['GET'])
 def health_check():
@@ -331,15 +1309,47 @@ def health_check():
         "status": "healthy",
         "engine": "Enhanced Medical QA Engine",
         "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-        "version": "2.0.0"
+        "version": "2.0.0",
+        "ready": qa_engine is not None and startup.stages.ready
     })
 
+@app.route('/api/v1/health/live', methods=['GET'])
+def liveness_probe():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({"status": "alive", "uptime_seconds": startup.stages.to_dict()["uptime_seconds"]})
+
+@app.route('/api/v1/health/ready', methods=['GET'])
+def readiness_probe():
+    """Readiness probe: 200 once questions can be answered, with the load state of every startup stage"""
+    report = startup.stages.to_dict()
+    if qa_engine is not None and startup.stages.ready:
+        report["status"] = "ready"
+        return jsonify(report)
+    report["status"] = "failed" if startup.stages.failed else "starting"
+    return jsonify(report), 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics, aggregated over all workers in multiprocess mode"""
+    try:
+        payload, content_type = metrics.render_metrics()
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    return app.response_class(payload, content_type=content_type)
+
 @app.route('/api/v1/ask', methods=['POST'])
+@admission.limited("ask")
+@profiled("ask")
 def ask_question():
     """Answer a question using the enhanced medical QA system"""
     try:
         if qa_engine is None:
-            return jsonify({"error": "QA engine not initialized"}), 500
+            return jsonify({"error": "QA engine not initialized"}), 503
+        
+        try:
+            stream_format = requested_stream_format()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         data = request.get_json()
         if not data or 'question' not in data:
@@ -350,92 +1360,320 @@ def ask_question():
             return jsonify({"error": "Question cannot be empty"}), 400
         
         context = data.get('context')
+        if stream_format is not None:
+            return stream_response(stream_format, _stream_passages(question, context))
         
-        # Process question
+        # Process question; knowledge-base answers come prebuilt
         start_time = time.time()
-        result = qa_engine.answer_question(question, context)
+        precompiled = qa_engine.precompiled_answer(question)
+        if precompiled is not None:
+            result = precompiled.result
+        else:
+            result = qa_engine.answer_question(question, context, routed=True)
         processing_time = time.time() - start_time
         
         # Format response
-        response = {
-            "question": question,
-            "answer": result["answer"],
-            "confidence": result["confidence"],
-            "source": result.get("source", "Medical Knowledge Base"),
-            "category": result.get("category", "general"),
-            "processing_time": round(processing_time, 3),
-            "engine": "Enhanced Medical QA Engine",
-            "disclaimer": "This system provides information for educational purposes only. Always consult with qualified healthcare professionals for medical decisions."
-        }
+        serialize_start = time.perf_counter()
+        if precompiled is not None:
+            response = _json_response(precompiled.encode(question, processing_time))
+        else:
+            response = jsonify(format_answer(question, result, processing_time))
+        metrics.STAGE_SERIALIZATION.observe(time.perf_counter() - serialize_start)
         
         logger.info(f"Answered question with confidence {result['confidence']:.3f}")
-        return jsonify(response)
+        return response
         
     except Exception as e:
         logger.error(f"Error processing question: {e}")
         return jsonify({"error": "Failed to process question"}), 500
 
+@app.route('/api/v1/ask/batch', methods=['POST'])
+@admission.limited("batch")
+@profiled("ask_batch")
+def ask_batch():
+    """Answer a batch of questions in one request, preserving their order
+    
+    In streaming mode each answer is sent as soon as its slice of
+    STREAM_BATCH_SIZE questions is answered.
+    """
+    try:
+        if qa_engine is None:
+            return jsonify({"error": "QA engine not initialized"}), 503
+        
+        try:
+            stream_format = requested_stream_format()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        data = request.get_json()
+        if not data or 'questions' not in data:
+            return jsonify({"error": "Questions are required"}), 400
+        
+        items = data['questions']
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Questions must be a non-empty list"}), 400
+        if len(items) > Config.MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {Config.MAX_BATCH_SIZE} questions per batch"}), 400
+        
+        # Items are plain strings or {"question": ..., "context": ...} objects
+        questions = []
+        contexts = []
+        errors = {}
+        for position, item in enumerate(items):
+            question = item.get('question') if isinstance(item, dict) else item
+            if not isinstance(question, str) or not question.strip():
+                errors[position] = "Question cannot be empty"
+                continue
+            questions.append(question.strip())
+            contexts.append(item.get('context') if isinstance(item, dict) else None)
+        
+        if stream_format is not None:
+            return stream_response(stream_format, _stream_answers(items, questions, contexts, errors))
+        
+        # Knowledge-base answers come prebuilt; the other questions are answered as one batch
+        start_time = time.time()
+        prebuilt = []
+        for question in questions:
+            item_start = time.perf_counter()
+            prebuilt.append((qa_engine.precompiled_answer(question), time.perf_counter() - item_start))
+        remaining = [position for position, (precompiled, _) in enumerate(prebuilt) if precompiled is None]
+        answered = iter(qa_engine.answer_questions([questions[position] for position in remaining],
+                                                   [contexts[position] for position in remaining], routed=True))
+        processing_time = time.time() - start_time
+        
+        # Results are encoded one by one so prebuilt answers are spliced in as they are
+        serialize_start = time.perf_counter()
+        results = []
+        valid = iter(zip(questions, prebuilt))
+        for position in range(len(items)):
+            if position in errors:
+                results.append(encode_json({"error": errors[position]}))
+                continue
+            question, (precompiled, item_time) = next(valid)
+            if precompiled is not None:
+                results.append(precompiled.encode(question, item_time, precision=6))
+            else:
+                result, item_time = next(answered)
+                results.append(encode_json(format_answer(question, result, item_time, precision=6)))
+        
+        response = _json_response(f'{{"count":{len(results)},"processing_time":'
+                                  f'{encode_json(round(processing_time, 3))},"results":[{",".join(results)}]}}')
+        metrics.STAGE_SERIALIZATION.observe(time.perf_counter() - serialize_start)
+        
+        logger.info(f"Answered batch of {len(questions)} questions in {processing_time:.3f}s")
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error processing question batch: {e}")
+        return jsonify({"error": "Failed to process question batch"}), 500
+
+def _stream_answers(items: List, questions: List[str], contexts: List[Optional[str]],
+                    errors: Dict[int, str]) -> Iterable[Tuple[str, Dict]]:
+    """Yield ("answer", record) for every item in order as it is answered, then ("done", summary)
+    
+    Valid questions are answered in slices of STREAM_BATCH_SIZE, so the
+    first answers are sent while later slices are still being processed.
+    Each record carries the item's position as "index".
+    """
+    start_time = time.time()
+    try:
+        answered = _answer_in_slices(questions, contexts)
+        for position in range(len(items)):
+            if position in errors:
+                record = {"error": errors[position]}
+            else:
+                question, (result, item_time) = next(answered)
+                record = format_answer(question, result, item_time, precision=6)
+            record["index"] = position
+            yield "answer", record
+        
+        processing_time = time.time() - start_time
+        logger.info(f"Streamed answers to {len(questions)} questions in {processing_time:.3f}s")
+        yield "done", {"done": True, "count": len(items), "processing_time": round(processing_time, 3)}
+    except Exception as e:
+        logger.error(f"Error streaming answers: {e}")
+        yield "error", {"error": "Failed to process question batch"}
+
+def _stream_passages(question: str, context: Optional[str]) -> Iterable[Tuple[str, Dict]]:
+    """Yield ("passage", record) for each passage of an uploaded-document answer as it is found, then the answer
+    
+    The answer record and the ("done", summary) that follows are those of
+    ``_stream_answers``; passage records carry their rank as "passage".
+    """
+    start_time = time.time()
+    try:
+        precompiled = qa_engine.precompiled_answer(question)
+        if precompiled is not None:
+            result = precompiled.result
+        else:
+            rank = 0
+            for event, value in qa_engine.stream_answer(question, context, routed=True):
+                if event == "passage":
+                    yield "passage", {"passage": rank, "text": value}
+                    rank += 1
+                else:
+                    result = value
+        processing_time = time.time() - start_time
+        record = format_answer(question, result, processing_time, precision=6)
+        record["index"] = 0
+        yield "answer", record
+        
+        logger.info(f"Streamed answer with confidence {result['confidence']:.3f}")
+        yield "done", {"done": True, "count": 1, "processing_time": round(processing_time, 3)}
+    except Exception as e:
+        logger.error(f"Error streaming answer: {e}")
+        yield "error", {"error": "Failed to process question"}
+
+def _answer_in_slices(questions: List[str], contexts: List[Optional[str]]):
+    """Yield (question, (result, processing time)) pairs, answering STREAM_BATCH_SIZE questions at a time"""
+    for start in range(0, len(questions), Config.STREAM_BATCH_SIZE):
+        end = start + Config.STREAM_BATCH_SIZE
+        yield from zip(questions[start:end], qa_engine.answer_questions(questions[start:end], contexts[start:end]))
+
+def _spool_files(files) -> List[Tuple[str, str]]:
+    """Copy uploaded files to disk and return the (path, format) of each"""
+    spools = []
+    try:
+        for uploaded_file in files:
+            spool_path = spool_stream(uploaded_file.stream, Config.UPLOAD_READ_SIZE)
+            spools.append((spool_path, ""))
+            with open(spool_path, 'rb') as spool:
+                spools[-1] = (spool_path, detect_format(uploaded_file.filename, spool.read(1024)))
+    except Exception:
+        _remove_spools(spools)
+        raise
+    return spools
+
+def _remove_spools(spools: List[Tuple[str, str]]):
+    for spool_path, _ in spools:
+        try:
+            os.remove(spool_path)
+        except FileNotFoundError:
+            pass
+
+def _ingest_spooled_upload(spools: List[Tuple[str, str]], is_json: bool, profile: bool = False,
+                           collection: str = Config.DEFAULT_COLLECTION):
+    """Return the background job that ingests spooled uploads and then deletes them"""
+    def work(job: IngestionJob):
+        try:
+            # A job resumed after a restart needs its spool files to have survived
+            if not all(os.path.exists(spool_path) for spool_path, _ in spools):
+                raise ValueError("The uploaded data of this job is no longer available")
+            with profiler.maybe_profile("ingest", profile):
+                if is_json:
+                    with open(spools[0][0], 'rb') as spool:
+                        blocks = iter_decoded(spool, read_size=Config.UPLOAD_READ_SIZE)
+                        documents = ([text] for text in iter_json_documents(blocks) if text is not None)
+                        qa_engine.ingest_documents(documents, is_user_upload=True, job=job, collection=collection)
+                else:
+                    # PDF, DOCX and HTML files are parsed in the extraction process pool
+                    qa_engine.ingest_documents(iter_extracted_documents(spools), is_user_upload=True, job=job,
+                                               collection=collection)
+        except UnicodeDecodeError:
+            raise ValueError("File encoding not supported. Please upload a text file.")
+        finally:
+            _remove_spools(spools)
+    return work
+
+def _enqueue_upload(spools: List[Tuple[str, str]], description: str, is_json: bool,
+                    collection: str = Config.DEFAULT_COLLECTION):
+    """Queue spooled uploads for background ingestion"""
+    try:
+        job = ingestion_queue.submit(description, _ingest_spooled_upload(spools, is_json, profile_requested(),
+                                                                         collection),
+                                     spec={"spools": spools, "is_json": is_json, "collection": collection})
+    except queue.Full:
+        _remove_spools(spools)
+        response = jsonify({"error": "Ingestion queue is full, please retry later"})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+    
+    logger.info(f"Queued ingestion job {job.id} for {description}")
+    return jsonify({
+        "message": f"Accepted {description} for ingestion",
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/v1/docs/jobs/{job.id}"
+    }), 202
+
+_COLLECTION_NAME = re.compile(r"[A-Za-z0-9_.-]{1,64}\Z")
+
 @app.route('/api/v1/docs/upload', methods=['POST'])
+@admission.limited("upload")
+@profiled("upload")
 def upload_documents():
-    """Upload documents to the knowledge base"""
+    """Upload documents to the knowledge base
+    
+    Uploads are queued for background ingestion and answered with 202 and a
+    job ID; pass ?wait=true to ingest within the request instead. Pass
+    ?collection=<name> to add the documents to a collection with its own
+    retention quota. Files may be text, PDF, DOCX or HTML, and several can
+    be sent at once; each file is one document.
+    """
     try:
         if qa_engine is None:
-            return jsonify({"error": "QA engine not initialized"}), 500
+            return jsonify({"error": "QA engine not initialized"}), 503
         
-        # Handle file upload (multipart/form-data)
+        wait = request.args.get('wait', 'false').lower() == 'true'
+        collection = request.args.get('collection', Config.DEFAULT_COLLECTION)
+        if not _COLLECTION_NAME.match(collection):
+            return jsonify({"error": "Collection names are 1-64 letters, digits, '_', '.' or '-'"}), 400
+        
+        # Handle file uploads (multipart/form-data); several files may be sent under the same field
         if 'file' in request.files:
-            uploaded_file = request.files['file']
-            if uploaded_file.filename == '':
+            uploaded_files = request.files.getlist('file')
+            if any(uploaded_file.filename == '' for uploaded_file in uploaded_files):
                 return jsonify({"error": "No file selected"}), 400
+            filenames = [uploaded_file.filename for uploaded_file in uploaded_files]
+            description = f"document: {filenames[0]}" if len(filenames) == 1 else f"{len(filenames)} documents"
+            
+            spools = _spool_files(uploaded_files)
+            if not wait:
+                return _enqueue_upload(spools, description, is_json=False, collection=collection)
             
-            # Read file content
+            # Text is decoded block by block, other formats extracted page by page as chunking proceeds
+            job = IngestionJob(description, None)
             try:
-                if uploaded_file.filename.endswith('.txt'):
-                    file_content = uploaded_file.read().decode('utf-8')
-                elif uploaded_file.filename.endswith('.md'):
-                    file_content = uploaded_file.read().decode('utf-8')
-                else:
-                    # Try to read as text anyway
-                    file_content = uploaded_file.read().decode('utf-8')
-                
-                # Process the file content and extract medical information - mark as user upload
-                qa_engine._extract_medical_info(file_content, is_user_upload=True)
-                
-                logger.info(f"Successfully uploaded document: {uploaded_file.filename}")
-                
-                return jsonify({
-                    "message": f"Successfully uploaded document: {uploaded_file.filename}",
-                    "document_count": 1,
-                    "filename": uploaded_file.filename,
-                    "content_length": len(file_content)
-                })
-                
+                _, content_length = qa_engine.ingest_documents(iter_extracted_documents(spools), is_user_upload=True,
+                                                               job=job, collection=collection)
             except UnicodeDecodeError:
                 return jsonify({"error": "File encoding not supported. Please upload a text file."}), 400
+            except ValueError as e:
+                return jsonify({"error": str(e), "document_count": job.documents_processed}), 400
+            finally:
+                _remove_spools(spools)
+            
+            logger.info(f"Successfully uploaded {description}")
+            
+            response = {
+                "message": f"Successfully uploaded {description}",
+                "document_count": job.documents_processed,
+                "filename": filenames[0],
+                "content_length": content_length
+            }
+            if len(filenames) > 1:
+                response["filenames"] = filenames
+                response["skipped_count"] = job.documents_skipped
+            return jsonify(response)
         
-        # Handle JSON data (application/json)
+        # Handle JSON data (application/json), parsing the documents array as it streams in
         elif request.is_json:
-            data = request.get_json()
-            if not data or 'documents' not in data:
-                return jsonify({"error": "Documents are required"}), 400
-            
-            documents = data['documents']
-            if not isinstance(documents, list):
-                return jsonify({"error": "Documents must be a list"}), 400
+            if not wait:
+                return _enqueue_upload([(spool_stream(request.stream, Config.UPLOAD_READ_SIZE), "json")],
+                                       "JSON documents", is_json=True, collection=collection)
             
-            # Process documents and extract medical information - mark as user uploads
-            processed_count = 0
-            for doc in documents:
-                if isinstance(doc, str):
-                    qa_engine._extract_medical_info(doc, is_user_upload=True)
-                    processed_count += 1
-                elif isinstance(doc, dict) and 'text' in doc:
-                    qa_engine._extract_medical_info(doc['text'], is_user_upload=True)
-                    processed_count += 1
+            job = IngestionJob("JSON documents", None)
+            try:
+                documents = iter_json_documents(iter_decoded(request.stream, read_size=Config.UPLOAD_READ_SIZE))
+                qa_engine.ingest_documents(([text] for text in documents if text is not None),
+                                           is_user_upload=True, job=job, collection=collection)
+            except (ValueError, UnicodeDecodeError) as e:
+                return jsonify({"error": str(e), "document_count": job.documents_processed}), 400
             
             return jsonify({
-                "message": f"Successfully processed {processed_count} documents",
-                "document_count": processed_count
+                "message": f"Successfully processed {job.documents_processed} documents",
+                "document_count": job.documents_processed,
+                "skipped_count": job.documents_skipped
             })
         
         else:
@@ -445,17 +1683,32 @@ def upload_documents():
         logger.error(f"Error uploading documents: {e}")
         return jsonify({"error": "Failed to upload documents"}), 500
 
+@app.route('/api/v1/docs/jobs/<job_id>', methods=['GET'])
+def ingestion_job_status(job_id):
+    """Get the status of a background ingestion job, which any worker process may have run"""
+    status = ingestion_queue.status(job_id)
+    if status is None:
+        return jsonify({"error": "Ingestion job not found"}), 404
+    return jsonify(status)
+
 @app.route('/api/v1/docs/stats', methods=['GET'])
 def document_stats():
     """Get document statistics"""
     try:
         if qa_engine is None:
-            return jsonify({"error": "QA engine not initialized"}), 500
+            return jsonify({"error": "QA engine not initialized"}), 503
         
         stats = {
             "knowledge_base_topics": len(qa_engine.medical_knowledge),
             "available_topics": list(qa_engine.medical_knowledge.keys()),
-            "total_entries": sum(len(v) if isinstance(v, dict) else 1 for v in qa_engine.medical_knowledge.values())
+            "total_entries": sum(len(v) if isinstance(v, dict) else 1 for v in qa_engine.medical_knowledge.values()),
+            "answer_cache": qa_engine.answer_cache.stats(),
+            "semantic_cache": qa_engine.semantic_cache.stats() if qa_engine.semantic_cache is not None else None,
+            "deduplication": qa_engine.deduplication_stats(),
+            "entities": qa_engine.entity_index.stats() if qa_engine.entity_index is not None else None,
+            "memory": qa_engine.memory_stats(),
+            "ingestion_queue_pending": ingestion_queue.pending,
+            "admission": {name: budget.stats() for name, budget in admission.budgets.items()}
         }
         
         return jsonify(stats)
@@ -464,12 +1717,57 @@ def document_stats():
         logger.error(f"Error getting document stats: {e}")
         return jsonify({"error": "Failed to get document statistics"}), 500
 
+@app.route('/api/v1/admin/profile', methods=['GET', 'DELETE'])
+def profile_report():
+    """Aggregated request profiles: a summary, or one endpoint as collapsed stacks or pstats
+    
+    Only available once PROFILING_ADMIN_TOKEN is set, to requests sending it in X-Admin-Token.
+    """
+    if not Config.PROFILING_ADMIN_TOKEN:
+        return jsonify({"error": "Profiling admin endpoint is disabled"}), 404
+    if not admin_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if request.method == 'DELETE':
+        profiler.reset()
+        return jsonify({"message": "Profiles cleared"})
+    
+    endpoint = request.args.get('endpoint')
+    if not endpoint:
+        return jsonify(profiler.summary())
+    
+    output_format = request.args.get('format', 'collapsed' if profiler.mode == 'sampling' else 'text')
+    if output_format == 'collapsed':
+        body = profiler.collapsed(endpoint)
+    elif output_format == 'text':
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            return jsonify({"error": f"Unknown sort key: {sort}"}), 400
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return jsonify({"error": "limit must be a positive integer"}), 400
+        body = profiler.pstats_text(endpoint, sort, limit)
+    elif output_format == 'pstats':
+        body = profiler.pstats_dump(endpoint)
+    else:
+        return jsonify({"error": "Format must be collapsed, text or pstats"}), 400
+    
+    if not body:
+        return jsonify({"error": f"No {output_format} profile data for endpoint: {endpoint}"}), 404
+    if output_format == 'pstats':
+        return app.response_class(body, mimetype='application/octet-stream',
+                                  headers={"Content-Disposition": f"attachment; filename={endpoint}.prof"})
+    return app.response_class(body, mimetype='text/plain')
+
 if __name__ == "__main__":
     print("Enhanced Healthcare QA System API")
     print("=" * 50)
     
-    # Initialize QA engine
-    if initialize_qa_engine():
+    # Initialize QA engine; the server starts while it loads
+    if initialize_qa_engine(background=Config.BACKGROUND_STARTUP):
         print("Starting server on http://localhost:5000")
         print("API Documentation: http://localhost:5000/api/v1/health")
         print("Enhanced medical QA with reliable knowledge base")
@@ -0,0 +1,312 @@
+"""
+Medical entity index for the Healthcare BERT QA System
+
+Ingestion runs a gazetteer matcher over every sentence of an uploaded
+document: drug, condition and symptom names, and section cues such as "side
+effects" or "symptoms", all compiled into one regular expression. A section
+cue at the start of a sentence is a heading and applies to the sentences
+after it, until the next heading or a paragraph about another entity. Each
+sentence mentioning an entity (or following one, within its paragraph) in a
+known section is indexed under (entity, section), so "side effects of X" is
+answered with one dictionary lookup instead of a corpus search.
+
+The built-in gazetteer covers common drugs, conditions and symptoms;
+``ENTITY_GAZETTEER_PATH`` names a JSON file of more terms by entity type.
+"""
+
+import json
+import logging
+import re
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config import Config
+from intent_router import trie_pattern
+from retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+GAZETTEER: Dict[str, Tuple[str, ...]] = {
+    "drug": (
+        "acetaminophen", "albuterol", "alendronate", "allopurinol", "alprazolam", "amiodarone", "amitriptyline",
+        "amlodipine", "amoxicillin", "apixaban", "aspirin", "atenolol", "atorvastatin", "azithromycin",
+        "budesonide", "bupropion", "carvedilol", "cephalexin", "cetirizine", "ciprofloxacin", "citalopram",
+        "clonazepam", "clopidogrel", "dapagliflozin", "diazepam", "diclofenac", "digoxin", "doxycycline",
+        "duloxetine", "empagliflozin", "enalapril", "escitalopram", "esomeprazole", "famotidine", "fluoxetine",
+        "furosemide", "gabapentin", "glipizide", "hydrochlorothiazide", "hydroxychloroquine", "ibuprofen",
+        "insulin", "levetiracetam", "levothyroxine", "lisinopril", "lithium", "loratadine", "lorazepam",
+        "losartan", "meloxicam", "metformin", "methotrexate", "metoprolol", "metronidazole", "montelukast",
+        "morphine", "naproxen", "nitrofurantoin", "nitroglycerin", "omeprazole", "ondansetron", "oxycodone",
+        "pantoprazole", "paracetamol", "penicillin", "prednisone", "pregabalin", "propranolol", "quetiapine",
+        "ramipril", "rivaroxaban", "rosuvastatin", "semaglutide", "sertraline", "simvastatin", "sitagliptin",
+        "spironolactone", "tamsulosin", "tramadol", "trazodone", "valsartan", "venlafaxine", "warfarin",
+    ),
+    "condition": (
+        "alzheimer's disease", "anemia", "anxiety", "arthritis", "asthma", "atrial fibrillation",
+        "bronchitis", "cancer", "celiac disease", "chronic kidney disease", "cirrhosis", "copd", "covid-19",
+        "crohn's disease", "deep vein thrombosis", "dementia", "depression", "diabetes", "eczema", "epilepsy",
+        "gerd", "glaucoma", "gout", "heart failure", "hepatitis", "hiv", "hypertension", "hyperthyroidism",
+        "hypothyroidism", "influenza", "irritable bowel syndrome", "kidney disease", "lupus", "malaria",
+        "measles", "migraine", "multiple sclerosis", "myocardial infarction", "obesity", "osteoarthritis",
+        "osteoporosis", "parkinson's disease", "pneumonia", "psoriasis", "rheumatoid arthritis", "sepsis",
+        "sickle cell disease", "stroke", "tuberculosis", "ulcerative colitis", "urinary tract infection",
+    ),
+    "symptom": (
+        "abdominal pain", "back pain", "blurred vision", "chest pain", "chills", "confusion", "constipation",
+        "cough", "diarrhea", "dizziness", "fatigue", "fever", "headache", "heartburn", "insomnia",
+        "joint pain", "nausea", "palpitations", "rash", "shortness of breath", "sore throat", "swelling",
+        "vomiting", "weight loss", "wheezing",
+    ),
+}
+
+# Alternative names, indexed and looked up as the canonical entity
+SYNONYMS: Dict[str, str] = {
+    "high blood pressure": "hypertension",
+    "heart attack": "myocardial infarction",
+    "type 1 diabetes": "diabetes",
+    "type 2 diabetes": "diabetes",
+    "diabetes mellitus": "diabetes",
+    "flu": "influenza",
+    "uti": "urinary tract infection",
+    "acid reflux": "gerd",
+    "tylenol": "acetaminophen",
+    "advil": "ibuprofen",
+    "motrin": "ibuprofen",
+    "coumadin": "warfarin",
+    "ozempic": "semaglutide",
+}
+
+# Section cues, in documents and in questions
+SECTION_TERMS: Dict[str, Tuple[str, ...]] = {
+    "side_effects": ("side effect", "side effects", "adverse effect", "adverse effects", "adverse reaction",
+                     "adverse reactions"),
+    "symptoms": ("symptom", "symptoms", "signs and symptoms", "warning signs"),
+    "treatment": ("treatment", "treatments", "treated with", "therapy", "management", "managed with"),
+    "dosage": ("dosage", "dosing", "dose", "doses", "dosage and administration"),
+    "risk_factors": ("risk factor", "risk factors"),
+    "contraindications": ("contraindication", "contraindications", "contraindicated", "precautions"),
+    "interactions": ("interaction", "interactions", "interacts with", "drug interactions"),
+    "diagnosis": ("diagnosis", "diagnosed", "diagnostic tests"),
+}
+
+# Question phrasings that only make sense in questions ("how is X treated")
+QUESTION_SECTION_TERMS: Dict[str, str] = {
+    "treat": "treatment",
+    "treated": "treatment",
+    "manage": "treatment",
+    "how much": "dosage",
+    "cause": "risk_factors",
+    "causes": "risk_factors",
+    "diagnose": "diagnosis",
+    "interact": "interactions",
+    "reaction": "side_effects",
+    "reactions": "side_effects",
+}
+
+_HEADING_WORDS = 6
+
+
+def load_gazetteer(path: str = Config.ENTITY_GAZETTEER_PATH) -> Dict[str, Tuple[str, ...]]:
+    """Return the built-in gazetteer extended with the terms of a JSON file of ``{type: [terms]}``"""
+    gazetteer = {entity_type: tuple(terms) for entity_type, terms in GAZETTEER.items()}
+    if not path:
+        return gazetteer
+    try:
+        with open(path, encoding="utf-8") as f:
+            extra = json.load(f)
+        for entity_type, terms in extra.items():
+            gazetteer[entity_type] = gazetteer.get(entity_type, ()) + tuple(term.lower() for term in terms)
+    except (OSError, ValueError, AttributeError) as e:
+        logger.warning(f"Could not load entity gazetteer {path}: {e}")
+    return gazetteer
+
+
+class EntityMatcher:
+    """Finds gazetteer entities and section cues in text with one compiled pattern"""
+
+    def __init__(self, gazetteer: Optional[Dict[str, Tuple[str, ...]]] = None,
+                 topics: Iterable[str] = ()):
+        gazetteer = load_gazetteer() if gazetteer is None else gazetteer
+        # Term -> (kind, canonical name)
+        self._terms: Dict[str, Tuple[str, str]] = {}
+        for terms in gazetteer.values():
+            for term in terms:
+                self._terms[term] = ("entity", term)
+        for topic in topics:
+            self._terms.setdefault(topic, ("entity", topic))
+        for term, canonical in SYNONYMS.items():
+            self._terms[term] = ("entity", canonical)
+        for section, terms in SECTION_TERMS.items():
+            for term in terms:
+                self._terms[term] = ("section", section)
+        self.entity_types = {term: entity_type for entity_type, terms in gazetteer.items() for term in terms}
+
+        self._pattern = re.compile(r"\b(?:" + trie_pattern(sorted(self._terms)) + r")\b")
+        question_terms = dict(self._terms)
+        for term, section in QUESTION_SECTION_TERMS.items():
+            question_terms.setdefault(term, ("section", section))
+        self._question_terms = question_terms
+        self._question_pattern = re.compile(r"\b(?:" + trie_pattern(sorted(question_terms)) + r")\b")
+        # Canonical entity and section names, as they appear among canonical terms
+        self.canonical_names = frozenset(name for _, name in question_terms.values())
+
+    def scan(self, text_lower: str) -> Tuple[List[str], List[Tuple[int, str]]]:
+        """Return the distinct entities of a text in order, and (position, section) of its section cues"""
+        entities: List[str] = []
+        sections: List[Tuple[int, str]] = []
+        for match in self._pattern.finditer(text_lower):
+            kind, name = self._terms[match.group()]
+            if kind == "section":
+                sections.append((match.start(), name))
+            elif name not in entities:
+                entities.append(name)
+        return entities, sections
+
+    def parse_question(self, question_lower: str) -> Optional[Tuple[str, str]]:
+        """Return the (entity, section) a question asks about, if it names exactly one section and an entity"""
+        entities = []
+        sections = set()
+        for match in self._question_pattern.finditer(question_lower):
+            kind, name = self._question_terms[match.group()]
+            if kind == "section":
+                sections.add(name)
+            elif name not in entities:
+                entities.append(name)
+        if len(sections) != 1 or not entities:
+            return None
+        # In "does metformin cause nausea" the drug is the subject, not the symptom
+        subjects = [entity for entity in entities if self.entity_types.get(entity) != "symptom"]
+        return (subjects or entities)[0], sections.pop()
+
+    def canonical_terms(self, question_lower: str) -> List[str]:
+        """Return a question's terms in order, with entities and section cues replaced by their canonical names
+
+        "adverse reactions to tylenol" and "acetaminophen side effects" give
+        the same terms, in a different order.
+        """
+        terms: List[str] = []
+        position = 0
+        for match in self._question_pattern.finditer(question_lower):
+            terms.extend(tokenize(question_lower[position:match.start()]))
+            terms.append(self._question_terms[match.group()][1])
+            position = match.end()
+        terms.extend(tokenize(question_lower[position:]))
+        return terms
+
+    def extract(self, sentences: Iterable[Tuple[int, str]]) -> List[Tuple[str, str, int]]:
+        """Return (entity, section, sentence ID) for the indexed sentences of a document
+
+        ``sentences`` are (ID, raw text) in document order; a gap in the IDs
+        starts a new document. A sentence naming a section is indexed under
+        every drug or condition it names, other sentences under the subject:
+        the drug or condition named first in the latest sentence naming one.
+        A heading's section lasts until the next heading or a paragraph about
+        another subject, a section cue opening a sentence lasts until the end
+        of its paragraph, and a cue within a sentence naming a subject applies
+        to that sentence only.
+        """
+        entries = []
+        subject: List[str] = []
+        section: Optional[str] = None
+        heading_section = False
+        previous_id = None
+        paragraph_start = True
+        for sentence_id, text in sentences:
+            if previous_id is not None and sentence_id != previous_id + 1:
+                subject, section, paragraph_start = [], None, True
+            previous_id = sentence_id
+            stripped = text.strip()
+            if not stripped:
+                continue
+
+            entities, cues = self.scan(stripped.lower())
+            subjects = [entity for entity in entities if self.entity_types.get(entity) != "symptom"]
+            # A heading is a section cue opening a short line: "Side Effects", "Dosage: 500 mg twice daily"
+            first_line = stripped.split("\n", 1)[0]
+            opening = bool(cues) and cues[0][0] == 0
+            heading = opening and (len(first_line.split()) <= _HEADING_WORDS or first_line.endswith(":"))
+            if opening:
+                section, heading_section = cues[0][1], heading
+            elif paragraph_start and subjects and not cues:
+                section = None
+            if subjects:
+                subject = subjects[:1]
+
+            cue = cues[0][1] if cues and not opening and (subjects or section is None) else section
+            # A bare heading is not worth answering with
+            if cue is not None and not (heading and stripped == first_line and not entities):
+                entries.extend((entity, cue, sentence_id) for entity in (subjects if cues and subjects else subject))
+
+            # Sentence text includes the whitespace after it; a line break there ends the paragraph
+            paragraph_start = "\n" in text[len(text.rstrip()):]
+            if paragraph_start and not heading_section:
+                section = None
+        return entries
+
+
+class EntityIndex:
+    """(entity, section) -> the sentences and chunks mentioning it
+
+    Postings are appended and removed under the engine's index lock and
+    read without it.
+    """
+
+    def __init__(self, matcher: EntityMatcher):
+        self.matcher = matcher
+        self._postings: Dict[Tuple[str, str], Tuple[array, array]] = {}
+        self.entries = 0
+
+    def __len__(self) -> int:
+        return len(self._postings)
+
+    def add(self, entries: Iterable[Tuple[str, str, int, int]]):
+        """Add (entity, section, sentence ID, chunk ID) entries"""
+        for entity, section, sentence_id, chunk_id in entries:
+            postings = self._postings.get((entity, section))
+            if postings is None:
+                postings = self._postings[(entity, section)] = (array('q'), array('q'))
+            postings[0].append(sentence_id)
+            postings[1].append(chunk_id)
+            self.entries += 1
+
+    def remove(self, chunk_ids: Iterable[int]):
+        """Drop the entries of removed chunks, e.g. of evicted documents
+
+        Postings holding any of them are rewritten and swapped in whole, so
+        a concurrent lookup sees either version.
+        """
+        removed = set(chunk_ids)
+        if not removed:
+            return
+        for key, (sentence_ids, entry_chunks) in list(self._postings.items()):
+            kept = [position for position, chunk_id in enumerate(entry_chunks) if chunk_id not in removed]
+            if len(kept) == len(entry_chunks):
+                continue
+            self.entries -= len(entry_chunks) - len(kept)
+            if kept:
+                self._postings[key] = (array('q', (sentence_ids[position] for position in kept)),
+                                       array('q', (entry_chunks[position] for position in kept)))
+            else:
+                del self._postings[key]
+
+    def lookup(self, entity: str, section: str) -> Tuple[Sequence[int], Sequence[int]]:
+        """Return the sentence IDs and chunk IDs indexed under (entity, section)"""
+        sentence_ids, chunk_ids = self._postings.get((entity, section), ((), ()))
+        # Copy the lengths first: a commit may be appending to the arrays
+        count = min(len(sentence_ids), len(chunk_ids))
+        return sentence_ids[:count], chunk_ids[:count]
+
+    def stats(self) -> Dict:
+        entities = {entity for entity, _ in self._postings}
+        return {
+            "entities": len(entities),
+            "entity_sections": len(self._postings),
+            "entries": self.entries
+        }
+
+
+def create_entity_index(topics: Iterable[str] = ()) -> Optional[EntityIndex]:
+    """Create the entity index, or None if entity indexing is disabled"""
+    if not Config.ENTITY_INDEX_ENABLED:
+        return None
+    return EntityIndex(EntityMatcher(topics=topics))
@@ -0,0 +1,271 @@
+"""
+Document text extraction for the Healthcare BERT QA System
+
+Uploads in the formats of ``Config.SUPPORTED_DOCUMENT_TYPES`` are turned into
+text before chunking. Plain text is decoded block by block in the ingesting
+thread; PDF, DOCX and HTML parsing is CPU-bound and runs in a process pool.
+PDFs are split into tasks of a few pages each, so one large PDF, or several
+uploaded files, keep every worker process busy. Extracted text is yielded in
+document and page order as soon as it is ready, so chunking starts on the
+first pages while later ones are still being parsed.
+
+PDF extraction uses PyMuPDF, or pdfplumber if PyMuPDF is not installed; HTML
+uses BeautifulSoup, or the standard library parser without it. DOCX files are
+read with the standard library.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import Callable, Deque, Iterator, List, Optional, Sequence, Tuple
+from xml.etree import ElementTree
+
+from config import Config
+from ingestion import iter_decoded
+
+logger = logging.getLogger(__name__)
+
+_HTML_SKIPPED_TAGS = {"script", "style", "noscript", "template", "head"}
+_HTML_BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article",
+                    "table", "ul", "ol", "blockquote", "pre", "title"}
+_EXTENSION_FORMATS = {".pdf": "pdf", ".docx": "docx", ".html": "html", ".htm": "html"}
+_WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_BLANK_LINES = re.compile(r"\n\s*\n\s*")
+
+
+def detect_format(filename: str, head: bytes = b"") -> str:
+    """Return "pdf", "docx", "html" or "text" for an upload, from its leading bytes and extension
+
+    Anything not recognised is ingested as text, which must decode as UTF-8.
+    """
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if head.lstrip()[:64].lower().startswith((b"<!doctype html", b"<html")):
+        return "html"
+    return _EXTENSION_FORMATS.get(os.path.splitext(filename or "")[1].lower(), "text")
+
+
+def _clean(text: str) -> str:
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+
+def _pdf_page_count(path: str) -> int:
+    try:
+        import fitz
+        with fitz.open(path) as pdf:
+            return pdf.page_count
+    except ImportError:
+        pass
+    try:
+        import pdfplumber
+    except ImportError:
+        raise ValueError("PDF extraction requires PyMuPDF or pdfplumber")
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+
+def _extract_pdf_pages(path: str, start: int, end: int) -> str:
+    """Text of pages [start, end) of a PDF, one page per paragraph"""
+    try:
+        import fitz
+        with fitz.open(path) as pdf:
+            pages = [pdf[page].get_text() for page in range(start, end)]
+    except ImportError:
+        import pdfplumber
+        with pdfplumber.open(path) as pdf:
+            pages = [pdf.pages[page].extract_text() or "" for page in range(start, end)]
+    return "\n\n".join(_clean(page) for page in pages if page.strip())
+
+
+def _extract_docx(path: str) -> str:
+    """Paragraph text of a DOCX document body"""
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{_WORD_NAMESPACE}p"):
+        text = "".join(node.text or "" for node in paragraph.iter(f"{_WORD_NAMESPACE}t"))
+        if text.strip():
+            paragraphs.append(text.strip())
+    return "\n\n".join(paragraphs)
+
+
+class _TextCollector(HTMLParser):
+    """Visible text of an HTML document, with a line break after block elements"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces: List[str] = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _HTML_SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in _HTML_BLOCK_TAGS:
+            self.pieces.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _HTML_SKIPPED_TAGS:
+            self._skipping = max(self._skipping - 1, 0)
+        elif tag in _HTML_BLOCK_TAGS:
+            self.pieces.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.pieces.append(data)
+
+
+def _extract_html(path: str) -> str:
+    """Visible text of an HTML document"""
+    with open(path, "rb") as f:
+        content = f.read()
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        collector = _TextCollector()
+        collector.feed(content.decode("utf-8", errors="replace"))
+        collector.close()
+        text = "".join(collector.pieces)
+    else:
+        soup = BeautifulSoup(content, "html.parser")
+        for tag in soup(list(_HTML_SKIPPED_TAGS)):
+            tag.decompose()
+        text = soup.get_text("\n")
+    return _clean("\n".join(line.strip() for line in text.splitlines()))
+
+
+def _fail(message: str) -> str:
+    raise ValueError(message)
+
+
+def _tasks(path: str, document_format: str) -> Iterator[Tuple[Callable[..., str], tuple]]:
+    """The extraction tasks of one document, in text order"""
+    if document_format == "pdf":
+        try:
+            page_count = _pdf_page_count(path)
+        except Exception as e:
+            # Reported when the document is read, not while an earlier one is
+            yield _fail, (str(e),)
+            return
+        step = max(Config.EXTRACTION_PAGES_PER_TASK, 1)
+        for start in range(0, page_count, step):
+            yield _extract_pdf_pages, (path, start, min(start + step, page_count))
+    elif document_format == "docx":
+        yield _extract_docx, (path,)
+    elif document_format == "html":
+        yield _extract_html, (path,)
+
+
+class _InlineTask:
+    """A task run in the calling thread when its result is needed, for use without a pool"""
+
+    def __init__(self, function: Callable[..., str], args: tuple):
+        self._function = function
+        self._args = args
+
+    def result(self) -> str:
+        return self._function(*self._args)
+
+    def cancel(self) -> bool:
+        return True
+
+
+def iter_extracted_documents(sources: Sequence[Tuple[str, str]], executor: Optional[Executor] = None,
+                             read_size: int = Config.UPLOAD_READ_SIZE) -> Iterator[Iterator[str]]:
+    """Yield, for each (path, format) source, an iterator over its extracted text pieces
+
+    Tasks of all sources are submitted to the pool in order, keeping a few
+    per worker process in flight, so the next pages and files are parsed
+    while earlier text is being chunked. Extraction errors are raised as
+    ValueError from the piece iterator of the failing document. Tasks left
+    over by a failed, skipped or abandoned document are cancelled.
+    """
+    executor = executor if executor is not None else get_executor()
+    window = 2 * Config.EXTRACTION_PROCESSES if executor is not None else 1
+    tasks = ((index, function, args) for index, (path, document_format) in enumerate(sources)
+             for function, args in _tasks(path, document_format))
+    pending: Deque[Tuple[int, object]] = deque()
+
+    def fill():
+        while len(pending) < window:
+            task = next(tasks, None)
+            if task is None:
+                return
+            index, function, args = task
+            pending.append((index, executor.submit(function, *args) if executor is not None
+                            else _InlineTask(function, args)))
+
+    def discard(before: int):
+        """Cancel the tasks of the documents before ``before``, submitting later ones in their place"""
+        fill()
+        while pending and pending[0][0] < before:
+            pending.popleft()[1].cancel()
+            fill()
+
+    def pieces(index: int) -> Iterator[str]:
+        path, document_format = sources[index]
+        if document_format == "text":
+            with open(path, "rb") as f:
+                yield from iter_decoded(f, read_size=read_size)
+            return
+        try:
+            while True:
+                # Tasks of documents the consumer skipped or stopped reading are dropped
+                discard(index)
+                if not pending or pending[0][0] != index:
+                    return
+                text = pending.popleft()[1].result()
+                if text:
+                    yield text + "\n\n"
+        except Exception as e:
+            discard(index + 1)
+            raise ValueError(f"Could not extract text from {document_format.upper()} document: {e}")
+
+    try:
+        for index in range(len(sources)):
+            yield pieces(index)
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _lower_priority():
+    # Extraction yields the CPU to request handling where the OS allows it
+    try:
+        os.nice(Config.INGEST_WORKER_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def get_executor() -> Optional[ProcessPoolExecutor]:
+    """The shared extraction process pool, started on first use; None if EXTRACTION_PROCESSES is 0"""
+    global _executor
+    if Config.EXTRACTION_PROCESSES <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # Forking a threaded server can deadlock in the child, so workers are spawned
+            _executor = ProcessPoolExecutor(max_workers=Config.EXTRACTION_PROCESSES,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_lower_priority)
+            logger.info(f"Started {Config.EXTRACTION_PROCESSES} document extraction processes")
+        return _executor
+
+
+@atexit.register
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+            _executor = None
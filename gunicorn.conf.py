@@ -0,0 +1,58 @@
+"""
+Gunicorn settings for the Enhanced Healthcare QA System API
+
+    gunicorn -c gunicorn.conf.py enhanced_full_api:app
+
+Every worker builds its own QA engine after the fork, on a startup thread
+so that it passes liveness probes at once; /api/v1/health/ready reports
+when it can take questions. Uploaded documents
+are shared between workers through memory-mapped segment files, so an
+upload handled by one worker is answered from by all of them, and
+documents evicted by the retention limits on one worker are dropped by
+all of them. Prometheus metrics of all workers are aggregated through
+PROMETHEUS_MULTIPROC_DIR.
+
+Background ingestion jobs and document content hashes are kept in the
+SQLite document store, so a job can be polled on any worker, re-sent
+documents are recognised whichever worker ingested them, and jobs left
+unfinished by a stopped worker are resumed by the next one to start. With
+DOCUMENT_STORE_ENABLED=False all of this is per worker; run a single
+worker (WEB_CONCURRENCY=1) then.
+
+Behind a reverse proxy, set PROXY_TRUSTED_HOPS to the number of proxies so
+rate limits apply per client rather than per proxy address.
+"""
+
+import os
+import shutil
+
+os.environ.setdefault("SEGMENTS_ENABLED", "True")
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/hqa-metrics")
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+# Per-worker pools such as EXTRACTION_PROCESSES are sized by the number of workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = 120
+
+
+def on_starting(server):
+    # Values left by a previous run would be aggregated into this one
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def post_fork(server, worker):
+    import enhanced_full_api
+
+    enhanced_full_api.initialize_qa_engine(background=enhanced_full_api.Config.BACKGROUND_STARTUP)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,410 @@
+"""
+Streaming document ingestion for the Healthcare BERT QA System
+
+Uploads are read in fixed-size blocks and decoded incrementally, so neither
+the raw bytes nor the decoded text of a whole upload are held at once. The
+same applies to JSON uploads, whose ``documents`` array is parsed one element
+at a time.
+
+Uploads are processed by a pool of background workers fed from a bounded
+queue; each upload is tracked as an ``IngestionJob`` whose progress can be
+polled while its documents are staged and committed in batches. With a
+document store, jobs are also recorded in the database shared by all worker
+processes: any of them can report a job's status, and jobs left unfinished
+by a process that stopped are resumed by the next one to start.
+"""
+
+import codecs
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from chunking import PreparedDocument
+from config import Config
+from dedup import MinHashLSH
+from documents import DocumentRecord
+from retrieval import IndexBatch
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = " \t\r\n"
+
+
+def iter_decoded(stream: BinaryIO, encoding: str = "utf-8",
+                 read_size: int = Config.UPLOAD_READ_SIZE) -> Iterator[str]:
+    """Yield the text of a binary stream block by block
+
+    Raises UnicodeDecodeError as soon as an undecodable block is reached.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+class _StreamReader:
+    """Incremental JSON tokenizer over a stream of decoded text blocks"""
+
+    def __init__(self, blocks: Iterator[str]):
+        self._blocks = blocks
+        self._decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+
+    def _read_more(self, minimum: int) -> bool:
+        """Append at least ``minimum`` characters to the buffer, unless the stream ends"""
+        # Drop consumed text so the buffer only holds the value being parsed
+        pieces = [self.buffer[self.pos:]]
+        self.pos = 0
+        added = 0
+        while added < minimum:
+            block = next(self._blocks, None)
+            if block is None:
+                self.exhausted = True
+                break
+            pieces.append(block)
+            added += len(block)
+        self.buffer = "".join(pieces)
+        return added > 0
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it ('' at the end)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.exhausted or not self._read_more(1):
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"Invalid JSON: expected '{char}'")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next JSON value, reading more text until it is complete"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next block
+                if end < len(self.buffer) or self.exhausted:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise ValueError("Invalid JSON document")
+            # Grow geometrically so a large value is re-parsed O(log n) times
+            self._read_more(max(len(self.buffer) - self.pos, 1024))
+
+
+def iter_json_documents(blocks: Iterator[str], key: str = "documents") -> Iterator[Optional[str]]:
+    """Yield the texts of the ``documents`` array of a streamed JSON object
+
+    Elements may be strings or objects with a ``text`` field; other elements
+    yield None so callers can count them as skipped. Raises ValueError if the
+    body is not an object with a ``documents`` list.
+    """
+    reader = _StreamReader(blocks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        raise ValueError("Documents are required")
+
+    while True:
+        name = reader.value()
+        reader.expect(":")
+        if name == key:
+            break
+        reader.value()
+        if reader.peek() != ",":
+            raise ValueError("Documents are required")
+        reader.expect(",")
+
+    if reader.peek() != "[":
+        raise ValueError("Documents must be a list")
+    reader.expect("[")
+    if reader.peek() == "]":
+        return
+
+    while True:
+        document = reader.value()
+        if isinstance(document, str):
+            yield document
+        elif isinstance(document, dict) and isinstance(document.get('text'), str):
+            yield document['text']
+        else:
+            yield None
+
+        separator = reader.peek()
+        if separator == "]":
+            return
+        reader.expect(",")
+
+
+def spool_stream(stream: BinaryIO, read_size: int = Config.UPLOAD_READ_SIZE,
+                 directory: Path = Config.UPLOAD_SPOOL_DIR) -> str:
+    """Copy a request stream to a spool file block by block and return its path
+
+    Spool files live in the data directory, so queued uploads survive a restart.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(prefix="hqa-upload-", dir=directory, delete=False) as spool:
+        while True:
+            block = stream.read(read_size)
+            if not block:
+                break
+            spool.write(block)
+    return spool.name
+
+
+class IngestBatch:
+    """Document parts staged for one atomic commit into the engine's indexes
+
+    Chunking and tokenizing happen while staging, so committing only appends
+    prepared arrays under the index lock.
+    """
+
+    def __init__(self):
+        self.documents: List[PreparedDocument] = []
+        self.chunk_texts: List[str] = []
+        self.index_batch = IndexBatch()
+        self.document_infos: List[DocumentRecord] = []
+        self.characters = 0
+        # MinHash signature of each staged chunk, and their index for duplicates within the batch
+        self.signatures: List[np.ndarray] = []
+        self.near_duplicates: Optional[MinHashLSH] = None
+        # (entity, section, staged part, sentence within the part, staged chunk) of recognized entities
+        self.entities: List[Tuple[str, str, int, int, int]] = []
+
+    def mark(self) -> Tuple[int, int, int, int]:
+        """Return the current staging position, for ``rollback``"""
+        return len(self.documents), len(self.chunk_texts), len(self.index_batch), self.characters
+
+    def rollback(self, mark: Tuple[int, int, int, int]):
+        """Drop everything staged after ``mark``"""
+        documents, chunk_texts, passages, self.characters = mark
+        del self.documents[documents:]
+        del self.chunk_texts[chunk_texts:]
+        self.index_batch.truncate(passages)
+        if self.signatures:
+            del self.signatures[chunk_texts:]
+            self.near_duplicates.truncate(chunk_texts)
+        while self.entities and self.entities[-1][2] >= documents:
+            self.entities.pop()
+
+
+class IngestionJob:
+    """Status and progress of one background upload"""
+
+    def __init__(self, description: str, work: Callable[["IngestionJob"], None], job_id: Optional[str] = None,
+                 created_at: Optional[float] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.description = description
+        self.work = work
+        self.status = "queued"
+        self.created_at = created_at or time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.documents_processed = 0
+        self.documents_committed = 0
+        self.documents_skipped = 0
+        self.characters_processed = 0
+        self.error: Optional[str] = None
+        # Document store recording the job for other worker processes, if any
+        self.store = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def save(self, **kwargs):
+        """Record the job's progress in the document store; failures only cost status updates"""
+        if self.store is None:
+            return
+        try:
+            self.store.save_job(self.to_dict(), **kwargs)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not record ingestion job {self.id}: {e}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "description": self.description,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "documents_processed": self.documents_processed,
+            "documents_committed": self.documents_committed,
+            "documents_skipped": self.documents_skipped,
+            "characters_processed": self.characters_processed,
+            "error": self.error,
+        }
+
+
+class IngestionQueue:
+    """Bounded queue of upload jobs processed by a pool of background workers
+
+    Workers start on the first submission. ``submit`` raises ``queue.Full``
+    when the queue is at capacity so the caller can shed the upload instead
+    of blocking a request thread.
+
+    Once ``use_store`` gives it the shared document store, every job is
+    recorded there with the spec it was submitted with, so it can be
+    reported by other processes and resumed after a restart.
+    """
+
+    def __init__(self, workers: int = Config.INGEST_WORKERS, max_pending: int = Config.INGEST_QUEUE_SIZE,
+                 history: int = Config.INGEST_JOB_HISTORY):
+        self.num_workers = workers
+        self.history = history
+        self.store = None
+        self._queue: "queue.Queue[IngestionJob]" = queue.Queue(maxsize=max_pending)
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+
+    def use_store(self, store):
+        """Record jobs in the shared document store from now on"""
+        self.store = store
+
+    def submit(self, description: str, work: Callable[[IngestionJob], None],
+               spec: Optional[Dict[str, Any]] = None) -> IngestionJob:
+        """Queue ``work`` to run in the background and return its job
+
+        ``spec`` is the JSON-serializable input from which ``resume`` can
+        recreate ``work`` in a later process.
+        """
+        self._start_workers()
+        job = IngestionJob(description, work)
+        job.store = self.store
+        # Recorded before queueing, so a worker's status updates cannot be overwritten
+        job.save(spec=spec, owner=os.getpid())
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            if self.store is not None:
+                self.store.delete_job(job.id)
+            raise
+        self._track(job)
+        return job
+
+    def _track(self, job: IngestionJob):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        if self.store is not None:
+            self.store.prune_jobs(self.history)
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the status of a job run by this process or, from the store, by any other"""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.store is None:
+            return None
+        return self.store.load_job(job_id)
+
+    def resume(self, make_work: Callable[[Dict[str, Any]], Callable[[IngestionJob], None]]) -> int:
+        """Queue again the unfinished jobs of processes that are no longer running
+
+        ``make_work`` recreates a job's work from its spec. Blocks while the
+        queue is full; returns the number of jobs resumed.
+        """
+        if self.store is None:
+            return 0
+        resumed = 0
+        for status, spec, owner in self.store.unfinished_jobs():
+            if self.get(status["job_id"]) is not None:
+                continue
+            # A restarted server may have reused the process ID of the job's owner for this process
+            if owner is not None and owner != os.getpid() and _process_alive(owner):
+                continue
+            if not self.store.claim_job(status["job_id"], owner, os.getpid()):
+                continue
+            job = IngestionJob(status["description"], make_work(spec), status["job_id"], status["created_at"])
+            job.store = self.store
+            job.save()
+            self._start_workers()
+            self._queue.put(job)
+            self._track(job)
+            resumed += 1
+        if resumed:
+            logger.info(f"Resumed {resumed} ingestion jobs left unfinished by stopped processes")
+        return resumed
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _forget_finished(self):
+        """Drop the oldest finished jobs beyond the history limit"""
+        excess = len(self._jobs) - self.history
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished][:max(excess, 0)]:
+            del self._jobs[job_id]
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.num_workers:
+                worker = threading.Thread(target=self._run, name=f"ingest-worker-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self):
+        # Ingestion yields the CPU to request threads where the OS allows it
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), Config.INGEST_WORKER_NICE)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            job.save()
+            try:
+                job.work(job)
+                job.status = "completed"
+            except Exception as e:
+                logger.error(f"Ingestion job {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                job.save()
+                self._queue.task_done()
+
+
+def _process_alive(pid: int) -> bool:
+    """Whether a process with this ID is running on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
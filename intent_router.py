@@ -0,0 +1,187 @@
+"""
+Intent routing for the Healthcare BERT QA System
+
+The knowledge-base question patterns are described as a rule table and compiled
+once into a single regular expression, so every intent keyword and entity in a
+question is found in one pass over the text.
+"""
+
+import re
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+KNOWLEDGE_BASE_SOURCE = "Medical Knowledge Base"
+
+
+class AnswerRule(NamedTuple):
+    """A knowledge-base answer selected when an intent and an entity co-occur
+
+    ``intents`` lists the keywords of which at least one must appear; an empty
+    tuple means the entity alone is enough. ``template`` is formatted with the
+    fields of ``medical_knowledge[topic]``, list fields joined by ``joiner``.
+    """
+    intents: Tuple[str, ...]
+    entities: Tuple[str, ...]
+    template: str
+    confidence: float
+    category: str
+    topic: Optional[str] = None
+    joiner: str = ", "
+
+
+SIDE_EFFECT_TERMS = ("side effect", "adverse effect", "reaction")
+SYMPTOM_TERMS = ("symptom", "sign")
+RISK_FACTOR_TERMS = ("risk factor", "cause")
+TREATMENT_TERMS = ("treatment", "therapy", "manage")
+
+# Evaluated in order; the first rule whose intent and entity both match wins
+ANSWER_RULES: List[AnswerRule] = [
+    AnswerRule(SIDE_EFFECT_TERMS, ("aspirin",),
+               "Common side effects of aspirin include: {side_effects}",
+               0.95, "medication_side_effects", topic="aspirin"),
+    AnswerRule(SYMPTOM_TERMS, ("diabetes",),
+               "Common symptoms of diabetes include: {symptoms}",
+               0.93, "disease_symptoms", topic="diabetes"),
+    AnswerRule(SYMPTOM_TERMS, ("pneumonia",),
+               "Common symptoms of pneumonia include: {symptoms}",
+               0.92, "disease_symptoms", topic="pneumonia"),
+    AnswerRule(RISK_FACTOR_TERMS, ("hypertension", "high blood pressure", "blood pressure"),
+               "Risk factors for hypertension include: {risk_factors}",
+               0.94, "risk_factors", topic="hypertension"),
+    AnswerRule(TREATMENT_TERMS, ("diabetes",),
+               "Diabetes management includes: {management}",
+               0.91, "treatment", topic="diabetes"),
+    AnswerRule(TREATMENT_TERMS, ("hypertension", "high blood pressure"),
+               "Hypertension treatment includes: {treatment}. Medications include: {medications}",
+               0.92, "treatment", topic="hypertension"),
+    AnswerRule((), ("insulin",),
+               "Types of insulin include: {types}",
+               0.90, "medication_types", topic="insulin", joiner="; "),
+    # Generic medical responses for common questions
+    AnswerRule((), ("what is diabetes",),
+               "Diabetes is a group of metabolic disorders characterized by high blood sugar levels. "
+               "Type 1 is autoimmune, Type 2 involves insulin resistance.",
+               0.88, "general_information"),
+    AnswerRule((), ("what is hypertension",),
+               "Hypertension is high blood pressure consistently above 140/90 mmHg, "
+               "a major risk factor for cardiovascular disease.",
+               0.87, "general_information"),
+    AnswerRule((), ("what is pneumonia",),
+               "Pneumonia is an infection that inflames air sacs in the lungs, which may fill "
+               "with fluid or pus, caused by bacteria, viruses, or fungi.",
+               0.86, "general_information"),
+]
+
+
+def trie_pattern(keywords: Iterable[str]) -> str:
+    """Build a regex alternation that shares common prefixes between keywords
+
+    Optional suffixes are greedy, so at any position the longest keyword wins.
+    """
+    trie: Dict[str, Any] = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def render(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return "(?:" + body + ")?"
+        return body
+
+    return render(trie)
+
+
+class IntentRouter:
+    """Routes questions to precompiled knowledge-base answers
+
+    All keywords from the rule table and all ``medical_knowledge`` topics are
+    compiled into one pattern at construction time. Responses are rendered
+    once, and every call returns a fresh copy, so the router is safe to share
+    between request threads.
+    """
+
+    def __init__(self, medical_knowledge: Dict[str, Dict[str, Any]],
+                 rules: Optional[List[AnswerRule]] = None):
+        self.rules = list(ANSWER_RULES if rules is None else rules)
+
+        keywords = set(medical_knowledge)
+        for rule in self.rules:
+            keywords.update(rule.intents)
+            keywords.update(rule.entities)
+
+        # A matched keyword also implies every keyword it contains, so the
+        # non-overlapping single pass still reports e.g. "blood pressure"
+        # inside "high blood pressure"
+        self._implied: Dict[str, FrozenSet[str]] = {
+            keyword: frozenset(other for other in keywords if other in keyword)
+            for keyword in keywords
+        }
+        self._pattern = re.compile(trie_pattern(sorted(keywords)))
+
+        # Only rules mentioning a matched entity are considered per question
+        self._rules_by_entity: Dict[str, List[int]] = {}
+        for position, rule in enumerate(self.rules):
+            for entity in rule.entities:
+                self._rules_by_entity.setdefault(entity, []).append(position)
+
+        self._responses = [self._render(rule, medical_knowledge) for rule in self.rules]
+        self.topics = frozenset(medical_knowledge)
+
+    @staticmethod
+    def _render(rule: AnswerRule, medical_knowledge: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Render the static answer for a rule"""
+        if rule.topic is None:
+            answer = rule.template
+        else:
+            fields = {
+                name: rule.joiner.join(value) if isinstance(value, list) else value
+                for name, value in medical_knowledge[rule.topic].items()
+            }
+            answer = rule.template.format(**fields)
+        return {
+            "answer": answer,
+            "confidence": rule.confidence,
+            "source": KNOWLEDGE_BASE_SOURCE,
+            "category": rule.category,
+        }
+
+    def match(self, question_lower: str) -> FrozenSet[str]:
+        """Return every rule keyword and knowledge-base topic found in the question"""
+        found = set()
+        for keyword in self._pattern.findall(question_lower):
+            found.update(self._implied[keyword])
+        return frozenset(found)
+
+    def route(self, question_lower: str) -> Optional[Dict[str, Any]]:
+        """Return the knowledge-base answer for a lowercased question, if any rule applies"""
+        return self.resolve(self.match(question_lower))
+
+    def resolve(self, found: FrozenSet[str]) -> Optional[Dict[str, Any]]:
+        """Return the answer of the first rule satisfied by the matched keywords"""
+        position = self.resolve_position(found)
+        return self.response(position) if position is not None else None
+
+    def response(self, position: int) -> Dict[str, Any]:
+        """Return a copy of the rendered answer of the rule at ``position``"""
+        return dict(self._responses[position])
+
+    def resolve_position(self, found: FrozenSet[str]) -> Optional[int]:
+        """Return the position of the first rule satisfied by the matched keywords"""
+        if not found:
+            return None
+
+        candidates = sorted({
+            position
+            for keyword in found
+            for position in self._rules_by_entity.get(keyword, ())
+        })
+        for position in candidates:
+            rule = self.rules[position]
+            if not rule.intents or not found.isdisjoint(rule.intents):
+                return position
+        return None
@@ -0,0 +1,117 @@
+"""
+Prometheus metrics for the Healthcare BERT QA System
+
+Metric children for fixed label values are bound once at import, so the hot
+path only pays for an observe/inc call. When ``PROMETHEUS_MULTIPROC_DIR`` is
+set (see gunicorn.conf.py), every worker writes its values to files in that
+directory and ``render_metrics`` aggregates all of them. Without
+prometheus-client, or with METRICS_ENABLED off, all metrics are no-ops.
+"""
+
+import os
+import threading
+from typing import Dict, Tuple
+
+from config import Config
+
+try:
+    from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                                   generate_latest, multiprocess)
+except ImportError:  # prometheus-client is optional at runtime
+    Counter = None
+
+# Stage timings range from microseconds (routing) to seconds (cold dense search)
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class _NoOpMetric:
+    """Stand-in accepting the metric calls used here when metrics are disabled"""
+
+    def labels(self, *args, **kwargs) -> "_NoOpMetric":
+        return self
+
+    def observe(self, value: float):
+        pass
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+
+ENABLED = Counter is not None and Config.METRICS_ENABLED
+
+if ENABLED:
+    _stage_seconds = Histogram("hqa_stage_seconds", "Time spent in each answer pipeline stage",
+                               ["stage"], buckets=STAGE_BUCKETS)
+    _answers = Counter("hqa_answers_total", "Answers returned, by category and source", ["category", "source"])
+    _cache_lookups = Counter("hqa_answer_cache_lookups_total", "Answer cache lookups, by result", ["result"])
+    REJECTED_REQUESTS = Counter("hqa_rejected_requests_total", "Requests rejected by admission control",
+                                ["budget", "reason"])
+    INFERENCE_BATCH_SIZE = Histogram("hqa_inference_batch_size", "Items per micro-batch run through the model",
+                                     buckets=BATCH_SIZE_BUCKETS)
+    INFERENCE_QUEUE_WAIT = Histogram("hqa_inference_queue_wait_seconds",
+                                     "Time items wait in the micro-batching queue", buckets=STAGE_BUCKETS)
+    INGESTED_DOCUMENTS = Counter("hqa_ingested_documents_total", "Documents ingested")
+    INGESTED_BYTES = Counter("hqa_ingested_bytes_total", "UTF-8 bytes of document text ingested")
+    INGEST_COMMIT_SECONDS = Histogram("hqa_ingest_commit_seconds", "Time to commit one ingestion batch",
+                                      buckets=STAGE_BUCKETS)
+    _deduplicated = Counter("hqa_deduplicated_total", "Duplicates skipped at ingestion, by kind", ["kind"])
+    _evicted = Counter("hqa_evicted_documents_total", "Documents evicted from memory, by retention policy",
+                       ["reason"])
+    # Workers sharing segments see the same corpus, so the maximum is the corpus size
+    CORPUS_DOCUMENTS = Gauge("hqa_corpus_documents", "Documents in the corpus", multiprocess_mode="max")
+    CORPUS_CHUNKS = Gauge("hqa_corpus_chunks", "Indexed chunks of uploaded documents", multiprocess_mode="max")
+    DENSE_VECTORS = Gauge("hqa_dense_vectors", "Vectors in the dense index", multiprocess_mode="max")
+    # Every worker holds its own in-memory corpus
+    CORPUS_MEMORY_BYTES = Gauge("hqa_corpus_memory_bytes", "Estimated memory of the in-memory corpus",
+                                multiprocess_mode="livesum")
+else:
+    _stage_seconds = _answers = _cache_lookups = REJECTED_REQUESTS = _NoOpMetric()
+    INFERENCE_BATCH_SIZE = INFERENCE_QUEUE_WAIT = _NoOpMetric()
+    INGESTED_DOCUMENTS = INGESTED_BYTES = INGEST_COMMIT_SECONDS = _deduplicated = _evicted = _NoOpMetric()
+    CORPUS_DOCUMENTS = CORPUS_CHUNKS = DENSE_VECTORS = CORPUS_MEMORY_BYTES = _NoOpMetric()
+
+STAGE_ROUTING = _stage_seconds.labels("intent_routing")
+STAGE_KNOWLEDGE_BASE = _stage_seconds.labels("knowledge_base")
+STAGE_UPLOADED_SEARCH = _stage_seconds.labels("uploaded_search")
+STAGE_READER = _stage_seconds.labels("reader")
+STAGE_SERIALIZATION = _stage_seconds.labels("serialization")
+CACHE_HITS = _cache_lookups.labels("hit")
+CACHE_MISSES = _cache_lookups.labels("miss")
+SEMANTIC_CACHE_HITS = _cache_lookups.labels("semantic_hit")
+EXACT_DUPLICATE_DOCUMENTS = _deduplicated.labels("exact_document")
+NEAR_DUPLICATE_DOCUMENTS = _deduplicated.labels("near_document")
+NEAR_DUPLICATE_CHUNKS = _deduplicated.labels("near_chunk")
+EVICTED_DOCUMENTS = {reason: _evicted.labels(reason) for reason in ("age", "quota", "budget")}
+
+_answer_children: Dict[Tuple[str, str], object] = {}
+_answer_lock = threading.Lock()
+
+
+def count_answer(result: Dict):
+    """Count an answer under its category and source"""
+    key = (result.get("category", "general"), result.get("source", "Medical Knowledge Base"))
+    child = _answer_children.get(key)
+    if child is None:
+        with _answer_lock:
+            child = _answer_children.setdefault(key, _answers.labels(*key))
+    child.inc()
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Return the exposition payload and its content type
+
+    In multiprocess mode the values of every worker are aggregated.
+    """
+    if not ENABLED:
+        raise RuntimeError("Metrics are disabled or prometheus-client is not installed")
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
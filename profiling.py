@@ -0,0 +1,199 @@
+"""
+Opt-in request profiling for the Healthcare BERT QA System
+
+With PROFILING_ENABLED, a PROFILING_SAMPLE_RATE fraction of requests (and
+every request sent with an ``X-Profile: 1`` header or ``?profile=1`` along
+with the PROFILING_ADMIN_TOKEN in ``X-Admin-Token``) runs under a profiler, and the results are aggregated per endpoint. Two profilers
+are available: ``sampling`` records the profiled thread's stack at a fixed
+interval from a helper thread and produces collapsed stacks for flame graphs;
+``cprofile`` produces pstats. When profiling is disabled the decorators
+return the view unchanged and ``maybe_profile`` is a shared null context.
+"""
+
+import cProfile
+import hmac
+import io
+import marshal
+import pstats
+import random
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Callable, Dict, Optional
+
+from config import Config
+
+_NULL_CONTEXT = nullcontext()
+
+
+class _StackSampler:
+    """Samples one thread's Python stack at a fixed interval from a helper thread"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class RequestProfiler:
+    """Profiles sampled requests and aggregates the results per endpoint"""
+
+    def __init__(self, enabled: bool = Config.PROFILING_ENABLED, sample_rate: float = Config.PROFILING_SAMPLE_RATE,
+                 mode: str = Config.PROFILING_MODE, interval: float = Config.PROFILING_INTERVAL):
+        if mode not in ("sampling", "cprofile"):
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Only one cProfile profiler may be active at a time in recent Pythons
+        self._cprofile_lock = threading.Lock()
+        self.requests: Counter = Counter()
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._stacks: Dict[str, Counter] = {}
+
+    def should_profile(self, forced: bool = False) -> bool:
+        return self.enabled and (forced or random.random() < self.sample_rate)
+
+    def maybe_profile(self, endpoint: str, forced: bool = False):
+        """Return a context that profiles its body if this call is sampled"""
+        if not self.should_profile(forced):
+            return _NULL_CONTEXT
+        return self.profile(endpoint)
+
+    @contextmanager
+    def profile(self, endpoint: str):
+        """Profile the body of the context under ``endpoint``"""
+        if self.mode == "cprofile":
+            if not self._cprofile_lock.acquire(blocking=False):
+                # Another request is being profiled; run this one unprofiled
+                yield
+                return
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+            finally:
+                self._cprofile_lock.release()
+            with self._lock:
+                self.requests[endpoint] += 1
+                if endpoint in self._stats:
+                    self._stats[endpoint].add(profile)
+                else:
+                    self._stats[endpoint] = pstats.Stats(profile)
+            return
+
+        sampler = _StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            stacks = sampler.stop()
+            with self._lock:
+                self.requests[endpoint] += 1
+                self._stacks.setdefault(endpoint, Counter()).update(stacks)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "mode": self.mode,
+                "sample_rate": self.sample_rate,
+                "endpoints": dict(self.requests),
+            }
+
+    def collapsed(self, endpoint: str) -> str:
+        """Return aggregated stacks in collapsed format, one ``frame;frame count`` per line"""
+        with self._lock:
+            stacks = self._stacks.get(endpoint, Counter())
+            return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def pstats_text(self, endpoint: str, sort: str = "cumulative", limit: int = 50) -> str:
+        buffer = io.StringIO()
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                return ""
+            stats.stream = buffer
+            stats.sort_stats(sort).print_stats(limit)
+        return buffer.getvalue()
+
+    def pstats_dump(self, endpoint: str) -> Optional[bytes]:
+        """Return aggregated stats in the binary format read by ``pstats.Stats(path)``"""
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            return marshal.dumps(stats.stats) if stats is not None else None
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self._stats.clear()
+            self._stacks.clear()
+
+
+profiler = RequestProfiler()
+
+
+def admin_authorized() -> bool:
+    """Return True if the current request carries the profiling admin token
+
+    Always False while PROFILING_ADMIN_TOKEN is unset, so profiling can
+    only be steered by clients once a token is configured.
+    """
+    from flask import request
+
+    token = Config.PROFILING_ADMIN_TOKEN
+    return bool(token) and hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token)
+
+
+def profile_requested() -> bool:
+    """Return True if the current request asks to be profiled and may do so"""
+    from flask import request
+
+    flagged = request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1"
+    return flagged and admin_authorized()
+
+
+def profiled(endpoint: str) -> Callable:
+    """Decorate a Flask view so sampled or flagged requests are profiled
+
+    Returns the view itself when profiling is disabled, so disabled
+    profiling adds no work to the request path.
+    """
+    def decorator(view: Callable) -> Callable:
+        if not profiler.enabled:
+            return view
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with profiler.maybe_profile(endpoint, profile_requested()):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
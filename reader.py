@@ -0,0 +1,246 @@
+"""
+Extractive reader for the Healthcare BERT QA System
+
+A BERT-family question-answering checkpoint (for example BioBERT fine-tuned
+on SQuAD or BioASQ) is loaded from a local directory and run on CPU over the
+top retrieved chunks. Linear layers are dynamically quantized to int8,
+question/passage pairs are sorted by length and padded only up to the next
+length bucket, and torch's thread count is fixed so that several workers do
+not oversubscribe the cores. Each question's answer is the best span over
+its passages, scored by the product of its start and end probabilities.
+Questions from concurrent requests are collected into micro-batches so the
+model runs once per batch rather than once per request.
+
+Run ``python reader.py --create-test-checkpoint DIR`` to write a tiny
+randomly initialized checkpoint for exercising the reader offline.
+"""
+
+import argparse
+import logging
+import os
+import re
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from batching import MicroBatcher
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Candidate start and end positions considered per passage window
+_TOP_POSITIONS = 20
+
+
+class ReaderAnswer(NamedTuple):
+    """An answer span: its text, score, and position within one of the passages read"""
+    text: str
+    score: float
+    passage: int
+    start: int
+    end: int
+
+
+class ExtractiveReader:
+    """Question-answering model reading answer spans out of passages on CPU"""
+
+    def __init__(self, model_dir: Path, max_length: int = Config.MAX_SEQUENCE_LENGTH,
+                 max_answer_tokens: int = Config.MAX_ANSWER_LENGTH, batch_size: int = Config.READER_BATCH_SIZE,
+                 threads: int = Config.READER_THREADS, quantize: bool = Config.READER_QUANTIZE,
+                 bucket_size: int = Config.READER_BUCKET_SIZE, stride: int = Config.READER_DOC_STRIDE):
+        import torch
+        from transformers import AutoModelForQuestionAnswering, AutoTokenizer
+
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir), local_files_only=True, use_fast=True)
+        if not self.tokenizer.is_fast:
+            raise ValueError(f"A fast tokenizer is required for answer offsets: {model_dir}")
+
+        model = AutoModelForQuestionAnswering.from_pretrained(str(model_dir), local_files_only=True)
+        model.eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self._torch = torch
+
+        self.max_length = min(max_length, self.tokenizer.model_max_length)
+        self.max_answer_tokens = max_answer_tokens
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.stride = min(stride, self.max_length // 2)
+        self._uses_token_types = "token_type_ids" in self.tokenizer.model_input_names
+        logger.info(f"Extractive reader loaded from {model_dir} (quantized: {quantize}, "
+                    f"threads: {torch.get_num_threads()})")
+
+    def read(self, question: str, passages: Sequence[str]) -> Optional[ReaderAnswer]:
+        return self.read_many([question], [passages])[0]
+
+    def read_many(self, questions: Sequence[str], passages: Sequence[Sequence[str]]) -> List[Optional[ReaderAnswer]]:
+        """Return the best answer span of each question over its passages, or None if it has none"""
+        pairs = [(question_id, passage_id) for question_id, question_passages in enumerate(passages)
+                 for passage_id, passage in enumerate(question_passages) if passage.strip()]
+        best: List[Optional[ReaderAnswer]] = [None] * len(questions)
+        if not pairs:
+            return best
+
+        # Passages longer than the window are split into overlapping windows
+        encodings = self.tokenizer(
+            [questions[question_id] for question_id, _ in pairs],
+            [passages[question_id][passage_id] for question_id, passage_id in pairs],
+            truncation="only_second", max_length=self.max_length, stride=self.stride,
+            return_overflowing_tokens=True, return_offsets_mapping=True, padding=False)
+        windows = encodings["input_ids"]
+
+        # Similar lengths share a batch, so padding stays within one bucket
+        order = sorted(range(len(windows)), key=lambda window: len(windows[window]))
+        for batch_start in range(0, len(order), self.batch_size):
+            batch = order[batch_start:batch_start + self.batch_size]
+            start_logits, end_logits = self._run(encodings, batch)
+            for row, window in enumerate(batch):
+                question_id, passage_id = pairs[encodings["overflow_to_sample_mapping"][window]]
+                answer = self._best_span(encodings, window, start_logits[row], end_logits[row],
+                                         passages[question_id][passage_id], passage_id)
+                if answer is not None and (best[question_id] is None or answer.score > best[question_id].score):
+                    best[question_id] = answer
+        return best
+
+    def _run(self, encodings, batch: List[int]):
+        """Run the model over windows padded to the batch's length bucket"""
+        longest = max(len(encodings["input_ids"][window]) for window in batch)
+        padded_length = min(self.max_length, -(-longest // self.bucket_size) * self.bucket_size)
+
+        input_ids = np.full((len(batch), padded_length), self.tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(batch), padded_length), dtype=np.int64)
+        token_type_ids = np.zeros((len(batch), padded_length), dtype=np.int64)
+        for row, window in enumerate(batch):
+            length = len(encodings["input_ids"][window])
+            input_ids[row, :length] = encodings["input_ids"][window]
+            attention_mask[row, :length] = 1
+            if self._uses_token_types:
+                token_type_ids[row, :length] = encodings["token_type_ids"][window]
+
+        torch = self._torch
+        inputs = {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+        if self._uses_token_types:
+            inputs["token_type_ids"] = torch.from_numpy(token_type_ids)
+        with torch.inference_mode():
+            outputs = self.model(**inputs)
+        return outputs.start_logits.float().numpy(), outputs.end_logits.float().numpy()
+
+    def _best_span(self, encodings, window: int, start_logits: np.ndarray, end_logits: np.ndarray,
+                   passage: str, passage_id: int) -> Optional[ReaderAnswer]:
+        """Pick the highest-probability valid span of one window"""
+        length = len(encodings["input_ids"][window])
+        start_probs = _softmax(start_logits[:length])
+        end_probs = _softmax(end_logits[:length])
+        # Only passage tokens can start or end an answer
+        context = np.array([sequence == 1 for sequence in encodings.sequence_ids(window)])
+        start_probs = np.where(context, start_probs, 0.0)
+        end_probs = np.where(context, end_probs, 0.0)
+
+        starts = np.argsort(start_probs)[::-1][:_TOP_POSITIONS]
+        ends = np.argsort(end_probs)[::-1][:_TOP_POSITIONS]
+        best_score, best_start, best_end = 0.0, -1, -1
+        for start in starts:
+            if not context[start]:
+                break
+            for end in ends:
+                if not context[end]:
+                    break
+                if start <= end < start + self.max_answer_tokens:
+                    score = float(start_probs[start] * end_probs[end])
+                    if score > best_score:
+                        best_score, best_start, best_end = score, start, end
+        if best_start < 0:
+            return None
+
+        offsets = encodings["offset_mapping"][window]
+        char_start, char_end = offsets[best_start][0], offsets[best_end][1]
+        text = passage[char_start:char_end].strip()
+        return ReaderAnswer(text, best_score, passage_id, char_start, char_end) if text else None
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    exponents = np.exp(logits - logits.max())
+    return exponents / exponents.sum()
+
+
+class BatchingReader:
+    """Reader whose questions from concurrent requests share micro-batches
+
+    ``read_many`` raises ``TimeoutError`` if its answers are not ready within
+    ``timeout`` seconds; its questions that have not started are cancelled.
+    It raises ``BatcherFull`` at once when ``max_pending`` questions are
+    already waiting.
+    """
+
+    def __init__(self, reader: ExtractiveReader, max_batch_size: int = Config.READER_MAX_BATCH_SIZE,
+                 max_wait_ms: float = Config.READER_MAX_WAIT_MS, timeout: float = Config.READER_TIMEOUT,
+                 max_pending: int = Config.READER_MAX_PENDING):
+        self.reader = reader
+        self.timeout = timeout
+        self.batcher = MicroBatcher(self._read_batch, max_batch_size, max_wait_ms / 1000.0, max_pending,
+                                    name="reader-batcher")
+
+    def _read_batch(self, items: List[tuple]) -> List[Optional[ReaderAnswer]]:
+        return self.reader.read_many([question for question, _ in items], [passages for _, passages in items])
+
+    def read(self, question: str, passages: Sequence[str]) -> Optional[ReaderAnswer]:
+        return self.read_many([question], [passages])[0]
+
+    def read_many(self, questions: Sequence[str], passages: Sequence[Sequence[str]]) -> List[Optional[ReaderAnswer]]:
+        return self.batcher.run_many(list(zip(questions, passages)), self.timeout)
+
+
+def create_reader():
+    """Load the reader described by the configuration, or None if it is disabled or unavailable
+
+    The reader is wrapped in a ``BatchingReader`` unless READER_MAX_BATCH_SIZE is 1.
+    """
+    if not Config.READER_ENABLED:
+        return None
+    try:
+        reader = ExtractiveReader(Config.READER_MODEL_DIR)
+    except Exception as e:
+        logger.warning(f"Extractive reader disabled: {e}")
+        return None
+    return BatchingReader(reader) if Config.READER_MAX_BATCH_SIZE > 1 else reader
+
+
+def save_test_checkpoint(directory: Path, texts: Sequence[str] = ()):
+    """Write a tiny randomly initialized BERT question-answering checkpoint
+
+    Its vocabulary covers the lowercased words of ``texts``. The spans it
+    returns are meaningless, but it exercises the full reader path quickly.
+    """
+    from transformers import BertConfig, BertForQuestionAnswering, BertTokenizerFast
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    words = sorted({word for text in texts for word in re.findall(r"\w+|[^\w\s]", text.lower())})
+    vocabulary = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words
+    vocab_path = directory / "vocab.txt"
+    vocab_path.write_text("\n".join(vocabulary) + "\n", encoding="utf-8")
+
+    BertTokenizerFast(vocab_file=str(vocab_path), do_lower_case=True).save_pretrained(str(directory))
+    config = BertConfig(vocab_size=len(vocabulary), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=64, max_position_embeddings=Config.MAX_SEQUENCE_LENGTH)
+    BertForQuestionAnswering(config).save_pretrained(str(directory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extractive reader utilities")
+    parser.add_argument("--create-test-checkpoint", metavar="DIR", required=True,
+                        help="write a tiny random checkpoint whose vocabulary covers the sample documents")
+    args = parser.parse_args()
+
+    docs_path = os.path.join(os.path.dirname(__file__), "sample_medical_documents.txt")
+    with open(docs_path, "r", encoding="utf-8") as f:
+        save_test_checkpoint(Path(args.create_test_checkpoint), [f.read()])
+    print(f"Test checkpoint written to {args.create_test_checkpoint}")
+
+
+if __name__ == "__main__":
+    main()
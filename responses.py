@@ -0,0 +1,66 @@
+"""
+Answer payloads for the Healthcare BERT QA System
+
+Knowledge-base answers are static, so each is formatted and JSON-encoded
+once, when the engine starts. A request for one only splices its own fields,
+the question and the processing time, between the prebuilt byte fragments.
+Encoding matches Flask's ``jsonify`` in production: sorted keys, compact
+separators and ASCII escapes. Under debug pretty-printing the API re-encodes
+the payload with ``jsonify`` instead.
+"""
+
+import json
+from typing import Any, Dict
+
+ENGINE_NAME = "Enhanced Medical QA Engine"
+DISCLAIMER = ("This system provides information for educational purposes only. "
+              "Always consult with qualified healthcare professionals for medical decisions.")
+
+# Placeholders for the per-request fields, encoded and then cut out of the payload
+_QUESTION = "\x00question"
+_PROCESSING_TIME = "\x00processing_time"
+
+
+def encode_json(value: Any) -> str:
+    """Encode a value the way ``jsonify`` does, without the trailing newline"""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def format_answer(question: str, result: Dict, processing_time: float, precision: int = 3) -> Dict:
+    """Format an engine result as an API answer"""
+    answer = {
+        "question": question,
+        "answer": result["answer"],
+        "confidence": result["confidence"],
+        "source": result.get("source", "Medical Knowledge Base"),
+        "category": result.get("category", "general"),
+        "processing_time": round(processing_time, precision),
+        "engine": ENGINE_NAME,
+        "disclaimer": DISCLAIMER
+    }
+    if result.get("context"):
+        answer["context"] = result["context"]
+    return answer
+
+
+class PrecompiledAnswer:
+    """A static engine result with its API answer encoded around the per-request fields"""
+
+    __slots__ = ("result", "_fragments")
+
+    def __init__(self, result: Dict):
+        self.result = result
+        answer = format_answer(_QUESTION, result, 0.0)
+        answer["processing_time"] = _PROCESSING_TIME
+        encoded = encode_json(answer)
+        question = encode_json(_QUESTION)
+        processing_time = encode_json(_PROCESSING_TIME)
+        # Sorted keys put "processing_time" before "question"
+        head, rest = encoded.split(processing_time)
+        middle, tail = rest.split(question)
+        self._fragments = (head, middle, tail)
+
+    def encode(self, question: str, processing_time: float, precision: int = 3) -> str:
+        """Return the JSON answer to ``question``, equal to encoding ``format_answer``"""
+        head, middle, tail = self._fragments
+        return head + encode_json(round(processing_time, precision)) + middle + encode_json(question) + tail
@@ -0,0 +1,360 @@
+"""
+Keyword retrieval for the Healthcare BERT QA System
+
+Provides the tokenizer shared by ingestion and querying, and an incrementally
+updated inverted index that ranks passages with BM25.
+"""
+
+import heapq
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Function words that carry no retrieval signal in medical questions
+STOPWORDS = frozenset("""
+a about above after again all am an and any are as at be been being before
+below between both but by can could did do does doing during each for from
+had has have having he her here hers him his how i if in into is it its
+itself just me more most my no nor not now of off on once only or other our
+out over own same she should so some such than that the their them then
+there these they this those through to too under until up very was we were
+what when where which while who whom why will with would you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase text and split it into alphanumeric terms, dropping stopwords"""
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+class IndexBatch:
+    """Passages staged for one atomic commit into an InvertedIndex
+
+    Tokenizing and building postings happens here, outside the index lock;
+    committing only appends the prepared arrays.
+    """
+
+    def __init__(self):
+        # term -> (local passage IDs, term frequencies)
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.lengths = array('I')
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, tokens: Iterable[str]) -> int:
+        """Stage one passage and return its position within the batch"""
+        term_counts: Dict[str, int] = {}
+        length = 0
+        for token in tokens:
+            term_counts[token] = term_counts.get(token, 0) + 1
+            length += 1
+
+        local_id = len(self.lengths)
+        for term, count in term_counts.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = (array('I'), array('I'))
+                self.postings[term] = postings
+            postings[0].append(local_id)
+            postings[1].append(count)
+        self.lengths.append(length)
+        return local_id
+
+    def truncate(self, length: int):
+        """Drop the staged passages from position ``length`` on"""
+        for term in list(self.postings):
+            local_ids, term_freqs = self.postings[term]
+            keep = bisect_left(local_ids, length)
+            if keep == 0:
+                del self.postings[term]
+            else:
+                del local_ids[keep:]
+                del term_freqs[keep:]
+        del self.lengths[length:]
+
+
+class InvertedIndex:
+    """BM25-ranked inverted index with incremental updates
+
+    Each indexed unit (a passage) gets a dense integer ID in insertion order, so
+    postings lists stay sorted and can be stored as compact arrays. Passages
+    are added in batches; searches only see passages below the visibility
+    watermark, which moves in one step when a batch commit has finished.
+
+    A term's postings are a list of runs in passage ID order. Committed
+    batches extend an in-memory run, while attached runs can be read-only
+    views (e.g. over a memory-mapped segment file) that are never copied.
+    Removed passages are filtered out of the runs; their IDs are not reused.
+    Committed passages keep the list of their distinct terms, so removing
+    them only rewrites those terms' runs; attached passages have none, and
+    removing one of them scans every term.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> runs of (passage IDs, term frequencies), sorted by passage ID
+        self._postings: Dict[str, List[Tuple[Sequence[int], Sequence[int]]]] = {}
+        self._lengths = array('I')
+        self._total_length = 0
+        self._removed = bytearray()
+        self._removed_count = 0
+        # Passage -> end of its distinct term IDs in _passage_terms, and whether it has no term list
+        self._term_ids: Dict[str, int] = {}
+        self._term_names: List[str] = []
+        self._passage_terms = array('I')
+        self._passage_term_ends = array('Q')
+        self._unlisted = bytearray()
+        # (visible passage ID bound, total length and count of the live passages below it),
+        # replaced as a whole on commit
+        self._visible = (0, 0, 0)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._visible[0]
+
+    @property
+    def live_count(self) -> int:
+        return self._visible[2]
+
+    @property
+    def vocabulary_size(self) -> int:
+        return len(self._postings)
+
+    def add(self, tokens: Iterable[str]) -> int:
+        """Index one passage and return its passage ID"""
+        batch = IndexBatch()
+        batch.add(tokens)
+        return self.commit(batch).start
+
+    def commit(self, batch: IndexBatch) -> range:
+        """Append a staged batch, make it searchable and return its passage IDs"""
+        with self._lock:
+            base = len(self._lengths)
+            owners, term_ids = [], []
+            for term, (local_ids, term_freqs) in batch.postings.items():
+                runs = self._postings.setdefault(term, [])
+                if not runs or not isinstance(runs[-1][0], array):
+                    runs.append((array('I'), array('I')))
+                runs[-1][0].extend(base + local_id for local_id in local_ids)
+                runs[-1][1].extend(term_freqs)
+                owners.append(np.asarray(local_ids, dtype=np.int64))
+                term_ids.append(np.full(len(local_ids), self._term_id(term), dtype=np.uint32))
+            self._list_terms(len(batch.lengths), owners, term_ids)
+            return self._publish(base, batch.lengths)
+
+    def _term_id(self, term: str) -> int:
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = self._term_ids[term] = len(self._term_names)
+            self._term_names.append(term)
+        return term_id
+
+    def _list_terms(self, count: int, owners: List[np.ndarray], term_ids: List[np.ndarray], listed: bool = True):
+        """Append the term lists of ``count`` new passages from their (local passage ID, term ID) pairs"""
+        end = self._passage_term_ends[-1] if self._passage_term_ends else 0
+        if owners:
+            owners_all = np.concatenate(owners)
+            order = np.argsort(owners_all, kind="stable")
+            self._passage_terms.frombytes(np.concatenate(term_ids)[order].tobytes())
+            ends = end + np.cumsum(np.bincount(owners_all, minlength=count)[:count])
+            self._passage_term_ends.extend(ends.tolist())
+        else:
+            self._passage_term_ends.extend([end] * count)
+        self._unlisted.extend(bytes(count) if listed else b"\x01" * count)
+
+    def attach(self, lengths: Sequence[int], postings: Iterable[Tuple[str, Sequence[int], Sequence[int]]]) -> range:
+        """Append passages whose postings are already built, without copying them
+
+        ``postings`` yields (term, passage IDs, term frequencies) with IDs
+        numbered from the current end of the index.
+        """
+        with self._lock:
+            for term, passage_ids, term_freqs in postings:
+                self._postings.setdefault(term, []).append((passage_ids, term_freqs))
+            # Listing their terms would read every attached posting
+            self._list_terms(len(lengths), [], [], listed=False)
+            return self._publish(len(self._lengths), lengths)
+
+    def _publish(self, base: int, lengths: Sequence[int]) -> range:
+        self._lengths.extend(lengths)
+        self._total_length += sum(lengths)
+        self._visible = (len(self._lengths), self._total_length, len(self._lengths) - self._removed_count)
+        return range(base, len(self._lengths))
+
+    def passage_length(self, passage_id: int) -> int:
+        """Number of indexed tokens of a passage"""
+        return self._lengths[passage_id]
+
+    def remove(self, passage_ids: Iterable[int]) -> int:
+        """Drop passages from the index and return how many were removed
+
+        Only the runs of the removed passages' terms are looked at. Runs
+        holding any of them are rewritten as in-memory copies and swapped in
+        whole, so a concurrent search sees either version of a term's
+        postings.
+        """
+        with self._lock:
+            self._removed.extend(bytes(len(self._lengths) - len(self._removed)))
+            removed_ids = []
+            for passage_id in passage_ids:
+                if 0 <= passage_id < len(self._lengths) and not self._removed[passage_id]:
+                    self._removed[passage_id] = 1
+                    removed_ids.append(passage_id)
+                    self._total_length -= self._lengths[passage_id]
+                    self._lengths[passage_id] = 0
+            if not removed_ids:
+                return 0
+
+            if any(self._unlisted[passage_id] for passage_id in removed_ids):
+                terms = list(self._postings)
+            else:
+                ends = self._passage_term_ends
+                term_ids = set()
+                for passage_id in removed_ids:
+                    term_ids.update(self._passage_terms[ends[passage_id - 1] if passage_id else 0:ends[passage_id]])
+                terms = [self._term_names[term_id] for term_id in term_ids]
+
+            removed = np.array(sorted(removed_ids), dtype=np.uint32)
+            for term in terms:
+                runs = self._postings.get(term)
+                if runs is None:
+                    continue
+                kept_runs = []
+                changed = False
+                for passage_ids_run, term_freqs in runs:
+                    run_ids = np.frombuffer(passage_ids_run, dtype=np.uint32)
+                    keep = ~np.isin(run_ids, removed, assume_unique=True)
+                    if keep.all():
+                        kept_runs.append((passage_ids_run, term_freqs))
+                        continue
+                    changed = True
+                    if keep.any():
+                        kept_runs.append((array('I', run_ids[keep].tolist()),
+                                          array('I', np.frombuffer(term_freqs, dtype=np.uint32)[keep].tolist())))
+                if not changed:
+                    continue
+                if kept_runs:
+                    self._postings[term] = kept_runs
+                else:
+                    del self._postings[term]
+
+            self._removed_count += len(removed_ids)
+            self._visible = (len(self._lengths), self._total_length, len(self._lengths) - self._removed_count)
+            return len(removed_ids)
+
+    def _term_weights(self, terms: Iterable[str], num_passages: int, live_passages: int) -> Dict[str, List[Tuple[float, float, Tuple[Sequence[int], Sequence[int]], int]]]:
+        """Look up visible postings runs and BM25 weights for each distinct term in the index"""
+        weights = {}
+        for term in set(terms):
+            runs = self._postings.get(term)
+            if runs is None:
+                continue
+            visible_runs = []
+            document_freq = 0
+            for postings in list(runs):
+                passage_ids = postings[0]
+                # Postings of a batch still being committed lie past the watermark
+                visible_end = len(passage_ids)
+                if visible_end and passage_ids[visible_end - 1] >= num_passages:
+                    visible_end = bisect_left(passage_ids, num_passages, 0, visible_end)
+                if visible_end:
+                    visible_runs.append((postings, visible_end))
+                    document_freq += visible_end
+            if document_freq == 0:
+                continue
+            idf = math.log(1.0 + (live_passages - document_freq + 0.5) / (document_freq + 0.5))
+            weights[term] = [(idf * (self.k1 + 1.0), idf, postings, visible_end)
+                             for postings, visible_end in visible_runs]
+        return weights
+
+    def search(self, query_tokens: Iterable[str], k: int = 5) -> List[Tuple[int, float]]:
+        """Return the top-k (passage ID, score) pairs for the query terms"""
+        return self.search_many([query_tokens], k)[0]
+
+    def search_many(self, queries: List[Iterable[str]], k: int = 5) -> List[List[Tuple[int, float]]]:
+        """Score several queries against one shared lookup of their terms"""
+        num_passages, total_length, live_passages = self._visible
+        if live_passages == 0 or k <= 0:
+            return [[] for _ in queries]
+
+        queries = [set(query) for query in queries]
+        weights = self._term_weights(set().union(*queries), num_passages, live_passages)
+        avg_length = total_length / live_passages or 1.0
+        return [self._top_k([run for term in query if term in weights for run in weights[term]], k, avg_length)
+                for query in queries]
+
+    def score(self, query_tokens: Iterable[str], passage_ids: Iterable[int]) -> Dict[int, float]:
+        """Return the BM25 scores of the given visible passages for the query terms"""
+        num_passages, total_length, live_passages = self._visible
+        scores = {passage_id: 0.0 for passage_id in passage_ids if passage_id < num_passages}
+        if live_passages == 0 or not scores:
+            return scores
+
+        k1 = self.k1
+        lengths = self._lengths
+        norm_a = k1 * (1.0 - self.b)
+        norm_b = k1 * self.b / (total_length / live_passages or 1.0)
+        for runs in self._term_weights(query_tokens, num_passages, live_passages).values():
+            for _, idf, (run_ids, term_freqs), visible_end in runs:
+                for passage_id in scores:
+                    pos = bisect_left(run_ids, passage_id, 0, visible_end)
+                    if pos < visible_end and run_ids[pos] == passage_id:
+                        tf = term_freqs[pos]
+                        scores[passage_id] += idf * tf * (k1 + 1.0) / (tf + norm_a + norm_b * lengths[passage_id])
+        return scores
+
+    def _top_k(self, terms: List[Tuple[float, float, Tuple[Sequence[int], Sequence[int]], int]], k: int,
+               avg_length: float) -> List[Tuple[int, float]]:
+        """Rank passages for one query's (bound, idf, postings, visible length) runs
+
+        A term's runs cover disjoint passages, so each run is scored as if it
+        were a separate term with the term's IDF. Runs are scored in
+        decreasing order of their maximum possible contribution. Once the k-th
+        best partial score exceeds what the remaining runs could add, no unseen
+        passage can enter the top-k, so the remaining postings are only probed
+        for existing candidates.
+        """
+        if not terms:
+            return []
+
+        terms = sorted(terms, key=lambda item: item[0], reverse=True)
+        remaining_bounds = [0.0] * (len(terms) + 1)
+        for i in range(len(terms) - 1, -1, -1):
+            remaining_bounds[i] = remaining_bounds[i + 1] + terms[i][0]
+
+        k1 = self.k1
+        lengths = self._lengths
+        norm_a = k1 * (1.0 - self.b)
+        norm_b = k1 * self.b / avg_length
+        scores: Dict[int, float] = {}
+
+        for i, (_, idf, (passage_ids, term_freqs), visible_end) in enumerate(terms):
+            remaining = remaining_bounds[i]
+            if len(scores) >= k:
+                threshold = heapq.nlargest(k, scores.values())[-1]
+                if threshold >= remaining:
+                    # Only candidates that can still reach the top-k are probed
+                    candidates = [pid for pid, score in scores.items() if score + remaining > threshold]
+                    for passage_id in candidates:
+                        pos = bisect_left(passage_ids, passage_id, 0, visible_end)
+                        if pos < visible_end and passage_ids[pos] == passage_id:
+                            tf = term_freqs[pos]
+                            scores[passage_id] += idf * tf * (k1 + 1.0) / (
+                                tf + norm_a + norm_b * lengths[passage_id])
+                    continue
+
+            for passage_id, tf in islice(zip(passage_ids, term_freqs), visible_end):
+                scores[passage_id] = scores.get(passage_id, 0.0) + idf * tf * (k1 + 1.0) / (
+                    tf + norm_a + norm_b * lengths[passage_id])
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,626 @@
+"""
+Shared corpus segments for the Healthcare BERT QA System
+
+Each committed ingestion batch can be written as an immutable segment file
+holding the chunk text with its folded copy and sentence keys (see
+chunking), sentence offsets, keyword postings, chunk vectors, MinHash
+signatures and entity postings of that batch. Worker processes memory-map
+segments read-only, so the page cache keeps one physical copy of the
+corpus per host however many workers serve it. A manifest lists the
+segments in commit order; writers append to it under an exclusive file
+lock, and readers pick up new entries by checking it.
+
+Runs of similar-sized segments are merged into one file and swapped into
+the manifest in a single replace, keeping every chunk and sentence ID, so
+the number of files and postings runs grows with the log of the corpus
+size rather than with the number of commits.
+
+Documents evicted by the retention policies are recorded as tombstones in
+the manifest. Every worker drops them from its indexes when it sees them,
+and merges leave their text out of the merged file.
+"""
+
+import fcntl
+import json
+import math
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Pattern, Sequence, Tuple
+
+import numpy as np
+
+from chunking import PreparedDocument, fold_text, sentence_key
+from retrieval import IndexBatch
+
+_MAGIC = b"HQASEG01"
+_ALIGNMENT = 8
+# Segments up to this size are in the smallest merge tier
+_MERGE_FLOOR_BYTES = 1024 * 1024
+
+
+def write_segment(path: Path, chunk_base: int, parts: Sequence[PreparedDocument], index_batch: IndexBatch,
+                  vector_keys: Sequence[int] = (), vectors: Optional[np.ndarray] = None,
+                  signatures: Sequence[np.ndarray] = (),
+                  entities: Iterable[Tuple[str, str, int, int, int]] = ()):
+    """Write one batch of chunked parts as a segment file, atomically
+
+    Chunk and passage IDs are stored globally numbered from ``chunk_base``.
+    Sentence offsets are converted to byte offsets into the UTF-8 text, so
+    readers can slice sentences straight out of the mapped file. Each part's
+    last sentence ends with a newline, so tokens never run across parts.
+    ``signatures`` holds the MinHash signature of every chunk, or nothing,
+    and ``entities`` the (entity, section, part, sentence within the part,
+    chunk within the batch) entries of ``IngestBatch.entities``.
+    """
+    text = bytearray()
+    sentence_offsets = np.zeros(sum(len(part.offsets) - 1 for part in parts) + 1, dtype='uint32')
+    chunk_first = []
+    chunk_end = []
+    sentence = 0
+    part_sentence_bases = []
+    part_first_chunks = []
+    for part in parts:
+        part_sentence_bases.append(sentence)
+        part_first_chunks.append(len(chunk_first))
+        for first, end in part.chunks:
+            chunk_first.append(sentence + first)
+            chunk_end.append(sentence + end)
+        encoded, offsets = part.encode()
+        count = len(offsets) - 1
+        sentence_offsets[sentence:sentence + count] = np.asarray(offsets[:count], dtype='uint32') + len(text)
+        text += encoded
+        text += b"\n"
+        sentence += count
+    sentence_offsets[sentence] = len(text)
+    folded = fold_text(text)
+    sentence_keys = np.fromiter((sentence_key(folded, sentence_offsets[i], sentence_offsets[i + 1])
+                                 for i in range(sentence)), dtype='uint32', count=sentence)
+
+    terms = {}
+    passage_ids = []
+    term_freqs = []
+    position = 0
+    for term, (local_ids, freqs) in index_batch.postings.items():
+        terms[term] = [position, len(local_ids)]
+        passage_ids.append(np.frombuffer(local_ids, dtype='uint32') + np.uint32(chunk_base))
+        term_freqs.append(np.frombuffer(freqs, dtype='uint32'))
+        position += len(local_ids)
+
+    # Entity postings are numbered like the chunk table: sentences within the segment, chunks globally
+    grouped: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+    for entity, section, part, part_sentence, chunk in entities:
+        grouped.setdefault((entity, section), []).append((part_sentence_bases[part] + part_sentence,
+                                                          chunk_base + chunk))
+    entity_keys, entity_postings = _pack_entities(grouped)
+
+    if vectors is None:
+        vectors = np.zeros((0, 0), dtype='float32')
+    signatures = np.asarray(signatures, dtype='uint32')
+    _write_file(path, {
+        "chunk_base": chunk_base,
+        "num_chunks": len(chunk_first),
+        "num_sentences": sentence,
+        "dimension": int(vectors.shape[1]) if vectors.size else 0,
+        "signature_size": int(signatures.shape[1]) if signatures.size else 0,
+        "terms": terms,
+        "entities": entity_keys,
+    }, {
+        "text": bytes(text),
+        "folded": folded,
+        "sentence_keys": sentence_keys.tobytes(),
+        "sentence_offsets": sentence_offsets.tobytes(),
+        "chunk_first": np.asarray(chunk_first, dtype='uint32').tobytes(),
+        "chunk_end": np.asarray(chunk_end, dtype='uint32').tobytes(),
+        "lengths": np.frombuffer(index_batch.lengths, dtype='uint32').tobytes(),
+        "passage_ids": np.concatenate(passage_ids).tobytes() if passage_ids else b"",
+        "term_freqs": np.concatenate(term_freqs).tobytes() if term_freqs else b"",
+        "vector_keys": np.asarray(vector_keys, dtype='uint64').tobytes(),
+        "vectors": np.ascontiguousarray(vectors, dtype='float32').tobytes(),
+        "signatures": signatures.tobytes(),
+        "entity_sentences": entity_postings[:, 0].tobytes(),
+        "entity_chunks": entity_postings[:, 1].tobytes(),
+        "part_owners": np.asarray([part.document_id for part in parts], dtype='int64').tobytes(),
+        "part_first_chunk": np.asarray(part_first_chunks, dtype='uint32').tobytes(),
+        "part_first_sentence": np.asarray(part_sentence_bases, dtype='uint32').tobytes(),
+    })
+
+
+def merge_segments(path: Path, segments: Sequence["Segment"], tombstones: Iterable[int] = ()):
+    """Write consecutive segments as one segment file, atomically
+
+    Chunk, passage and sentence IDs are the same as across the merged
+    segments, so readers can switch to the merged file without renumbering
+    anything they indexed. Parts of the evicted documents in ``tombstones``
+    are left out: their sentences are empty and their chunks have no
+    postings, vectors or entities. Vectors and signatures are kept if every
+    segment holding them has the same size.
+    """
+    chunk_base = segments[0].chunk_base
+    tombstones = np.fromiter(tombstones, dtype='int64')
+    dimensions = {segment.dimension for segment in segments if segment.dimension}
+    dimension = dimensions.pop() if len(dimensions) == 1 else 0
+    signature_sizes = {segment.signature_size for segment in segments}
+    signature_size = signature_sizes.pop() if len(signature_sizes) == 1 else 0
+
+    text = bytearray()
+    folded = bytearray()
+    sentence_offsets, sentence_keys, chunk_first, chunk_end, lengths = [], [], [], [], []
+    part_owners, part_first_chunk, part_first_sentence = [], [], []
+    postings: Dict[str, Tuple[List[np.ndarray], List[np.ndarray]]] = {}
+    grouped: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+    vector_keys, vectors, signatures = [], [], []
+    sentence = 0
+    chunk_end_id = chunk_base
+    for segment in segments:
+        if segment.chunk_base != chunk_end_id:
+            raise ValueError(f"Segment {segment.path.name} starts at chunk {segment.chunk_base}, "
+                             f"expected {chunk_end_id}")
+        chunk_end_id += len(segment)
+
+        # Text of the kept parts, with every sentence of a dropped part collapsed onto its start
+        offsets = np.frombuffer(segment.sentence_offsets, dtype='uint32')
+        new_offsets = np.empty(segment.num_sentences, dtype='uint32')
+        segment_lengths = np.frombuffer(segment.lengths, dtype='uint32').copy()
+        dropped_chunks = np.zeros(len(segment), dtype=bool)
+        owners = segment.part_owners
+        first_sentences = np.append(segment.part_first_sentence, segment.num_sentences)
+        first_chunks = np.append(segment.part_first_chunk, len(segment))
+        dropped_parts = np.isin(owners, tombstones)
+        for part, dropped in enumerate(dropped_parts.tolist()):
+            first, last = first_sentences[part], first_sentences[part + 1]
+            start, end = offsets[first], offsets[last]
+            if dropped:
+                new_offsets[first:last] = len(text)
+                dropped_chunks[first_chunks[part]:first_chunks[part + 1]] = True
+                continue
+            new_offsets[first:last] = offsets[first:last] - start + np.uint32(len(text))
+            text += segment._text[start:end]
+            folded += segment.folded[start:end]
+        segment_lengths[dropped_chunks] = 0
+        dropped_ids = np.flatnonzero(dropped_chunks).astype('uint32') + np.uint32(segment.chunk_base)
+
+        sentence_offsets.append(new_offsets)
+        sentence_keys.append(np.frombuffer(segment.sentence_keys, dtype='uint32'))
+        chunk_first.append(np.frombuffer(segment.chunk_first, dtype='uint32') + np.uint32(sentence))
+        chunk_end.append(np.frombuffer(segment.chunk_end, dtype='uint32') + np.uint32(sentence))
+        lengths.append(segment_lengths)
+        part_owners.append(owners)
+        part_first_chunk.append(segment.part_first_chunk + np.uint32(segment.chunk_base - chunk_base))
+        part_first_sentence.append(segment.part_first_sentence + np.uint32(sentence))
+        for term, passage_ids, term_freqs in segment.iter_postings():
+            passage_ids = np.frombuffer(passage_ids, dtype='uint32')
+            term_freqs = np.frombuffer(term_freqs, dtype='uint32')
+            if len(dropped_ids):
+                kept = ~np.isin(passage_ids, dropped_ids)
+                passage_ids, term_freqs = passage_ids[kept], term_freqs[kept]
+            if len(passage_ids):
+                runs = postings.setdefault(term, ([], []))
+                runs[0].append(passage_ids)
+                runs[1].append(term_freqs)
+        for entity, section, sentence_id, chunk_id in segment.iter_entities():
+            if not dropped_chunks[chunk_id - segment.chunk_base]:
+                grouped.setdefault((entity, section), []).append((sentence + sentence_id, chunk_id))
+        if dimension and segment.dimension == dimension:
+            keys, segment_vectors = segment.vectors()
+            kept = ~np.isin(keys, dropped_ids)
+            vector_keys.append(keys[kept])
+            vectors.append(segment_vectors[kept])
+        if signature_size:
+            signatures.append(segment.signatures())
+        sentence += segment.num_sentences
+    sentence_offsets.append(np.asarray([len(text)], dtype='uint32'))
+
+    terms = {}
+    passage_ids = []
+    term_freqs = []
+    position = 0
+    for term, (term_passage_ids, term_term_freqs) in postings.items():
+        count = sum(len(run) for run in term_passage_ids)
+        terms[term] = [position, count]
+        passage_ids.extend(term_passage_ids)
+        term_freqs.extend(term_term_freqs)
+        position += count
+    entity_keys, entity_postings = _pack_entities(grouped)
+    lengths = np.concatenate(lengths)
+    vector_keys = np.concatenate(vector_keys) if vector_keys else np.zeros(0, dtype='uint64')
+
+    _write_file(path, {
+        "chunk_base": chunk_base,
+        "num_chunks": len(lengths),
+        "num_sentences": sentence,
+        "dimension": dimension if len(vector_keys) else 0,
+        "signature_size": signature_size,
+        "terms": terms,
+        "entities": entity_keys,
+    }, {
+        "text": bytes(text),
+        "folded": bytes(folded),
+        "sentence_keys": np.concatenate(sentence_keys).tobytes(),
+        "sentence_offsets": np.concatenate(sentence_offsets).tobytes(),
+        "chunk_first": np.concatenate(chunk_first).tobytes(),
+        "chunk_end": np.concatenate(chunk_end).tobytes(),
+        "lengths": lengths.tobytes(),
+        "passage_ids": np.concatenate(passage_ids).tobytes() if passage_ids else b"",
+        "term_freqs": np.concatenate(term_freqs).tobytes() if term_freqs else b"",
+        "vector_keys": vector_keys.tobytes(),
+        "vectors": np.concatenate(vectors).tobytes() if len(vector_keys) else b"",
+        "signatures": np.concatenate(signatures).tobytes() if signatures else b"",
+        "entity_sentences": entity_postings[:, 0].tobytes(),
+        "entity_chunks": entity_postings[:, 1].tobytes(),
+        "part_owners": np.concatenate(part_owners).tobytes(),
+        "part_first_chunk": np.concatenate(part_first_chunk).tobytes(),
+        "part_first_sentence": np.concatenate(part_first_sentence).tobytes(),
+    })
+
+
+def _pack_entities(grouped: Dict[Tuple[str, str], List[Tuple[int, int]]]) -> Tuple[List[list], np.ndarray]:
+    """Lay out (entity, section) -> (sentence ID, chunk ID) postings as header keys and an (n, 2) array"""
+    entity_keys = []
+    entity_postings = []
+    position = 0
+    for (entity, section), entries in grouped.items():
+        entity_keys.append([entity, section, position, len(entries)])
+        entity_postings.extend(entries)
+        position += len(entries)
+    return entity_keys, np.asarray(entity_postings, dtype='uint32').reshape(-1, 2)
+
+
+def _write_file(path: Path, header: Dict, sections: Dict[str, bytes]):
+    """Write a segment header and its sections to ``path``, atomically"""
+    layout = {}
+    offset = 0
+    for name, data in sections.items():
+        layout[name] = [offset, len(data)]
+        offset += len(data) + (-len(data)) % _ALIGNMENT
+    header = json.dumps(dict(header, sections=layout)).encode('utf-8')
+    header += b" " * ((-len(header) - len(_MAGIC) - 8) % _ALIGNMENT)
+
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for data in sections.values():
+            f.write(data)
+            f.write(b"\0" * ((-len(data)) % _ALIGNMENT))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """Read-only, memory-mapped view of one segment file"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"Not a segment file: {self.path}")
+        (header_length,) = struct.unpack_from("<Q", self._mmap, len(_MAGIC))
+        data_start = len(_MAGIC) + 8
+        header = json.loads(self._mmap[data_start:data_start + header_length])
+        self._data_start = data_start + header_length
+        self._sections: Dict[str, List[int]] = header["sections"]
+        self._terms: Dict[str, List[int]] = header["terms"]
+        self._entities: List[Tuple[str, str, int, int]] = header["entities"]
+        self.chunk_base: int = header["chunk_base"]
+        self.num_sentences: int = header["num_sentences"]
+        self.dimension: int = header["dimension"]
+        self.signature_size: int = header["signature_size"]
+        self._num_chunks: int = header["num_chunks"]
+
+        self._view = memoryview(self._mmap)
+        self._text = self._section("text")
+        self.sentence_offsets = self._section("sentence_offsets").cast('I')
+        self.chunk_first = self._section("chunk_first").cast('I')
+        self.chunk_end = self._section("chunk_end").cast('I')
+        self.lengths = self._section("lengths").cast('I')
+        self.folded = self._section("folded")
+        self.sentence_keys = self._section("sentence_keys").cast('I')
+        self._passage_ids = self._section("passage_ids").cast('I')
+        self._term_freqs = self._section("term_freqs").cast('I')
+        # Document ID, first chunk and first sentence of each part, numbered within the segment
+        self.part_owners = np.frombuffer(self._section("part_owners"), dtype='int64')
+        self.part_first_chunk = np.frombuffer(self._section("part_first_chunk"), dtype='uint32')
+        self.part_first_sentence = np.frombuffer(self._section("part_first_sentence"), dtype='uint32')
+
+    def __len__(self) -> int:
+        return self._num_chunks
+
+    def _section(self, name: str) -> memoryview:
+        offset, length = self._sections[name]
+        start = self._data_start + offset
+        return self._view[start:start + length]
+
+    def sentence(self, sentence_id: int) -> str:
+        offsets = self.sentence_offsets
+        return str(self._text[offsets[sentence_id]:offsets[sentence_id + 1]], 'utf-8')
+
+    def part_text(self, part: int) -> str:
+        """Return the text of a part, without the newline ending it"""
+        offsets = self.sentence_offsets
+        last = self.part_first_sentence[part + 1] if part + 1 < len(self.part_owners) else self.num_sentences
+        start, end = offsets[self.part_first_sentence[part]], offsets[last]
+        return str(self._text[start:max(start, end - 1)], 'utf-8')
+
+    def chunk_text(self, local_id: int) -> str:
+        offsets = self.sentence_offsets
+        start = offsets[self.chunk_first[local_id]]
+        end = offsets[self.chunk_end[local_id]]
+        return str(self._text[start:end], 'utf-8').strip()
+
+    def matching_sentences(self, local_id: int, pattern: Pattern[bytes]) -> Iterator[Tuple[int, str]]:
+        offsets = self.sentence_offsets
+        for sentence_id in range(self.chunk_first[local_id], self.chunk_end[local_id]):
+            start, end = offsets[sentence_id], offsets[sentence_id + 1]
+            if pattern.search(self.folded, start, end) is not None:
+                yield self.sentence_keys[sentence_id], str(self._text[start:end], 'utf-8').strip()
+
+    def iter_postings(self) -> Iterator[Tuple[str, memoryview, memoryview]]:
+        """Yield (term, passage IDs, term frequencies) as views into the mapped file"""
+        for term, (start, count) in self._terms.items():
+            yield term, self._passage_ids[start:start + count], self._term_freqs[start:start + count]
+
+    def vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the keys and vectors of the chunks embedded by the writer"""
+        keys = np.frombuffer(self._section("vector_keys"), dtype='uint64')
+        vectors = np.frombuffer(self._section("vectors"), dtype='float32')
+        return keys, vectors.reshape(len(keys), self.dimension) if self.dimension else vectors.reshape(0, 0)
+
+    def signatures(self) -> np.ndarray:
+        """MinHash signatures of the segment's chunks, one row per chunk, or none"""
+        signatures = np.frombuffer(self._section("signatures"), dtype='uint32')
+        return signatures.reshape(len(self), self.signature_size) if self.signature_size else signatures
+
+    def iter_entities(self) -> Iterator[Tuple[str, str, int, int]]:
+        """Yield (entity, section, sentence ID within the segment, chunk ID) entity postings"""
+        sentences = self._section("entity_sentences").cast('I')
+        chunks = self._section("entity_chunks").cast('I')
+        for entity, section, position, count in self._entities:
+            for offset in range(position, position + count):
+                yield entity, section, sentences[offset], chunks[offset]
+
+
+class SegmentedChunks:
+    """Chunk table over attached segments, with the interface of ChunkTable's readers
+
+    Parts are numbered across the attached segments like the documents of a
+    ChunkTable. Dropped documents read back as empty text; their bytes stay
+    in the shared files until a merge leaves them out.
+    """
+
+    def __init__(self):
+        self.segments: List[Segment] = []
+        self._chunk_ends: List[int] = []
+        self._sentence_bases: List[int] = []
+        self._part_bases: List[int] = []
+        self._num_chunks = 0
+        self._num_sentences = 0
+        self.document_owner = array('q')
+        self.document_first_chunk = array('I')
+        self.chunk_document = array('I')
+        self._dropped = bytearray()
+
+    def __len__(self) -> int:
+        return self._num_chunks
+
+    @property
+    def num_sentences(self) -> int:
+        return self._num_sentences
+
+    def attach(self, segment: Segment) -> range:
+        """Append a segment's chunks and return their chunk IDs"""
+        if segment.chunk_base != self._num_chunks:
+            raise ValueError(f"Segment {segment.path.name} starts at chunk {segment.chunk_base}, "
+                             f"expected {self._num_chunks}")
+        part_base = len(self.document_owner)
+        self._part_bases.append(part_base)
+        chunk_counts = np.diff(np.append(segment.part_first_chunk, len(segment)))
+        self.document_owner.frombytes(segment.part_owners.tobytes())
+        self.document_first_chunk.frombytes((segment.part_first_chunk + np.uint32(segment.chunk_base)).tobytes())
+        self.chunk_document.frombytes(np.repeat(np.arange(part_base, len(self.document_owner), dtype='uint32'),
+                                                chunk_counts).tobytes())
+        self._dropped.extend(bytes(len(segment)))
+        self.segments.append(segment)
+        self._sentence_bases.append(self._num_sentences)
+        self._num_sentences += segment.num_sentences
+        self._num_chunks += len(segment)
+        self._chunk_ends.append(self._num_chunks)
+        return range(segment.chunk_base, self._num_chunks)
+
+    def owned_chunks(self, owners: Iterable[int]) -> Tuple[List[int], np.ndarray]:
+        """Return the parts owned by the given document IDs and their chunk IDs"""
+        owned = np.flatnonzero(np.isin(np.frombuffer(self.document_owner, dtype=np.int64),
+                                       np.fromiter(owners, dtype=np.int64)))
+        first_chunks = np.append(np.frombuffer(self.document_first_chunk, dtype=np.uint32), self._num_chunks)
+        chunk_ids = [np.arange(first_chunks[part], first_chunks[part + 1]) for part in owned]
+        return owned.tolist(), np.concatenate(chunk_ids) if chunk_ids else np.zeros(0, dtype=np.int64)
+
+    def drop_documents(self, parts: Iterable[int]) -> int:
+        """Make the chunks of parts read back as empty text
+
+        The shared files keep their bytes until a merge, so none are
+        released.
+        """
+        first_chunks = self.document_first_chunk
+        for part in parts:
+            end = first_chunks[part + 1] if part + 1 < len(first_chunks) else self._num_chunks
+            self._dropped[first_chunks[part]:end] = b"\x01" * (end - first_chunks[part])
+        return 0
+
+    def memory_bytes(self) -> int:
+        """Bytes of the mapped segment files, shared through the page cache"""
+        return sum(len(segment._mmap) for segment in self.segments)
+
+    def _locate(self, chunk_id: int) -> Tuple[int, Segment]:
+        position = bisect_right(self._chunk_ends, chunk_id)
+        if position >= len(self.segments):
+            raise IndexError(chunk_id)
+        return position, self.segments[position]
+
+    def document_text(self, part: int) -> str:
+        """Return the full text of a part, or an empty string once dropped"""
+        if self._dropped[self.document_first_chunk[part]]:
+            return ""
+        position = bisect_right(self._part_bases, part) - 1
+        return self.segments[position].part_text(part - self._part_bases[position])
+
+    def chunk_text(self, chunk_id: int) -> str:
+        _, segment = self._locate(chunk_id)
+        if self._dropped[chunk_id]:
+            return ""
+        return segment.chunk_text(chunk_id - segment.chunk_base)
+
+    def chunk_sentence_range(self, chunk_id: int) -> range:
+        """Sentence IDs of a chunk"""
+        position, segment = self._locate(chunk_id)
+        local_id = chunk_id - segment.chunk_base
+        sentence_base = self._sentence_bases[position]
+        return range(sentence_base + segment.chunk_first[local_id], sentence_base + segment.chunk_end[local_id])
+
+    def sentence_text(self, sentence_id: int) -> str:
+        """Return the raw text of a sentence, with the whitespace following it"""
+        position = bisect_right(self._sentence_bases, sentence_id) - 1
+        return self.segments[position].sentence(sentence_id - self._sentence_bases[position])
+
+    def chunk_sentences(self, chunk_id: int) -> Iterator[Tuple[int, str]]:
+        """Yield (sentence ID, sentence text) for every sentence of a chunk"""
+        position, segment = self._locate(chunk_id)
+        local_id = chunk_id - segment.chunk_base
+        sentence_base = self._sentence_bases[position]
+        if self._dropped[chunk_id]:
+            return
+        for sentence_id in range(segment.chunk_first[local_id], segment.chunk_end[local_id]):
+            sentence = segment.sentence(sentence_id).strip()
+            if sentence:
+                yield sentence_base + sentence_id, sentence
+
+    def matching_sentences(self, chunk_id: int, pattern: Pattern[bytes]) -> Iterator[Tuple[int, str]]:
+        """Yield (sentence key, sentence text) for the sentences of a chunk matching a term_pattern"""
+        _, segment = self._locate(chunk_id)
+        return segment.matching_sentences(chunk_id - segment.chunk_base, pattern)
+
+
+class SegmentManifest:
+    """Ordered list of segment files in a directory shared by all workers"""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / "manifest.json"
+        self._lock_path = self.directory / "manifest.lock"
+        self._seen: Optional[Tuple[int, int]] = None
+
+    def changed(self) -> bool:
+        """Return True if the manifest was replaced since the last ``read``"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != self._seen
+
+    def read(self) -> List[str]:
+        """Return the segment file names in commit order"""
+        return self._read()["segments"]
+
+    def _read(self) -> Dict:
+        try:
+            with open(self.path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {"segments": [], "next_segment": 0, "tombstones": []}
+        self._seen = (stat.st_ino, stat.st_mtime_ns)
+        return manifest
+
+    def _write(self, manifest: Dict):
+        tmp_path = self.path.with_name(f"manifest.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self, known: Dict[str, Segment]) -> Tuple[List[Segment], List[int]]:
+        """Return the segments in commit order, reusing the open ones in ``known`` by name, and the tombstones
+
+        A merge may delete listed files after the manifest is read; it is
+        then read again.
+        """
+        while True:
+            manifest = self._read()
+            try:
+                return [known.get(name) or self.open(name) for name in manifest["segments"]], manifest["tombstones"]
+            except FileNotFoundError:
+                if not self.changed():
+                    raise
+
+    def add_tombstones(self, document_ids: Iterable[int]):
+        """Record documents evicted from the segments for every worker and later merges
+
+        The caller must hold ``lock``.
+        """
+        manifest = self._read()
+        tombstones = set(manifest["tombstones"])
+        manifest["tombstones"] += [document_id for document_id in document_ids if document_id not in tombstones]
+        self._write(manifest)
+
+    @contextmanager
+    def lock(self):
+        """Hold the exclusive writer lock shared by every process"""
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, chunk_base: int, parts: Sequence[PreparedDocument], index_batch: IndexBatch,
+               vector_keys: Sequence[int] = (), vectors: Optional[np.ndarray] = None,
+               signatures: Sequence[np.ndarray] = (),
+               entities: Iterable[Tuple[str, str, int, int, int]] = ()) -> str:
+        """Write a new segment and add it to the manifest; the caller must hold ``lock``"""
+        manifest = self._read()
+        name = f"segment-{manifest['next_segment']:06d}.seg"
+        write_segment(self.directory / name, chunk_base, parts, index_batch, vector_keys, vectors, signatures,
+                      entities)
+        self._write(dict(manifest, segments=manifest["segments"] + [name], next_segment=manifest["next_segment"] + 1))
+        return name
+
+    def merge(self, factor: int) -> List[Tuple[List[str], str]]:
+        """Merge runs of ``factor`` consecutive segments in the same size tier; the caller must hold ``lock``
+
+        Tiers are powers of ``factor`` times _MERGE_FLOOR_BYTES, so small
+        segments are merged soon and large ones rarely. Each run is rewritten
+        as one file without the text of tombstoned documents, the manifest
+        is replaced to list it instead, and the merged files are deleted; workers that mapped them keep reading them
+        until they switch to the new file. Returns (merged names, new name)
+        for each merge.
+        """
+        merges = []
+        if factor < 2:
+            return merges
+        while True:
+            manifest = self._read()
+            names = manifest["segments"]
+            tiers = [int(math.log(max(os.path.getsize(self.directory / name), _MERGE_FLOOR_BYTES)
+                                  / _MERGE_FLOOR_BYTES, factor)) for name in names]
+            start = next((start for start in range(len(names) - factor + 1)
+                          if len(set(tiers[start:start + factor])) == 1), None)
+            if start is None:
+                return merges
+            run = names[start:start + factor]
+            name = f"segment-{manifest['next_segment']:06d}.seg"
+            merge_segments(self.directory / name, [self.open(merged) for merged in run], manifest["tombstones"])
+            self._write(dict(manifest, segments=names[:start] + [name] + names[start + factor:],
+                             next_segment=manifest["next_segment"] + 1))
+            for merged in run:
+                os.unlink(self.directory / merged)
+            merges.append((run, name))
+
+    def open(self, name: str) -> Segment:
+        return Segment(self.directory / name)
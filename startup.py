@@ -0,0 +1,73 @@
+"""
+Staged startup for the Healthcare BERT QA System
+
+The QA engine comes up in stages so a worker can take traffic before the
+slow ones finish. The knowledge base and the corpus are required to answer;
+dense retrieval and the extractive reader load afterwards, and until they do,
+answers fall back to keyword search and retrieved passages. ``stages``
+records the state and load time of every stage for the liveness and
+readiness endpoints.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict
+
+REQUIRED_STAGES = ("knowledge_base", "corpus")
+OPTIONAL_STAGES = ("dense_index", "reader")
+
+
+class StartupStages:
+    """Load state of each startup stage: pending, loading, ready, disabled or failed"""
+
+    def __init__(self, required=REQUIRED_STAGES, optional=OPTIONAL_STAGES):
+        self.required = tuple(required)
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._stages: "OrderedDict[str, Dict[str, Any]]" = OrderedDict(
+            (name, {"status": "pending"}) for name in self.required + tuple(optional))
+
+    @contextmanager
+    def track(self, name: str):
+        """Mark ``name`` loading for the body of the context, then ready or failed"""
+        self.mark(name, "loading")
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.mark(name, "failed", error=str(e), seconds=round(time.perf_counter() - start_time, 3))
+            raise
+        with self._lock:
+            stage = self._stages[name]
+            # The body may have marked the stage disabled instead
+            if stage["status"] == "loading":
+                stage["status"] = "ready"
+            stage["seconds"] = round(time.perf_counter() - start_time, 3)
+
+    def mark(self, name: str, status: str, **details):
+        with self._lock:
+            self._stages[name] = {"status": status, **details}
+
+    @property
+    def ready(self) -> bool:
+        """True once every required stage is ready"""
+        with self._lock:
+            return all(self._stages[name]["status"] == "ready" for name in self.required)
+
+    @property
+    def failed(self) -> bool:
+        with self._lock:
+            return any(self._stages[name]["status"] == "failed" for name in self.required)
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started_at, 3),
+                "stages": {name: dict(stage) for name, stage in self._stages.items()},
+            }
+
+
+stages = StartupStages()
+
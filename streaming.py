@@ -0,0 +1,63 @@
+"""
+Streaming responses for the Healthcare BERT QA System
+
+A client that asks for a stream, with ``?stream=ndjson`` or ``?stream=sse``
+or an ``Accept`` header of ``application/x-ndjson`` or ``text/event-stream``,
+gets each answer as a record as soon as it is ready rather than one JSON
+document at the end; a single question answered from uploaded documents
+sends each passage as it is found. Records are encoded one at a time, so the
+full response is never held in memory.
+"""
+
+import json
+from typing import Dict, Iterable, Optional, Tuple
+
+NDJSON = "ndjson"
+SSE = "sse"
+MIMETYPES = {NDJSON: "application/x-ndjson", SSE: "text/event-stream"}
+
+
+def requested_stream_format() -> Optional[str]:
+    """Return the stream format the current request asks for, or None for a plain JSON response
+
+    Raises ValueError for an unknown ``stream`` parameter.
+    """
+    from flask import request
+
+    requested = request.args.get("stream")
+    if requested is not None:
+        requested = requested.lower()
+        if requested in MIMETYPES:
+            return requested
+        if requested in ("", "0", "false"):
+            return None
+        raise ValueError(f"Stream format must be one of: {', '.join(MIMETYPES)}")
+
+    best = request.accept_mimetypes.best_match(["application/json"] + list(MIMETYPES.values()))
+    for stream_format, mimetype in MIMETYPES.items():
+        if best == mimetype:
+            return stream_format
+    return None
+
+
+def encode_record(stream_format: str, record: Dict, event: str = "answer") -> str:
+    """Encode one record as an NDJSON line or a Server-Sent Event named ``event``"""
+    data = json.dumps(record, separators=(",", ":"))
+    if stream_format == SSE:
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+
+def stream_response(stream_format: str, records: Iterable[Tuple[str, Dict]]):
+    """Return a Flask response sending ``(event, record)`` pairs as they are produced"""
+    from flask import Response, stream_with_context
+
+    def generate():
+        for event, record in records:
+            yield encode_record(stream_format, record, event)
+
+    response = Response(stream_with_context(generate()), mimetype=MIMETYPES[stream_format])
+    response.headers["Cache-Control"] = "no-cache"
+    # Reverse proxies such as nginx would otherwise buffer the whole stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Offline tests of the Flask API, run against the app's test client
+"""
+
+import pytest
+
+import enhanced_full_api as api
+from config import Config
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import admission
+
+    # Every test starts with full rate-limit buckets
+    for budget in admission.budgets.values():
+        limiter = budget.rate_limiter
+        monkeypatch.setattr(budget, "rate_limiter", admission.RateLimiter(limiter.rate * 60.0, int(limiter.capacity)))
+    return api.app.test_client()
+
+
+# Profiling administration
+
+def test_profile_admin_is_disabled_without_token(client, monkeypatch):
+    monkeypatch.setattr(Config, "PROFILING_ADMIN_TOKEN", "")
+
+    assert client.get('/api/v1/admin/profile').status_code == 404
+    assert client.delete('/api/v1/admin/profile', headers={"X-Admin-Token": ""}).status_code == 404
+
+
+def test_profile_admin_requires_token(client, monkeypatch):
+    monkeypatch.setattr(Config, "PROFILING_ADMIN_TOKEN", "secret")
+
+    assert client.get('/api/v1/admin/profile').status_code == 401
+    assert client.get('/api/v1/admin/profile', headers={"X-Admin-Token": "wrong"}).status_code == 401
+    response = client.get('/api/v1/admin/profile', headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert "endpoints" in response.get_json()
+
+
+@pytest.mark.parametrize("query", ["limit=abc", "limit=0", "sort=nonsense"])
+def test_profile_admin_rejects_bad_text_options(client, monkeypatch, query):
+    monkeypatch.setattr(Config, "PROFILING_ADMIN_TOKEN", "secret")
+
+    response = client.get(f'/api/v1/admin/profile?endpoint=ask&format=text&{query}',
+                          headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 400
+
+
+def test_forced_profiling_requires_token(monkeypatch):
+    from profiling import profile_requested
+
+    monkeypatch.setattr(Config, "PROFILING_ADMIN_TOKEN", "")
+    with api.app.test_request_context('/?profile=1', headers={"X-Profile": "1"}):
+        assert not profile_requested()
+
+    monkeypatch.setattr(Config, "PROFILING_ADMIN_TOKEN", "secret")
+    with api.app.test_request_context('/', headers={"X-Profile": "1"}):
+        assert not profile_requested()
+    with api.app.test_request_context('/', headers={"X-Profile": "1", "X-Admin-Token": "secret"}):
+        assert profile_requested()
+
+
+# Startup probes
+
+def test_readiness_turns_ready_once_required_stages_load(client, tmp_path, monkeypatch):
+    import startup
+    from document_store import DocumentStore
+
+    monkeypatch.setattr(startup, "stages", startup.StartupStages())
+    monkeypatch.setattr(api, "qa_engine", None)
+    response = client.get('/api/v1/health/ready')
+    assert response.status_code == 503
+    assert response.get_json()["status"] == "starting"
+    assert client.get('/api/v1/health/live').status_code == 200
+
+    engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(str(tmp_path / "store.db")))
+    report = client.get('/api/v1/health/ready').get_json()
+    assert report["stages"]["knowledge_base"]["status"] == report["stages"]["corpus"]["status"] == "ready"
+    # The engine is not published yet
+    assert client.get('/api/v1/health/ready').status_code == 503
+
+    monkeypatch.setattr(api, "qa_engine", engine)
+    response = client.get('/api/v1/health/ready')
+    assert response.status_code == 200
+    report = response.get_json()
+    # Dense retrieval and the reader are still to load, which does not hold readiness back
+    assert report["status"] == "ready" and report["stages"]["dense_index"]["status"] == "pending"
+    assert client.get('/api/v1/health').get_json()["ready"] is True
+
+
+def test_readiness_reports_failed_required_stages(client, monkeypatch):
+    import startup
+
+    monkeypatch.setattr(startup, "stages", startup.StartupStages())
+    monkeypatch.setattr(api, "qa_engine", None)
+    with pytest.raises(RuntimeError):
+        with startup.stages.track("corpus"):
+            raise RuntimeError("database is locked")
+
+    response = client.get('/api/v1/health/ready')
+    assert response.status_code == 503
+    report = response.get_json()
+    assert report["status"] == "failed" and report["stages"]["corpus"]["error"] == "database is locked"
+
+
+# Extractive reader
+
+READER_DOCUMENT = "Zolpidemx is a sleep medicine. Common side effects of zolpidemx include drowsiness and dizziness."
+
+
+def _engine(tmp_path, reader):
+    from document_store import DocumentStore
+
+    engine = api.EnhancedMedicalQA(load_models=False, reader=reader,
+                                   document_store=DocumentStore(str(tmp_path / "store.db")))
+    engine.ingest_documents([[READER_DOCUMENT]], is_user_upload=True)
+    return engine
+
+
+class FailingReader:
+    def read_many(self, questions, passages):
+        raise RuntimeError("model failed")
+
+
+def test_reader_failure_falls_back_to_passages(tmp_path, caplog):
+    engine = _engine(tmp_path, FailingReader())
+
+    result = engine.answer_question("What are the side effects of zolpidemx?")
+    assert result["source"] == "Uploaded Documents"
+    assert "drowsiness" in result["answer"]
+    assert "Reader skipped" in caplog.text
+
+
+def test_reader_runs_tiny_checkpoint(tmp_path):
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from reader import ExtractiveReader, save_test_checkpoint
+
+    question = "What are the side effects of zolpidemx?"
+    save_test_checkpoint(tmp_path / "reader", [READER_DOCUMENT, question])
+    engine = _engine(tmp_path, ExtractiveReader(tmp_path / "reader", quantize=False))
+
+    result = engine.answer_question(question)
+    assert result["source"] == "Uploaded Documents"
+    # The span or passages answered come from the uploaded document
+    assert result["answer"] in READER_DOCUMENT or "zolpidemx" in result["answer"].lower()
+
+
+# Prebuilt knowledge-base answers
+
+@pytest.fixture
+def engine(tmp_path):
+    from document_store import DocumentStore
+
+    return api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(str(tmp_path / "store.db")))
+
+
+def test_precompiled_answers_encode_like_jsonify(engine):
+    from responses import PrecompiledAnswer, format_answer
+
+    questions = ["What are the side effects of aspirin?", 'Is "aspirin" safe?\n', "Aspirin été — side effects \U0001F48A"]
+    with api.app.app_context():
+        for position, precompiled in enumerate(engine.precompiled_answers):
+            assert isinstance(precompiled, PrecompiledAnswer)
+            for question in questions:
+                expected = api.jsonify(format_answer(question, precompiled.result, 0.01234)).get_data()
+                assert api._json_response(precompiled.encode(question, 0.01234)).get_data() == expected
+
+
+def test_prebuilt_payloads_follow_debug_pretty_printing(monkeypatch):
+    from responses import encode_json
+
+    payload = {"answer": "café", "confidence": 0.9, "results": [1, 2]}
+    monkeypatch.setattr(api.app, "debug", True)
+    with api.app.app_context():
+        assert api._json_response(encode_json(payload)).get_data() == api.jsonify(payload).get_data()
+        assert b"\n  " in api._json_response(encode_json(payload)).get_data()
+
+
+def test_questions_are_routed_once(client, engine, monkeypatch):
+    monkeypatch.setattr(api, "qa_engine", engine)
+    matched = []
+    match = engine.router.match
+    monkeypatch.setattr(engine.router, "match", lambda question: matched.append(question) or match(question))
+
+    for question in ["What are the side effects of aspirin?", "How far away is the moon?"]:
+        matched.clear()
+        assert client.post('/api/v1/ask', json={"question": question}).status_code == 200
+        assert len(matched) == 1
+
+    matched.clear()
+    response = client.post('/api/v1/ask/batch', json={"questions": ["What is diabetes?", "How far away is the moon?"]})
+    assert response.get_json()["count"] == 2
+    assert len(matched) == 2
+
+
+# Batch answers
+
+def test_batch_answers_in_order_with_per_item_errors(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "qa_engine", _engine(tmp_path, None))
+    items = [
+        "What are the side effects of zolpidemx?",
+        "",
+        {"question": "What is diabetes?", "context": "adult patient"},
+        123,
+        {"question": "  "},
+        "What are the side effects of aspirin?",
+    ]
+    response = client.post('/api/v1/ask/batch', json={"questions": items})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["count"] == len(items)
+
+    results = body["results"]
+    assert [result.get("question") for result in results] == [
+        "What are the side effects of zolpidemx?", None, "What is diabetes?", None, None,
+        "What are the side effects of aspirin?"]
+    assert [position for position, result in enumerate(results) if "error" in result] == [1, 3, 4]
+    assert all(results[position]["error"] == "Question cannot be empty" for position in [1, 3, 4])
+    assert results[0]["source"] == "Uploaded Documents"
+    # Each answer matches the one a single question gets
+    single = client.post('/api/v1/ask', json={"question": items[5]}).get_json()
+    assert results[5]["answer"] == single["answer"]
+
+
+@pytest.mark.parametrize("payload", [{}, {"questions": []}, {"questions": "What is diabetes?"}])
+def test_batch_rejects_malformed_requests(client, engine, monkeypatch, payload):
+    monkeypatch.setattr(api, "qa_engine", engine)
+
+    assert client.post('/api/v1/ask/batch', json=payload).status_code == 400
+
+
+def test_batch_rejects_more_than_max_batch_size(client, engine, monkeypatch):
+    monkeypatch.setattr(api, "qa_engine", engine)
+    monkeypatch.setattr(Config, "MAX_BATCH_SIZE", 3)
+
+    response = client.post('/api/v1/ask/batch', json={"questions": ["What is diabetes?"] * 4})
+    assert response.status_code == 400
+    assert "At most 3" in response.get_json()["error"]
+    assert client.post('/api/v1/ask/batch', json={"questions": ["What is diabetes?"] * 3}).status_code == 200
+
+
+# Prometheus metrics
+
+def _scrape(client, name):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return 0.0
+
+
+def test_metrics_count_ingested_utf8_bytes(client, engine):
+    import metrics
+
+    if not metrics.ENABLED:
+        pytest.skip("metrics are disabled")
+    text = "Zolpidemx causes drowsiness — rarely vertigo, naïve patients \U0001F48A."
+    documents = _scrape(client, "hqa_ingested_documents_total")
+    ingested = _scrape(client, "hqa_ingested_bytes_total")
+
+    engine.ingest_documents([[text]], is_user_upload=True)
+    assert _scrape(client, "hqa_ingested_documents_total") == documents + 1
+    assert _scrape(client, "hqa_ingested_bytes_total") == ingested + len(text.encode("utf-8"))
+    assert len(text.encode("utf-8")) > len(text)
+
+
+# Rate limiting behind proxies
+
+def test_rate_limits_follow_forwarded_clients():
+    import os
+    import subprocess
+    import sys
+
+    script = """
+import admission
+import enhanced_full_api as api
+
+client = api.app.test_client()
+for address in ["203.0.113.1", "203.0.113.2"]:
+    client.post('/api/v1/ask', json={}, headers={"X-Forwarded-For": address})
+print(sorted(admission.budgets["ask"].rate_limiter._buckets))
+"""
+    env = dict(os.environ, PROXY_TRUSTED_HOPS="1", RATE_LIMIT_ENABLED="true")
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                            check=True).stdout
+    assert output.strip().splitlines()[-1] == "['203.0.113.1', '203.0.113.2']"
+
+
+def test_max_size_batch_leaves_questions_admitted(tmp_path):
+    import os
+    import subprocess
+    import sys
+
+    script = f"""
+import enhanced_full_api as api
+from config import Config
+from document_store import DocumentStore
+
+api.qa_engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore({str(tmp_path / "store.db")!r}))
+client = api.app.test_client()
+batch = client.post('/api/v1/ask/batch', json={{"questions": ["What is diabetes?"] * Config.MAX_BATCH_SIZE}})
+question = client.post('/api/v1/ask', json={{"question": "What is diabetes?"}})
+print(batch.status_code, question.status_code)
+"""
+    env = dict(os.environ, RATE_LIMIT_ENABLED="true", BACKGROUND_STARTUP="false")
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                            check=True).stdout
+    assert output.strip().splitlines()[-1] == "200 200"
+
+
+# Streaming responses
+
+def test_ask_streams_passages_then_answer_as_ndjson(client, tmp_path, monkeypatch):
+    import json
+
+    monkeypatch.setattr(api, "qa_engine", _engine(tmp_path, None))
+    response = client.post('/api/v1/ask?stream=ndjson', json={"question": "What are the side effects of zolpidemx?"})
+    assert response.mimetype == "application/x-ndjson"
+    body = response.get_data(as_text=True)
+    assert body.endswith("\n")
+    records = [json.loads(line) for line in body.splitlines()]
+
+    passages = [record for record in records if "passage" in record]
+    assert [record["passage"] for record in passages] == list(range(len(passages)))
+    assert passages and all(record["text"] in READER_DOCUMENT for record in passages)
+    answer, done = records[len(passages):]
+    assert answer["index"] == 0 and answer["source"] == "Uploaded Documents"
+    assert answer["answer"] == " ".join(record["text"] for record in passages)
+    assert done["done"] is True and done["count"] == 1
+
+
+def test_batch_streams_server_sent_events(client, engine, monkeypatch):
+    import json
+
+    monkeypatch.setattr(api, "qa_engine", engine)
+    response = client.post('/api/v1/ask/batch', json={"questions": ["What is diabetes?", "", "What is aspirin?"]},
+                           headers={"Accept": "text/event-stream"})
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    events = response.get_data(as_text=True).split("\n\n")
+    assert events.pop() == ""
+
+    parsed = []
+    for event in events:
+        name, data = event.split("\n")
+        assert name.startswith("event: ") and data.startswith("data: ")
+        parsed.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    assert [name for name, _ in parsed] == ["answer", "answer", "answer", "done"]
+    assert [record["index"] for _, record in parsed[:3]] == [0, 1, 2]
+    assert "error" in parsed[1][1] and "answer" in parsed[2][1]
+    assert parsed[3][1]["done"] is True and parsed[3][1]["count"] == 3
+
+
+def test_abandoned_stream_releases_its_admission_slot(client, engine, monkeypatch):
+    import admission
+
+    if not Config.RATE_LIMIT_ENABLED:
+        pytest.skip("admission control is disabled")
+    monkeypatch.setattr(api, "qa_engine", engine)
+    concurrency = admission.budgets["batch"].concurrency
+    active = concurrency.active
+
+    response = client.post('/api/v1/ask/batch?stream=ndjson', json={"questions": ["What is diabetes?"] * 20},
+                           buffered=False)
+    assert next(iter(response.response))
+    assert concurrency.active == active + 1
+    # The client disconnects before the stream is done
+    response.close()
+    assert concurrency.active == active
+
+
+# Background ingestion jobs
+
+def _wait_for_job(client, job_id):
+    import time
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        status = client.get(f'/api/v1/docs/jobs/{job_id}').get_json()
+        if status["status"] in ("completed", "failed"):
+            return status
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_upload_jobs_report_their_status_transitions(client, engine, monkeypatch):
+    import threading
+
+    from ingestion import IngestionQueue
+
+    monkeypatch.setattr(api, "qa_engine", engine)
+    monkeypatch.setattr(api, "ingestion_queue", IngestionQueue(workers=1, max_pending=4, history=10))
+    # A job holding the only worker keeps the upload queued
+    started, release = threading.Event(), threading.Event()
+    blocker = api.ingestion_queue.submit("blocker", lambda job: (started.set(), release.wait(10)))
+    assert started.wait(10)
+    running = client.get(f'/api/v1/docs/jobs/{blocker.id}').get_json()
+    assert running["status"] == "running" and running["started_at"] and running["finished_at"] is None
+
+    response = client.post('/api/v1/docs/upload', json={"documents": ["Zolpidemx is a sleep medicine.",
+                                                                       {"text": "Zolpidemx causes drowsiness."}]})
+    assert response.status_code == 202
+    accepted = response.get_json()
+    assert accepted["status"] == "queued"
+    queued = client.get(accepted["status_url"]).get_json()
+    assert queued["status"] == "queued" and queued["started_at"] is None
+
+    release.set()
+    done = _wait_for_job(client, accepted["job_id"])
+    assert done["status"] == "completed" and done["error"] is None
+    assert done["documents_processed"] == 2 and done["documents_committed"] == 2
+    assert done["started_at"] <= done["finished_at"]
+
+    response = client.post('/api/v1/docs/upload', json={"documents": "not a list"})
+    failed = _wait_for_job(client, response.get_json()["job_id"])
+    assert failed["status"] == "failed" and "must be a list" in failed["error"]
+
+
+def test_unknown_job_status_is_not_found(client):
+    response = client.get('/api/v1/docs/jobs/does-not-exist')
+    assert response.status_code == 404
+    assert response.get_json()["error"] == "Ingestion job not found"
@@ -0,0 +1,889 @@
+#!/usr/bin/env python3
+"""
+Offline tests of the retrieval, caching and corpus building blocks
+"""
+
+import pytest
+
+
+# Dense retrieval, with the deterministic hashing encoder
+
+DENSE_TEXTS = [
+    "Aspirin can cause stomach bleeding and ulcers.",
+    "Metformin lowers blood glucose in type 2 diabetes.",
+    "Lisinopril treats high blood pressure and heart failure.",
+    "Albuterol inhalers relieve asthma attacks.",
+]
+
+
+class CountingEmbedder:
+    """Hashing encoder that records how many texts it embedded"""
+
+    def __init__(self):
+        from dense_retrieval import HashingEmbedder
+
+        self._embedder = HashingEmbedder(dimension=64)
+        self.dimension = self._embedder.dimension
+        self.encoded = 0
+
+    def encode(self, texts, batch_size=32):
+        self.encoded += len(texts)
+        return self._embedder.encode(texts, batch_size)
+
+
+def _dense_index(embedder, path=None, **kwargs):
+    pytest.importorskip("faiss")
+    from dense_retrieval import DenseIndex
+
+    return DenseIndex(embedder, path, hnsw_m=8, **kwargs)
+
+
+def test_dense_index_add_and_search():
+    index = _dense_index(CountingEmbedder())
+    index.add(range(len(DENSE_TEXTS)), DENSE_TEXTS)
+
+    assert len(index) == len(DENSE_TEXTS)
+    assert index.search("asthma inhalers", k=1)[0][0] == 3
+    assert [hits[0][0] for hits in index.search_many(["glucose diabetes", "stomach bleeding"], k=1)] == [1, 0]
+
+
+def test_dense_index_save_and_load_reuse_vectors(tmp_path):
+    path = tmp_path / "dense.faiss"
+    index = _dense_index(CountingEmbedder(), path)
+    index.add(range(len(DENSE_TEXTS)), DENSE_TEXTS)
+    index.save()
+
+    embedder = CountingEmbedder()
+    reloaded = _dense_index(embedder, path)
+    assert len(reloaded) == len(DENSE_TEXTS)
+    assert reloaded.stale_count == len(DENSE_TEXTS)
+    reloaded.add(range(len(DENSE_TEXTS)), DENSE_TEXTS)
+    assert embedder.encoded == 0
+    assert reloaded.stale_count == 0
+    assert reloaded.search("high blood pressure", k=1)[0][0] == 2
+
+
+def test_dense_index_compacts_stale_vectors():
+    index = _dense_index(CountingEmbedder(), compact_fraction=0.5)
+    index.add(range(len(DENSE_TEXTS)), DENSE_TEXTS)
+
+    index.remove([0], DENSE_TEXTS[:1])
+    assert not index.maybe_compact()
+    assert index.search("stomach bleeding aspirin", k=1)[0][0] != 0
+
+    index.remove([1], DENSE_TEXTS[1:2])
+    assert index.maybe_compact()
+    assert len(index) == 2 and index.stale_count == 0
+    assert index.search("asthma inhalers", k=1)[0][0] == 3
+    assert {chunk_id for chunk_id, _ in index.search("blood", k=4)} == {2, 3}
+
+
+# Keyword retrieval
+
+def _exhaustive_bm25(passages, query, k1=1.2, b=0.75):
+    """Score every passage containing a query term, without any pruning"""
+    import math
+
+    live = [tokens for tokens in passages if tokens is not None]
+    avg_length = sum(len(tokens) for tokens in live) / len(live)
+    scores = {}
+    for term in set(query):
+        containing = [pid for pid, tokens in enumerate(passages) if tokens is not None and term in tokens]
+        if not containing:
+            continue
+        idf = math.log(1.0 + (len(live) - len(containing) + 0.5) / (len(containing) + 0.5))
+        for pid in containing:
+            tf = passages[pid].count(term)
+            length = len(passages[pid])
+            scores[pid] = scores.get(pid, 0.0) + idf * tf * (k1 + 1.0) / (tf + k1 * (1.0 - b + b * length / avg_length))
+    return scores
+
+
+def _random_passages(seed, count=300):
+    import random
+
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(60)]
+    # Skewed term frequencies, so some postings lists are long and others short
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    return [rng.choices(vocabulary, weights, k=rng.randint(3, 40)) for _ in range(count)], vocabulary, rng
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_bm25_early_termination_matches_exhaustive_scoring(seed):
+    from array import array
+
+    from retrieval import IndexBatch, InvertedIndex
+
+    passages, vocabulary, rng = _random_passages(seed)
+    index = InvertedIndex()
+    for tokens in passages[:200]:
+        index.add(tokens)
+    # Attached passages get postings runs of their own, as segment files do
+    batch = IndexBatch()
+    for tokens in passages[200:]:
+        batch.add(tokens)
+    index.attach(batch.lengths, ((term, array('I', (200 + pid for pid in ids)), freqs)
+                                 for term, (ids, freqs) in batch.postings.items()))
+    removed = rng.sample(range(len(passages)), 30)
+    index.remove(removed)
+    for pid in removed:
+        passages[pid] = None
+
+    for _ in range(25):
+        query = rng.sample(vocabulary, rng.randint(1, 6))
+        for k in (1, 5, 10):
+            expected = sorted(_exhaustive_bm25(passages, query).values(), reverse=True)[:k]
+            found = index.search(query, k)
+            assert [score for _, score in found] == pytest.approx(expected)
+            assert all(passages[pid] is not None for pid, _ in found)
+
+
+def test_bm25_remove_rewrites_only_the_removed_passages_terms():
+    from retrieval import InvertedIndex
+
+    passages, vocabulary, rng = _random_passages(4)
+    passages.append(["unrelated", "words"])
+    index = InvertedIndex()
+    for tokens in passages:
+        index.add(tokens)
+    untouched = index._postings["unrelated"]
+
+    removed = rng.sample(range(len(passages) - 1), 40)
+    assert index.remove(removed + removed[:5]) == 40
+    assert index.remove(removed) == 0
+    assert index._postings["unrelated"] is untouched
+    for pid in removed:
+        passages[pid] = None
+    for term in vocabulary[:10]:
+        expected = sorted(_exhaustive_bm25(passages, [term]).values(), reverse=True)[:10]
+        assert [score for _, score in index.search([term], 10)] == pytest.approx(expected)
+
+
+def test_chunk_table_drops_text_and_compacts_past_fraction():
+    from chunking import ChunkTable
+
+    table = ChunkTable(chunk_size=60, chunk_overlap=0, compact_fraction=0.5)
+    texts = [f"Document {number} talks about medicine. It has a second sentence too." for number in range(4)]
+    for number, text in enumerate(texts):
+        table.add_prepared(table.prepare_document(text)._replace(document_id=number + 1))
+    arena_size = len(table.text)
+
+    documents, chunk_ids = table.owned_chunks([2])
+    assert documents == [1] and all(table.chunk_document[chunk_id] == 1 for chunk_id in chunk_ids)
+    # Below the fraction the text is only tombstoned, in new offsets swapped in for the old ones
+    arena = table._arena
+    assert table.drop_documents(documents) == 0
+    assert len(table.text) == arena_size
+    assert table._arena is not arena and table.text is arena[0]
+    assert arena[0][arena[2][table.chunk_first_sentence[chunk_ids[0]]]:].startswith(texts[1].encode())
+    assert all(table.chunk_text(chunk_id) == "" for chunk_id in chunk_ids)
+    assert table.document_text(1) == "" and table.document_text(2) == texts[2]
+
+    released = table.drop_documents(table.owned_chunks([3, 4])[0])
+    assert released > 0 and len(table.text) < arena_size and table.dropped_bytes == 0
+    assert table.document_text(0) == texts[0]
+    assert [table.chunk_text(chunk_id) for chunk_id in table.owned_chunks([1])[1]] == \
+        [chunk for chunk in table.prepare_document(texts[0]).chunk_texts()]
+
+
+def test_chunk_offsets_slice_the_original_text():
+    from chunking import ChunkTable, sentence_offsets
+
+    text = "Fever is common. Café au lait spots — rare! Is it serious?\n\nSee a doctor."
+    offsets = sentence_offsets(text, 200)
+    assert [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)] == \
+        ["Fever is common. ", "Café au lait spots — rare! ", "Is it serious?\n\n", "See a doctor."]
+    # Sentences without punctuation are cut at a space below the limit
+    long_offsets = sentence_offsets("alpha beta gamma delta epsilon", 12)
+    assert list(long_offsets) == [0, 10, 16, 22, 30]
+
+    table = ChunkTable(chunk_size=200, chunk_overlap=0)
+    table.add_document("First document.")
+    chunk_ids = table.add_document(text)
+    # Byte offsets into the arena decode back to the same sentences
+    assert [sentence for _, sentence in table.chunk_sentences(chunk_ids[0])] == \
+        ["Fever is common.", "Café au lait spots — rare!", "Is it serious?", "See a doctor."]
+    assert table.document_text(1) == text and table.chunk_text(chunk_ids[0]) == text
+
+
+@pytest.mark.parametrize("overlap, expected", [
+    (0, [(0, 2), (2, 4), (4, 5)]),
+    # A sentence with its trailing space is eleven characters, so it only fits an overlap of 11
+    (10, [(0, 2), (2, 4), (4, 5)]),
+    (11, [(0, 2), (1, 3), (2, 4), (3, 5)]),
+])
+def test_chunks_overlap_by_whole_sentences(overlap, expected):
+    from chunking import chunk_sentences, prepare_document
+
+    # Five sentences of ten characters each
+    text = "".join(f"Sentence{number}. " for number in range(5)).strip()
+    document = prepare_document(text, chunk_size=25, overlap=overlap)
+    assert document.chunks == chunk_sentences(document.offsets, 25, overlap) == expected
+    chunk_texts = document.chunk_texts()
+    assert all(len(chunk) <= 25 for chunk in chunk_texts)
+    # Every sentence is in some chunk, and chunks start where a sentence does
+    assert " ".join(dict.fromkeys(sentence for chunk in chunk_texts for sentence in chunk.split(" "))) == text
+
+
+# Intent routing
+
+ROUTER_KNOWLEDGE = {
+    "aspirin": {"side_effects": ["stomach upset", "bleeding"]},
+    "diabetes": {"symptoms": ["thirst", "fatigue"], "management": "diet and exercise"},
+    "pneumonia": {"symptoms": ["cough", "fever"]},
+    "hypertension": {"risk_factors": ["salt", "age"], "treatment": "lifestyle changes",
+                     "medications": "ACE inhibitors"},
+    "insulin": {"types": ["rapid-acting", "long-acting"]},
+}
+
+
+def _baseline_route(question, knowledge):
+    """The keyword cascade the intent router replaced, without the document search"""
+    q = question.lower()
+    kb = "Medical Knowledge Base"
+    if any(term in q for term in ['side effect', 'adverse effect', 'reaction']) and 'aspirin' in q:
+        return {"answer": "Common side effects of aspirin include: " + ", ".join(knowledge["aspirin"]["side_effects"]),
+                "confidence": 0.95, "source": kb, "category": "medication_side_effects"}
+    if any(term in q for term in ['symptom', 'sign']):
+        if 'diabetes' in q:
+            return {"answer": "Common symptoms of diabetes include: " + ", ".join(knowledge["diabetes"]["symptoms"]),
+                    "confidence": 0.93, "source": kb, "category": "disease_symptoms"}
+        elif 'pneumonia' in q:
+            return {"answer": "Common symptoms of pneumonia include: " + ", ".join(knowledge["pneumonia"]["symptoms"]),
+                    "confidence": 0.92, "source": kb, "category": "disease_symptoms"}
+    if any(term in q for term in ['risk factor', 'cause']):
+        if any(term in q for term in ['hypertension', 'high blood pressure', 'blood pressure']):
+            return {"answer": "Risk factors for hypertension include: " + ", ".join(knowledge["hypertension"]["risk_factors"]),
+                    "confidence": 0.94, "source": kb, "category": "risk_factors"}
+    if any(term in q for term in ['treatment', 'therapy', 'manage']):
+        if 'diabetes' in q:
+            return {"answer": f"Diabetes management includes: {knowledge['diabetes']['management']}",
+                    "confidence": 0.91, "source": kb, "category": "treatment"}
+        elif any(term in q for term in ['hypertension', 'high blood pressure']):
+            return {"answer": f"Hypertension treatment includes: {knowledge['hypertension']['treatment']}. "
+                              f"Medications include: {knowledge['hypertension']['medications']}",
+                    "confidence": 0.92, "source": kb, "category": "treatment"}
+    if 'insulin' in q:
+        return {"answer": "Types of insulin include: " + "; ".join(knowledge["insulin"]["types"]),
+                "confidence": 0.90, "source": kb, "category": "medication_types"}
+    for key, answer, confidence in [
+        ("what is diabetes", "Diabetes is a group of metabolic disorders characterized by high blood sugar levels. "
+                             "Type 1 is autoimmune, Type 2 involves insulin resistance.", 0.88),
+        ("what is hypertension", "Hypertension is high blood pressure consistently above 140/90 mmHg, "
+                                 "a major risk factor for cardiovascular disease.", 0.87),
+        ("what is pneumonia", "Pneumonia is an infection that inflames air sacs in the lungs, which may fill "
+                              "with fluid or pus, caused by bacteria, viruses, or fungi.", 0.86),
+    ]:
+        if key in q:
+            return {"answer": answer, "confidence": confidence, "source": kb, "category": "general_information"}
+    return None
+
+
+ROUTER_FRAGMENTS = ["what is", "what are the", "side effects of", "adverse reactions to", "symptoms of", "signs of",
+                    "risk factors for", "what causes", "treatment of", "therapy for", "how to manage", "types of",
+                    "aspirin", "diabetes", "pneumonia", "hypertension", "high blood pressure", "blood pressure",
+                    "insulin", "design", "signature", "because", "?", "WHAT IS DIABETES"]
+
+
+def test_intent_router_matches_keyword_cascade():
+    import random
+
+    from intent_router import IntentRouter
+
+    router = IntentRouter(ROUTER_KNOWLEDGE)
+    rng = random.Random(7)
+    questions = [
+        "What are the side effects of aspirin?", "What reactions can aspirin cause?",
+        "What are the signs of diabetes?", "How is high blood pressure treated?",
+        "What causes high blood pressure?", "What is hypertension?", "What is insulin?",
+        "Is there a treatment for pneumonia?", "What is a heart attack?", "",
+    ]
+    questions += [" ".join(rng.choices(ROUTER_FRAGMENTS, k=rng.randint(1, 5))) for _ in range(2000)]
+    for question in questions:
+        assert router.route(question.lower()) == _baseline_route(question, ROUTER_KNOWLEDGE), question
+
+
+# Streamed uploads
+
+STREAMED_TEXT = "Café au lait — naïve résumé \U0001F48A. Dosage: 5 µg per day! Ask a doctor?\n\nEnd."
+
+
+def _blocks(text: str, size: int):
+    return iter([text[start:start + size] for start in range(0, len(text), size)])
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 5, 64])
+def test_iter_decoded_joins_characters_split_across_reads(read_size):
+    import io
+
+    from ingestion import iter_decoded
+
+    blocks = list(iter_decoded(io.BytesIO(STREAMED_TEXT.encode("utf-8")), read_size=read_size))
+    assert "".join(blocks) == STREAMED_TEXT
+    assert all(blocks)
+
+    with pytest.raises(UnicodeDecodeError):
+        list(iter_decoded(io.BytesIO(b"valid text \xff\xfe more"), read_size=4))
+    # A sequence cut off at the end of the stream is an error too
+    with pytest.raises(UnicodeDecodeError):
+        list(iter_decoded(io.BytesIO("é".encode("utf-8")[:1]), read_size=4))
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 7, 1024])
+def test_json_documents_parse_across_split_tokens(block_size):
+    import json
+
+    from ingestion import iter_json_documents
+
+    body = json.dumps({
+        "collection": {"name": "notes", "tags": ["a", "b"]},
+        "version": 12345678,
+        "documents": [STREAMED_TEXT, {"text": "Escaped \"quote\" and \\ backslash"}, 42, {"title": "no text"},
+                      "last \u00e9"],
+        "trailing": True,
+    }, ensure_ascii=True)
+    documents = list(iter_json_documents(_blocks(body, block_size)))
+    assert documents == [STREAMED_TEXT, 'Escaped "quote" and \\ backslash', None, None, "last é"]
+    assert list(iter_json_documents(_blocks('{"documents": []}', block_size))) == []
+
+
+@pytest.mark.parametrize("body, message", [
+    ('["not", "an", "object"]', "expected '{'"),
+    ('{}', "Documents are required"),
+    ('{"other": 1}', "Documents are required"),
+    ('{"documents": "text"}', "Documents must be a list"),
+    ('{"documents": ["complete", "trunc', "Invalid JSON document"),
+    ('{"documents": ["a" "b"]}', "expected ','"),
+])
+def test_json_documents_reject_malformed_bodies(body, message):
+    from ingestion import iter_json_documents
+
+    with pytest.raises(ValueError, match=message):
+        list(iter_json_documents(_blocks(body, 3)))
+
+
+def test_document_parts_end_at_sentences_and_stay_bounded():
+    from chunking import iter_document_parts
+
+    sentences = [f"Sentence number {number} mentions aspirin. " for number in range(200)]
+    text = "".join(sentences)
+    parts = list(iter_document_parts(_blocks(text, 37), part_size=500))
+    assert "".join(parts) == text
+    assert len(parts) > 1
+    for part in parts[:-1]:
+        assert part.endswith(". ") and len(part) <= 500 + len(sentences[0])
+
+    # Without sentence boundaries parts are cut at a space once twice the part size is buffered
+    words = "word " * 1000
+    parts = list(iter_document_parts(_blocks(words, 37), part_size=500))
+    assert "".join(parts) == words
+    assert all(len(part) <= 2 * 500 for part in parts) and all(part.endswith(" ") for part in parts)
+
+
+# Background ingestion shared between worker processes
+
+def test_ingestion_jobs_are_visible_to_other_processes_and_resumed(tmp_path):
+    import subprocess
+    import sys
+
+    from document_store import DocumentStore
+    from ingestion import IngestionQueue
+
+    store = DocumentStore(str(tmp_path / "store.db"))
+    ran = []
+    first = IngestionQueue(workers=1)
+    first.use_store(store)
+    job = first.submit("one document", lambda job: ran.append("first"), spec={"name": "first"})
+    first._queue.join()
+
+    # Another worker process only sees the job through the store
+    other = IngestionQueue(workers=1)
+    other.use_store(DocumentStore(str(tmp_path / "store.db")))
+    assert other.get(job.id) is None
+    assert other.status(job.id)["status"] == "completed"
+    assert other.status("missing") is None
+
+    # A job queued by a process that has exited since is resumed once
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    status = dict(job.to_dict(), job_id="orphan", status="queued", started_at=None, finished_at=None)
+    store.save_job(status, spec={"name": "orphan"}, owner=exited.pid)
+    assert other.resume(lambda spec: lambda job: ran.append(spec["name"])) == 1
+    assert other.resume(lambda spec: lambda job: ran.append(spec["name"])) == 0
+    other._queue.join()
+    assert ran == ["first", "orphan"]
+    assert first.status("orphan")["status"] == "completed"
+
+
+# Answer cache
+
+class FakeRedis:
+    """The Redis commands RedisCache uses, over a dict; expiry times are recorded but not enforced"""
+
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode() if isinstance(value, str) else value
+        self.expiry[key] = ex
+
+    def incr(self, key):
+        self.values[key] = str(int(self.values.get(key, 0)) + 1).encode()
+        return int(self.values[key])
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+def test_lru_cache_expires_and_evicts_least_recently_used(monkeypatch):
+    import types
+
+    import caching
+
+    now = [100.0]
+    monkeypatch.setattr(caching, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    cache = caching.LRUCache(max_entries=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3
+
+    now[0] += 10.5
+    assert cache.get("a") is None and len(cache) == 1
+    cache.set("a", 4)
+    assert cache.get("a") == 4
+
+
+def test_answer_cache_drops_upload_answers_of_older_generations():
+    from caching import AnswerCache
+
+    cache = AnswerCache()
+    cache.set("What is diabetes?", None, {"answer": "rule"})
+    cache.set("What does zolpidemx treat?", None, {"answer": "upload"}, generation=cache.generation)
+    assert cache.get("what is diabetes") == {"answer": "rule"}
+    assert cache.get("What does zolpidemx treat?") == {"answer": "upload"}
+    assert cache.get("What does zolpidemx treat?", "with context") is None
+
+    cache.invalidate_corpus()
+    assert cache.get("What does zolpidemx treat?") is None
+    # Answers that never depend on uploads survive
+    assert cache.get("What is diabetes?") == {"answer": "rule"}
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 2
+
+
+def test_answer_cache_shares_entries_and_generations_through_redis():
+    from caching import AnswerCache, LRUCache, RedisCache
+
+    client = FakeRedis()
+    first = AnswerCache(LRUCache(), RedisCache(client, ttl=60))
+    second = AnswerCache(LRUCache(), RedisCache(client, ttl=60))
+    first.set("What does zolpidemx treat?", None, {"answer": "upload"}, generation=first.generation)
+    assert client.expiry and all(ttl == 60 for ttl in client.expiry.values())
+
+    assert second.get("What does zolpidemx treat?") == {"answer": "upload"}
+    assert second.stats()["remote_hits"] == 1 and second.stats()["backend"] == "memory+redis"
+    # An upload on one worker invalidates the local copies of every worker
+    first.invalidate_corpus()
+    assert second.generation == 1
+    assert second.get("What does zolpidemx treat?") is None
+    assert first.get("What does zolpidemx treat?") is None
+
+
+def test_uploads_invalidate_cached_answers(tmp_path):
+    import enhanced_full_api as api
+    from document_store import DocumentStore
+
+    engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(str(tmp_path / "store.db")))
+    engine.ingest_documents([["Zolpidemx is a sleep medicine."]], is_user_upload=True)
+    question = "What is zolpidemx?"
+    first = engine.answer_question(question)
+    assert "sleep medicine" in first["answer"]
+    generation = engine.answer_cache.generation
+    assert engine.answer_cache.get(question) == first
+
+    engine.ingest_documents([["Zolpidemx is also prescribed for jet lag."]], is_user_upload=True)
+    assert engine.answer_cache.generation > generation
+    assert engine.answer_cache.get(question) is None
+    assert "jet lag" in engine.answer_question(question)["answer"]
+
+
+# Semantic answer cache
+
+@pytest.mark.parametrize("first, second, reused", [
+    ("What are the side effects of aspirin?", "adverse effects of aspirin", True),
+    ("What are the common side effects of aspirin?", "Tell me the side effects of aspirin", True),
+    ("Is aspirin safe during pregnancy?", "Is aspirin not safe during pregnancy?", False),
+    ("Is aspirin safe during pregnancy?", "Isn't aspirin safe during pregnancy?", False),
+    ("Is aspirin safe during pregnancy?", "Is ibuprofen safe during pregnancy?", False),
+    ("Is aspirin safe during pregnancy?", "Is aspirin safe during pregnancy with diabetes?", False),
+    ("What are the side effects of aspirin?", "What is the dosage of aspirin?", False),
+    ("What is the aspirin dose for a child weighing 50 kg?", "aspirin dose for a child weighing 50kg", True),
+    ("What is the aspirin dose for a child weighing 50 kg?", "What is the aspirin dose for a child weighing 100 kg?",
+     False),
+    ("Is aspirin 81 mg safe during pregnancy?", "Is aspirin 325 mg safe during pregnancy?", False),
+])
+def test_semantic_cache_reuses_only_equivalent_questions(first, second, reused):
+    from caching import SemanticCache
+    from entities import EntityMatcher
+
+    cache = SemanticCache(EntityMatcher(), threshold=0.8)
+    cache.set(first, {"answer": first}, generation=0)
+
+    result = cache.get(second, generation=0)
+    assert (result is not None) == reused
+    assert cache.get(first, generation=1) is None
+
+
+# Near-duplicate detection
+
+DEDUP_TEXT = ("aspirin is used to reduce fever and relieve mild to moderate pain from conditions such as "
+              "muscle aches toothaches common cold and headaches").split()
+
+
+def test_minhash_lsh_keeps_every_chunk_sharing_a_band():
+    from dedup import MinHashLSH
+
+    lsh = MinHashLSH(num_perm=64, bands=16, threshold=0.8)
+    signature = lsh.signature(DEDUP_TEXT)
+    lsh.add_many(0, [signature, signature, signature])
+    assert lsh.find(signature) == 0
+
+    # Evicting the first chunk with a band leaves the later ones findable
+    lsh.remove([0])
+    assert lsh.find(signature) == 1
+    lsh.remove([1])
+    assert lsh.find(signature) == 2
+    lsh.remove([2])
+    assert lsh.find(signature) is None
+
+    # Pruned and truncated entries are gone from the band tables
+    assert all(not table.get(band_hash) for table, band_hash in zip(lsh._tables, lsh.band_hashes(signature)))
+    lsh.add(3, signature)
+    lsh.truncate(3)
+    assert lsh.find(signature) is None
+    lsh.add(3, lsh.signature(DEDUP_TEXT[::-1]))
+    assert lsh.find(signature) is None
+
+
+def test_dedup_stats_count_only_uploads(tmp_path):
+    import enhanced_full_api as api
+    from document_store import DocumentStore
+
+    path = str(tmp_path / "store.db")
+    api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    # The sample documents are read again on every start, but are not uploads
+    engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    assert engine.deduplication_stats()["documents"] == 0
+    assert engine.deduplication_stats()["exact_duplicate_documents"] == 0
+
+    engine.ingest_documents([["Zolpidemx is a sleep medicine."], ["Zolpidemx is a sleep medicine."]],
+                            is_user_upload=True)
+    stats = engine.deduplication_stats()
+    assert stats["documents"] == 2 and stats["exact_duplicate_documents"] == 1
+
+
+def test_dedup_stats_add_up_across_ingestion_threads(tmp_path):
+    import threading
+
+    import enhanced_full_api as api
+    from document_store import DocumentStore
+
+    engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(str(tmp_path / "store.db")))
+    # Every thread sends the same ten unrelated documents, so only one copy of each is kept
+    documents = [[" ".join(f"term{number}x{word}" for word in range(12)) + "."] for number in range(10)]
+    threads = [threading.Thread(target=engine.ingest_documents, args=(documents,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = engine.deduplication_stats()
+    assert stats["documents"] == 40
+    assert stats["exact_duplicate_documents"] + stats["near_duplicate_documents"] == 30
+
+
+@pytest.mark.parametrize("segments", [False, True])
+def test_restart_loads_stored_signatures(tmp_path, monkeypatch, segments):
+    import enhanced_full_api as api
+    from config import Config
+    from dedup import MinHashLSH
+    from document_store import DocumentStore
+    from retrieval import tokenize
+
+    monkeypatch.setattr(Config, "SEGMENTS_ENABLED", segments)
+    monkeypatch.setattr(Config, "SEGMENTS_DIR", tmp_path / "segments")
+    path = str(tmp_path / "store.db")
+    api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path)).ingest_documents(
+        [[" ".join(DEDUP_TEXT) + "."]])
+
+    computed = []
+    signature = MinHashLSH.signature
+    monkeypatch.setattr(MinHashLSH, "signature", lambda self, tokens: computed.append(tokens) or signature(self, tokens))
+    engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    assert not computed
+    assert engine.deduplicator.find(signature(engine.deduplicator, tokenize(engine.chunks.chunk_text(0)))) == 0
+
+
+# Shared segments
+
+SEGMENT_DOCUMENTS = [
+    "Side effects of aspirin include mild nausea in some people.",
+    "Zolpidemx is a sleep medicine taken at bedtime.",
+    "Side effects of ibuprofen include stomach upset and heartburn.",
+]
+
+
+def test_segments_merge_keeps_chunk_ids_and_other_workers_switch(tmp_path, monkeypatch):
+    import enhanced_full_api as api
+    from config import Config
+    from document_store import DocumentStore
+
+    monkeypatch.setattr(Config, "SEGMENTS_ENABLED", True)
+    monkeypatch.setattr(Config, "SEGMENTS_DIR", tmp_path / "segments")
+    monkeypatch.setattr(Config, "SEGMENT_MERGE_FACTOR", 2)
+    path = str(tmp_path / "store.db")
+    writer = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    other = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+
+    writer.ingest_documents([[SEGMENT_DOCUMENTS[0]]])
+    assert "nausea" in other.search_uploaded_documents("aspirin nausea")
+    # Every commit makes a run of two small segments, merged into one file
+    for document in SEGMENT_DOCUMENTS[1:]:
+        writer.ingest_documents([[document]])
+    assert writer.segments.read() == ["segment-000004.seg"]
+    assert sorted(file.name for file in (tmp_path / "segments").glob("*.seg")) == ["segment-000004.seg"]
+
+    # The other worker switches to the merged file, indexing the chunks it had not seen
+    assert "heartburn" in other.search_uploaded_documents("ibuprofen heartburn")
+    restarted = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    for engine in (writer, other, restarted):
+        assert [segment.path.name for segment in engine.chunks.segments] == ["segment-000004.seg"]
+        assert [engine.chunks.chunk_text(chunk_id) for chunk_id in range(3)] == SEGMENT_DOCUMENTS
+        assert len(engine.deduplicator) == 3 and engine.entity_index.stats()["entries"] == 2
+        assert engine._lookup_entity("What are the side effects of ibuprofen?")[1] == [2]
+
+
+def test_evictions_are_shared_through_segment_tombstones(tmp_path, monkeypatch):
+    import enhanced_full_api as api
+    from config import Config
+    from document_store import DocumentStore
+
+    monkeypatch.setattr(Config, "SEGMENTS_ENABLED", True)
+    monkeypatch.setattr(Config, "SEGMENTS_DIR", tmp_path / "segments")
+    monkeypatch.setattr(Config, "SEGMENT_MERGE_FACTOR", 0)
+    path = str(tmp_path / "store.db")
+    writer = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    other = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    writer.ingest_documents([[SEGMENT_DOCUMENTS[0]], [SEGMENT_DOCUMENTS[1]]])
+
+    # Other workers load the records of documents committed elsewhere and account their memory
+    assert "nausea" in other.search_uploaded_documents("aspirin nausea")
+    owner = other.chunks.document_owner[0]
+    position = other.documents.position(owner)
+    assert other.documents.memory[position] > 0
+
+    with writer._index_lock:
+        writer._evict_documents([(writer.documents.position(owner), "age")])
+    assert writer.segments.load({})[1] == [owner]
+    assert other.search_uploaded_documents("aspirin nausea") == ""
+    assert other.documents.evicted[position] and other.chunks.chunk_text(0) == ""
+    assert other._lookup_entity("What are the side effects of aspirin?") == ("", [])
+    assert "bedtime" in other.search_uploaded_documents("zolpidemx bedtime")
+
+    # A merge leaves the evicted text out of the merged file
+    monkeypatch.setattr(Config, "SEGMENT_MERGE_FACTOR", 2)
+    writer.ingest_documents([[SEGMENT_DOCUMENTS[2]]])
+    merged = (tmp_path / "segments" / writer.segments.read()[0]).read_bytes()
+    assert b"nausea" not in merged and b"bedtime" in merged
+    restarted = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    for engine in (other, restarted):
+        assert "heartburn" in engine.search_uploaded_documents("ibuprofen heartburn")
+        assert engine.search_uploaded_documents("aspirin nausea") == ""
+        assert engine.chunk_index.live_count == 2 and len(engine.deduplicator) == 3
+        assert [engine.chunks.chunk_text(chunk_id) for chunk_id in range(3)] == [""] + SEGMENT_DOCUMENTS[1:]
+
+
+# Entity index
+
+ENTITY_QUESTION = "What are the side effects of aspirin for the stomach?"
+
+
+def test_entity_postings_are_stored_ranked_and_evicted(tmp_path):
+    import enhanced_full_api as api
+    from document_store import DocumentStore
+
+    path = str(tmp_path / "store.db")
+    api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path)).ingest_documents([
+        ["Side effects of aspirin include mild nausea in some people."],
+        ["Side effects of aspirin include stomach bleeding and stomach ulcers with long term use for stomach pain."],
+    ])
+    engine = api.EnhancedMedicalQA(load_models=False, document_store=DocumentStore(path))
+    assert engine.entity_index.stats()["entries"] == 2
+
+    # The chunk matching the question best comes first, although it was uploaded last
+    passages, chunk_ids = engine._lookup_entity(ENTITY_QUESTION)
+    assert chunk_ids == [1, 0]
+    assert passages.startswith("Side effects of aspirin include stomach bleeding")
+
+    owner = engine.chunks.document_owner[engine.chunks.chunk_document[1]]
+    with engine._index_lock:
+        engine._evict_documents([(engine.documents.position(owner), "age")])
+    assert engine.entity_index.stats()["entries"] == 1
+    assert engine._lookup_entity(ENTITY_QUESTION)[1] == [0]
+
+
+# Document extraction
+
+class _LazyFuture:
+    """A future run only when its result is asked for, like a task still queued in the pool"""
+
+    def __init__(self, function, args):
+        from concurrent.futures import Future
+
+        self.future = Future()
+        self._call = (function, args)
+
+    def result(self):
+        if self.future.set_running_or_notify_cancel():
+            function, args = self._call
+            try:
+                self.future.set_result(function(*args))
+            except Exception as e:
+                self.future.set_exception(e)
+        return self.future.result()
+
+    def cancel(self):
+        return self.future.cancel()
+
+
+class _QueuedExecutor:
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, function, *args):
+        self.futures.append(_LazyFuture(function, args))
+        return self.futures[-1]
+
+
+def _failing_task(message):
+    raise ValueError(message)
+
+
+def test_extraction_cancels_tasks_of_skipped_and_failed_documents(monkeypatch):
+    import extraction
+    from config import Config
+
+    tasks = {
+        "skipped": [(str, ("skipped 1",)), (str, ("skipped 2",)), (str, ("skipped 3",))],
+        "failed": [(_failing_task, ("broken page",)), (str, ("failed 2",)), (str, ("failed 3",))],
+        "read": [(str, ("read 1",)), (str, ("read 2",))],
+    }
+    monkeypatch.setattr(extraction, "_tasks", lambda path, document_format: iter(tasks[path]))
+    monkeypatch.setattr(Config, "EXTRACTION_PROCESSES", 1)
+    executor = _QueuedExecutor()
+
+    documents = extraction.iter_extracted_documents([(path, "pdf") for path in tasks], executor)
+    assert next(next(documents)) == "skipped 1\n\n"
+    with pytest.raises(ValueError, match="broken page"):
+        list(next(documents))
+    assert list(next(documents)) == ["read 1\n\n", "read 2\n\n"]
+
+    states = [(future.future.cancelled(), future.future.done()) for future in executor.futures]
+    assert len(executor.futures) == 8
+    assert all(done for _, done in states)
+    assert sum(cancelled for cancelled, _ in states) == 4
+
+    # Abandoning the documents cancels what is still queued
+    executor = _QueuedExecutor()
+    documents = extraction.iter_extracted_documents([(path, "pdf") for path in tasks], executor)
+    assert next(next(documents)) == "skipped 1\n\n"
+    documents.close()
+    assert all(future.future.done() for future in executor.futures)
+
+
+# Admission control
+
+def test_rate_limiter_charges_requests_past_the_burst():
+    from admission import RateLimiter
+
+    limiter = RateLimiter(rate_per_minute=60, burst=5)
+    assert limiter.acquire("batch", cost=20) is None
+    # The whole cost is paid off before the next request
+    assert limiter.acquire("batch") == pytest.approx(16, abs=0.1)
+    assert limiter.acquire("other", cost=5) is None
+    assert limiter.acquire("other", cost=20) == pytest.approx(5, abs=0.1)
+
+
+# Micro-batching
+
+class _GatedProcess:
+    """Batch function recording its batches; the first one blocks until ``release`` is set"""
+
+    def __init__(self):
+        import threading
+
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        if len(self.batches) == 1:
+            self.started.set()
+            self.release.wait(5)
+        return [item * 10 for item in items]
+
+
+def test_micro_batcher_fills_batches_and_counts_the_wait_from_submission():
+    import time
+
+    from batching import MicroBatcher
+
+    process = _GatedProcess()
+    batcher = MicroBatcher(process, max_batch_size=3, max_wait=0.5)
+    first = batcher.submit(0)
+    assert process.started.wait(5)
+    futures = [batcher.submit(item) for item in range(1, 6)]
+    # Their waits run out while the first batch is busy, so the next batches leave at once
+    time.sleep(0.6)
+    released = time.perf_counter()
+    process.release.set()
+    assert [future.result(5) for future in [first] + futures] == [0, 10, 20, 30, 40, 50]
+    assert time.perf_counter() - released < 0.4
+    assert process.batches == [[0], [1, 2, 3], [4, 5]]
+
+
+def test_micro_batcher_cancels_abandoned_items_and_rejects_when_full():
+    import time
+
+    from batching import BatcherFull, MicroBatcher
+
+    process = _GatedProcess()
+    batcher = MicroBatcher(process, max_batch_size=8, max_wait=0.01, max_pending=2)
+    batcher.submit(0)
+    assert process.started.wait(5)
+
+    with pytest.raises(TimeoutError):
+        batcher.run_many([1], timeout=0.05)
+    # One slot is left, so the second item is refused and the first withdrawn
+    with pytest.raises(BatcherFull):
+        batcher.run_many([2, 3], timeout=1)
+    with pytest.raises(BatcherFull):
+        batcher.submit(4)
+
+    process.release.set()
+    deadline = time.monotonic() + 5
+    while batcher.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert batcher.run_many([5], timeout=5) == [50]
+    assert process.batches == [[0], [5]]
@@ -66,38 +66,39 @@ def test_medical_questions():
     successful_answers = 0
     high_confidence_answers = 0
     
-    for i, question in enumerate(questions, 1):
-        try:
-            response = requests.post(
-                'http://localhost:5000/api/v1/ask', 
-                json={'question': question}, 
-                timeout=10
-            )
+    # Send every question in one batch request instead of one request each
+    try:
+        response = requests.post(
+            'http://localhost:5000/api/v1/ask/batch', 
+            json={'questions': questions}, 
+            timeout=60
+        )
+        response.raise_for_status()
+        results = response.json()['results']
+    except Exception as e:
+        print(f"ERROR: {e}")
+        results = [{"error": str(e)} for _ in questions]
+    
+    for i, (question, data) in enumerate(zip(questions, results), 1):
+        if 'error' not in data:
+            answer = data['answer']
+            confidence = data['confidence']
+            category = data.get('category', 'general')
             
-            if response.status_code == 200:
-                data = response.json()
-                answer = data['answer']
-                confidence = data['confidence']
-                category = data.get('category', 'general')
-                
-                print(f"{i:2d}. QUESTION: {question}")
-                print(f"    ANSWER: {answer[:100]}{'...' if len(answer) > 100 else ''}")
-                print(f"    CONFIDENCE: {confidence:.1%}")
-                print(f"    CATEGORY: {category}")
-                print()
-                
-                successful_answers += 1
-                if confidence >= 0.9:
-                    high_confidence_answers += 1
-                    
-            else:
-                print(f"{i:2d}. QUESTION: {question}")
-                print(f"    ERROR: HTTP {response.status_code}")
-                print()
+            print(f"{i:2d}. QUESTION: {question}")
+            print(f"    ANSWER: {answer[:100]}{'...' if len(answer) > 100 else ''}")
+            print(f"    CONFIDENCE: {confidence:.1%}")
+            print(f"    CATEGORY: {category}")
+            print(f"    TIME: {data.get('processing_time', 0) * 1000:.2f} ms")
+            print()
+            
+            successful_answers += 1
+            if confidence >= 0.9:
+                high_confidence_answers += 1
                 
-        except Exception as e:
+        else:
             print(f"{i:2d}. QUESTION: {question}")
-            print(f"    ERROR: {e}")
+            print(f"    ERROR: {data['error']}")
             print()
     
     print("=" * 80)